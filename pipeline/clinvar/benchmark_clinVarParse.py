@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+benchmarks clinVarParse on a synthetic filtered ClinVar XML file, built from copies of the
+ClinVarSet in test_files with distinct IDs and accessions, with one and with more processes
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+CLINVAR_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(CLINVAR_DIR, "test_files", "enigma_clinvar_set.xml")
+HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+         '<ReleaseSet Dated="2020-01-01" Type="full" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+
+
+def options(parser):
+    parser.add_argument("--n_sets", type=int, default=20000)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def write_clinvar_xml(path, n_sets, rnd):
+    """writes n_sets copies of the template ClinVarSet, a tenth of which aren't current"""
+    with open(TEMPLATE_PATH) as f:
+        template = f.read().strip()
+    with open(path, "w") as f:
+        f.write(HEADER)
+        for i in range(n_sets):
+            clinvar_set = template.replace('ID="31343495"', 'ID="{}"'.format(i)).replace("SCV000783130", "SCV{:09d}".format(i))
+            if rnd.random() < 0.1:
+                clinvar_set = clinvar_set.replace("<RecordStatus>current</RecordStatus>", "<RecordStatus>replaced</RecordStatus>", 1)
+            f.write(clinvar_set + "\n")
+        f.write("</ReleaseSet>\n")
+
+
+def run(xml_path, log_path, processes):
+    """runs clinVarParse, returning its output and the elapsed time"""
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, os.path.join(CLINVAR_DIR, "clinVarParse.py"), xml_path,
+                                      "--logs", log_path, "--processes", str(processes)],
+                                     env=dict(os.environ, PYTHONPATH=os.path.dirname(CLINVAR_DIR)))
+    return output, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    options(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        xml_path = os.path.join(directory, "ClinVar.xml")
+        write_clinvar_xml(xml_path, args.n_sets, random.Random(args.seed))
+        print("{} ClinVarSets, {:.1f} MB".format(args.n_sets, os.path.getsize(xml_path) / 1e6))
+
+        expected = None
+        for processes in args.processes:
+            output, elapsed = run(xml_path, os.path.join(directory, "clinvar_xml_to_txt.log"), processes)
+            print("{:>3d} processes {:>10.2f} s {:>8d} lines".format(processes, elapsed, output.count(b"\n")))
+            if expected is None:
+                expected = output
+            elif output != expected:
+                raise Exception("output with {} processes differs from the output with {}".format(processes, args.processes[0]))
+
+
+if __name__ == "__main__":
+    main()
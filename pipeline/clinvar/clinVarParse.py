@@ -4,11 +4,13 @@ clinVarParse: parse the ClinVar XML file and output the data of interest
 """
 import argparse
 import logging
+import multiprocessing
+import sys
 import xml.etree.ElementTree as ET
 import re
 
 from clinvar import clinvar_common as clinvar
-from common import utils
+from common import hgvs_utils, utils
 
 
 def printHeader():
@@ -21,14 +23,20 @@ def printHeader():
 
 MULTI_VALUE_SEP = ','
 
+# ClinVarSets are passed to the workers of the process pool in chunks of this many sets
+POOL_CHUNK_SIZE = 16
+
+
 def processSubmission(submissionSet, assembly):
+    """Returns the output lines of the submissions of a ClinVarSet"""
     ra = submissionSet.referenceAssertion
 
     if ra.variant is None:
         logging.warning("No variant information could be extracted for ReferenceClinVarAssertion ID %s %s",
                      submissionSet.referenceAssertion.id, [c.accession for c in submissionSet.otherAssertions.values()])
-        return None
+        return []
 
+    lines = []
     debug = False
     for oa in list(submissionSet.otherAssertions.values()):
         variant = ra.variant
@@ -47,26 +55,27 @@ def processSubmission(submissionSet, assembly):
 
             # Omit the variants that don't have any genomic start coordinate indicated.
             if vcf_var and _bases_only(vcf_var.ref) and _bases_only(vcf_var.alt):
-                print("\t".join((str(hgvs),
-                                 oa.submitter,
-                                 str(oa.clinicalSignificance),
-                                 str(oa.dateLastUpdated),
-                                 str(oa.dateSignificanceLastEvaluated),
-                                 str(oa.accession),
-                                 str(oa.accession_version),
-                                 str(oa.id),
-                                 str(oa.origin),
-                                 str(oa.method),
-                                 str(vcf_var).replace('g.', ''),
-                                 str(variant.geneSymbol),
-                                 str(proteinChange),
-                                 str(oa.description),
-                                 str(oa.summaryEvidence),
-                                 str(oa.reviewStatus),
-                                 str(ra.condition_type),
-                                 str(ra.condition_value),
-                                 ",".join(ra.condition_db_id) if isinstance(ra.condition_db_id, list) else str(ra.condition_db_id),
-                                 str(synonyms))))
+                lines.append("\t".join((str(hgvs),
+                                       oa.submitter,
+                                       str(oa.clinicalSignificance),
+                                       str(oa.dateLastUpdated),
+                                       str(oa.dateSignificanceLastEvaluated),
+                                       str(oa.accession),
+                                       str(oa.accession_version),
+                                       str(oa.id),
+                                       str(oa.origin),
+                                       str(oa.method),
+                                       str(vcf_var).replace('g.', ''),
+                                       str(variant.geneSymbol),
+                                       str(proteinChange),
+                                       str(oa.description),
+                                       str(oa.summaryEvidence),
+                                       str(oa.reviewStatus),
+                                       str(ra.condition_type),
+                                       str(ra.condition_value),
+                                       ",".join(ra.condition_db_id) if isinstance(ra.condition_db_id, list) else str(ra.condition_db_id),
+                                       str(synonyms))))
+    return lines
 
 
 def _bases_only(seq):
@@ -74,36 +83,63 @@ def _bases_only(seq):
     return all(s in set(['-', 'A', 'C', 'T', 'G']) for s in seq)
 
 
+def iterateClinVarSets(clinVarXmlFilename):
+    """Yields the ClinVarSet elements of the ClinVar XML file, each one is cleared once the next one is read"""
+    context = ET.iterparse(clinVarXmlFilename, events=("start", "end"))
+    _, root = next(context)
+    for event, el in context:
+        if event == "end" and el.tag == "ClinVarSet":
+            yield el
+            # drops the sets processed so far
+            root.clear()
+
+
+def processClinVarSet(cvs, assembly):
+    """Returns the output lines of a ClinVarSet element"""
+    if clinvar.isCurrent(cvs):
+        submissionSet = clinvar.clinVarSet(cvs)
+        return processSubmission(submissionSet, assembly)
+    return []
+
+
+def initWorker():
+    # the UTA connection of the parent process can't be shared
+    hgvs_utils.HgvsWrapper.get_instance().reconnect()
+
+
+def processSerializedClinVarSet(args):
+    """Returns the output lines of a serialized ClinVarSet, in a worker of the process pool"""
+    cvsXml, assembly = args
+    return processClinVarSet(ET.fromstring(cvsXml), assembly)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("clinVarXmlFilename")
     parser.add_argument('-a', "--assembly", default="GRCh38")
     parser.add_argument('-l', "--logs")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes extracting the submissions of the ClinVarSets in parallel")
     args = parser.parse_args()
 
     utils.setup_logfile(args.logs)
 
     printHeader()
 
-    inputBuffer = ""
-    with open(args.clinVarXmlFilename) as inputFile:
-        inClinVarSet = False
-        for line in inputFile:
-            if "<ClinVarSet" in line:
-                inHeader = False
-                inputBuffer = line
-                inClinVarSet = True
-            elif "</ClinVarSet>" in line:
-                inputBuffer += line
-                inClinVarSet = False
-
-                cvs = ET.fromstring(inputBuffer)
-                if clinvar.isCurrent(cvs):
-                    submissionSet = clinvar.clinVarSet(cvs)
-                    processSubmission(submissionSet, args.assembly)
-                inputBuffer = None
-            elif inClinVarSet:
-                inputBuffer += line
+    clinVarSets = iterateClinVarSets(args.clinVarXmlFilename)
+    if args.processes > 1:
+        # otherwise buffered output of the parent would get written by the workers as well
+        sys.stdout.flush()
+        with multiprocessing.Pool(args.processes, initializer=initWorker) as pool:
+            serialized = ((ET.tostring(cvs), args.assembly) for cvs in clinVarSets)
+            # imap returns the lines of the sets in the order of the file
+            for lines in pool.imap(processSerializedClinVarSet, serialized, POOL_CHUNK_SIZE):
+                for line in lines:
+                    print(line)
+    else:
+        for cvs in clinVarSets:
+            for line in processClinVarSet(cvs, args.assembly):
+                print(line)
 
 if __name__ == "__main__":
     # execute only if run as a script
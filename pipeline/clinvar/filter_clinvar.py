@@ -1,44 +1,145 @@
 '''
 Parses original ClinVar XML file and filters out ClinVarSets of interest
+
+The file is read once: the ClinVarSet elements are cut out of the decompressed bytes, sets which can't mention
+one of the gene symbols are skipped without parsing them, and the remaining candidates are parsed and matched
+against the XPath filter by a pool of processes, keeping the order of the file.
 '''
 
 import gzip
-import itertools
+import multiprocessing
+import re
+import sys
+from xml.sax.saxutils import escape
 
 import click
 from lxml import etree
 from clinvar import clinvar_common
 
+# the decompressed file is read in chunks of this many bytes
+READ_SIZE = 1024 * 1024
+
+CLINVAR_SET_START = re.compile(rb'<ClinVarSet[\s>]')
+CLINVAR_SET_END = b'</ClinVarSet>'
+WHITESPACE = re.compile(rb'\s*')
+
+# last start tag of the header, i.e. the root element the ClinVarSets are parsed in
+ROOT_START_TAG = re.compile(rb'<([A-Za-z_][^\s>/]*)[^>]*>')
+
+# root element of files without header
+DEFAULT_ROOT = (b'<ReleaseSet>', b'</ReleaseSet>')
+
+# objects of the parent process used by the workers of the process pool, see init_worker
+POOL_CONTEXT = dict()
+
+
 def open_maybe_gzip(fname):
     if fname.endswith('gz'):
         return gzip.GzipFile(fname)
     else:
-        return open(fname, 'r')
+        return open(fname, 'rb')
+
+
+def build_symbols_prescreen(gene_symbols):
+    '''
+    Returns a regular expression matching a ClinVarSet if it may contain a Symbol ElementValue with one of the
+    gene symbols as text, as required by the XPath filter
+    '''
+    symbols = b'|'.join(re.escape(escape(s).encode('utf-8')) for s in gene_symbols)
+    return re.compile(rb'>(?:' + symbols + rb')<')
+
+
+def split_clinvar_sets(f, read_size=READ_SIZE):
+    '''
+    Given a ClinVar XML file object, returns the header (the lines before the first one mentioning
+    ClinVarSet) and an iterator of the ClinVarSet elements as bytes, reading the file once
+    '''
+    buffer = b''
+    while b'ClinVarSet' not in buffer:
+        chunk = f.read(read_size)
+        if not chunk:
+            break
+        buffer += chunk
 
+    first = buffer.find(b'ClinVarSet')
+    header_end = buffer.rfind(b'\n', 0, first) + 1 if first >= 0 else len(buffer)
+    return buffer[:header_end], _iterate_clinvar_sets(f, buffer[header_end:], read_size)
 
-def filter_xml(fin, fout, symbols):
+
+def _iterate_clinvar_sets(f, buffer, read_size):
+    # sets are yielded with the whitespace following them, like the tail of the elements parsed by iterparse
+    position = 0
+    # the end tag of the current set isn't before this offset
+    scanned = 0
+    while True:
+        match = CLINVAR_SET_START.search(buffer, position)
+        if match:
+            end = buffer.find(CLINVAR_SET_END, max(match.end(), scanned))
+            if end >= 0:
+                tail_end = WHITESPACE.match(buffer, end + len(CLINVAR_SET_END)).end()
+                if tail_end < len(buffer):
+                    yield buffer[match.start():tail_end]
+                    position = scanned = tail_end
+                    continue
+
+        chunk = f.read(read_size)
+        if not chunk:
+            if match and end >= 0:
+                yield buffer[match.start():]
+            return
+        # keeps the incomplete set, or the end of the buffer which may hold the beginning of a start tag
+        keep = match.start() if match else max(position, len(buffer) - len(b'<ClinVarSet '))
+        scanned = (end if end >= 0 else max(len(buffer) - len(CLINVAR_SET_END), match.end())) - keep if match else 0
+        buffer = buffer[keep:] + chunk
+        position = 0
+
+
+def root_tags(header):
+    '''Returns the start and end tag of the root element opened by the header'''
+    matches = [m for m in ROOT_START_TAG.finditer(header)]
+    if not matches:
+        return DEFAULT_ROOT
+    return matches[-1].group(0), b'</' + matches[-1].group(1) + b'>'
+
+
+def init_worker(xpath_filter, root_start, root_end):
+    POOL_CONTEXT['xpath_filter'] = xpath_filter
+    POOL_CONTEXT['root'] = (root_start, root_end)
+
+
+def filter_clinvar_set(clinvar_set):
+    '''Returns the serialized ClinVarSet if it matches the XPath filter, otherwise None'''
+    root_start, root_end = POOL_CONTEXT['root']
+    # parsing the set within the root element keeps the namespace declarations of the root in scope
+    el = etree.fromstring(root_start + clinvar_set + root_end)[0]
+    if len(el.xpath(POOL_CONTEXT['xpath_filter'])) >= 1:
+        return etree.tostring(el, pretty_print=True, encoding='UTF-8')
+    return None
+
+
+def filter_xml(fin, fout, symbols, processes=1):
     fout = open(fout, 'wb')
 
     xpath_filter = clinvar_common.build_xpath_filter_for_cv_assertions(symbols)
+    prescreen = build_symbols_prescreen(symbols)
 
-    # copying header
     with open_maybe_gzip(fin) as f:
-        header_lines = itertools.takewhile(lambda s: "ClinVarSet" not in s.decode('utf-8'), f)
-        fout.writelines(header_lines)
+        # copying header
+        header, clinvar_sets = split_clinvar_sets(f)
+        fout.write(header)
 
-    # filtering ClinVarSet's we are interested in
-    with open_maybe_gzip(fin) as f:
-        for _, el in etree.iterparse(f, tag='ClinVarSet'):
-            if len(el.xpath(xpath_filter)) >= 1:
-                fout.write(etree.tostring(el, pretty_print=True, encoding='UTF-8'))
-
-            # some cleanup to save a significant amount of memory
-            # (inspired by https://www.ibm.com/developerworks/xml/library/x-hiperfparse/)
-            el.clear()
-            # Also eliminate now-empty references from the root node to elem
-            for ancestor in el.xpath('ancestor-or-self::*'):
-                while ancestor.getprevious() is not None:
-                    del ancestor.getparent()[0]
+        # filtering ClinVarSet's we are interested in
+        candidates = (s for s in clinvar_sets if prescreen.search(s))
+        context = (xpath_filter,) + root_tags(header)
+        if processes > 1:
+            # otherwise buffered output of the parent would get written by the workers as well
+            sys.stdout.flush()
+            with multiprocessing.Pool(processes, initializer=init_worker, initargs=context) as pool:
+                filtered = pool.imap(filter_clinvar_set, candidates, chunksize=16)
+                fout.writelines(s for s in filtered if s is not None)
+        else:
+            init_worker(*context)
+            fout.writelines(s for s in map(filter_clinvar_set, candidates) if s is not None)
 
     # writing "footer"
     fout.write("</ReleaseSet>".encode('UTF-8'))
@@ -50,8 +151,9 @@ def filter_xml(fin, fout, symbols):
 @click.argument('input', type=click.Path(exists=True))
 @click.argument('output', type=click.Path())
 @click.option('--gene', type=str, required=True, multiple=True)
-def main(input, output, gene):
-    filter_xml(input, output, list(set(gene)))
+@click.option('--processes', type=int, default=1, help='number of processes parsing the ClinVarSets')
+def main(input, output, gene, processes):
+    filter_xml(input, output, list(set(gene)), processes)
 
 if __name__ == "__main__":
     main()
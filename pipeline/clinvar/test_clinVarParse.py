@@ -0,0 +1,28 @@
+import os
+
+from . import clinVarParse
+
+
+def write_clinvar_xml(tmpdir, set_ids):
+    xml_path = os.path.join(os.path.dirname(__file__), 'test_files', 'enigma_clinvar_set.xml')
+    with open(xml_path) as f:
+        template = f.read().strip()
+    path = str(tmpdir.join('ClinVar.xml'))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<ReleaseSet Type="full">\n')
+        for set_id in set_ids:
+            f.write(template.replace('ID="31343495"', 'ID="{}"'.format(set_id)) + '\n')
+        f.write('</ReleaseSet>\n')
+    return path
+
+
+def test_iterate_clinvar_sets(tmpdir):
+    path = write_clinvar_xml(tmpdir, [3, 1, 2])
+
+    assert [cvs.get('ID') for cvs in clinVarParse.iterateClinVarSets(path)] == ['3', '1', '2']
+
+
+def test_iterate_single_clinvar_set():
+    xml_path = os.path.join(os.path.dirname(__file__), 'test_files', 'enigma_clinvar_set.xml')
+
+    assert [cvs.get('ID') for cvs in clinVarParse.iterateClinVarSets(xml_path)] == ['31343495']
@@ -0,0 +1,54 @@
+import gzip
+import io
+import os
+
+import pytest
+from lxml import etree
+
+from . import filter_clinvar
+
+
+HEADER = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' \
+         b'<ReleaseSet Dated="2020-01-01" Type="full" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+
+
+def clinvar_set(set_id, symbol):
+    xml_path = os.path.join(os.path.dirname(__file__), 'test_files', 'enigma_clinvar_set.xml')
+    with open(xml_path, 'rb') as f:
+        s = f.read().strip().replace(b' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"', b'')
+    return s.replace(b'ID="31343495"', b'ID="%d"' % set_id).replace(b'>BRCA1<', b'>' + symbol + b'<')
+
+
+@pytest.mark.parametrize("read_size", [7, 100, filter_clinvar.READ_SIZE])
+def test_split_clinvar_sets(read_size):
+    sets = [clinvar_set(i, b'BRCA1') for i in range(3)]
+    data = HEADER + b''.join(b'  ' + s + b'\n' for s in sets) + b'</ReleaseSet>\n'
+
+    header, split = filter_clinvar.split_clinvar_sets(io.BytesIO(data), read_size)
+
+    assert header == HEADER
+    assert list(split) == [s + b'\n  ' for s in sets[:-1]] + [sets[-1] + b'\n']
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_filter_xml(tmpdir, processes):
+    sets = [clinvar_set(1, b'BRCA1'), clinvar_set(2, b'TP53'), clinvar_set(3, b'BRCA2'),
+            clinvar_set(4, b'BRCA2').replace(b'<ElementValue Type="Preferred">BRCA2<', b'<ElementValue Type="Alternate">BRCA2<')]
+    input_path = str(tmpdir.join('ClinVarFullRelease.xml.gz'))
+    with gzip.open(input_path, 'wb') as f:
+        f.write(HEADER + b''.join(b'  ' + s + b'\n' for s in sets) + b'</ReleaseSet>\n')
+    output_path = str(tmpdir.join('ClinVar.xml'))
+
+    filter_clinvar.filter_xml(input_path, output_path, ['BRCA1', 'BRCA2'], processes)
+
+    root = etree.parse(output_path).getroot()
+    assert root.get('Dated') == '2020-01-01'
+    assert [el.get('ID') for el in root] == ['1', '3']
+
+
+def test_symbols_prescreen():
+    prescreen = filter_clinvar.build_symbols_prescreen(['BRCA1', 'A&B'])
+
+    assert prescreen.search(b'<ElementValue Type="Preferred">BRCA1</ElementValue>')
+    assert prescreen.search(b'<ElementValue Type="Preferred">A&amp;B</ElementValue>')
+    assert not prescreen.search(b'<ElementValue Type="Preferred">BRCA12</ElementValue>')
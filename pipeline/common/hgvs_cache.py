@@ -0,0 +1,177 @@
+"""
+Cache of the lookups of the UTA data provider and of the conversions of HgvsWrapper, so that the transcripts and
+variants looked up by one stage of a run aren't looked up again by the next ones.
+
+Cached values are kept in a bounded in-memory LRU tier per process and, if a path is given (see HGVS_CACHE_PATH
+in hgvs_utils), in a SQLite store shared by the processes and stages of a run. Stored values are only valid for
+the UTA data version and hgvs version which produced them, others are dropped when the store is opened.
+
+Without a data provider, a store recorded by earlier runs stands in for UTA, e.g. to run tests offline.
+"""
+import collections
+import json
+import logging
+import pickle
+import sqlite3
+
+import hgvs
+from hgvs.exceptions import HGVSDataNotAvailableError
+
+# lookups of the hgvs data provider interface which are cached
+CACHED_LOOKUPS = frozenset(["data_version", "schema_version", "get_acs_for_protein_seq", "get_assembly_map",
+                            "get_gene_info", "get_pro_ac_for_tx_ac", "get_seq", "get_similar_transcripts",
+                            "get_tx_exons", "get_tx_for_gene", "get_tx_for_region", "get_tx_identity_info",
+                            "get_tx_info", "get_tx_mapping_options"])
+
+# number of values kept in memory per process
+DEFAULT_MAXSIZE = 100000
+
+
+class LRUTier(object):
+    """In-memory tier holding the most recently used maxsize values"""
+    name = "memory"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def reopen(self):
+        pass
+
+
+class SQLiteTier(object):
+    """
+    Tier persisting the values in a SQLite store. Values of other versions are dropped when the store is opened,
+    unless version is None, which accepts the values of any version
+    """
+    name = "disk"
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.reopen()
+
+    def reopen(self):
+        """(Re)opens the store, forked processes have to as SQLite connections can't be shared by processes"""
+        self._db = sqlite3.connect(self.path, timeout=60)
+        # several processes may use the store at once, losing recent values on a crash is fine for a cache
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hgvs_cache "
+                         "(key TEXT PRIMARY KEY, version TEXT NOT NULL, value BLOB NOT NULL)")
+        if self.version is not None:
+            self._db.execute("DELETE FROM hgvs_cache WHERE version != ?", (self.version,))
+        self._db.commit()
+
+    def get(self, key):
+        row = self._db.execute("SELECT value FROM hgvs_cache WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.hits += 1
+            return bytes(row[0])
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.version is None:
+            # values looked up without a data provider are already stored
+            return
+        self._db.execute("INSERT OR REPLACE INTO hgvs_cache (key, version, value) VALUES (?, ?, ?)",
+                         (key, self.version, value))
+        self._db.commit()
+
+
+class HgvsCache(object):
+    """Cached values by key, looked up in memory first, then in the store at path if there is one"""
+    def __init__(self, path=None, version=None, maxsize=DEFAULT_MAXSIZE):
+        self.tiers = [LRUTier(maxsize)]
+        if path:
+            self.tiers.append(SQLiteTier(path, version))
+
+    def cached(self, namespace, args, compute):
+        """Returns the cached value of namespace and args, computing and caching it with compute if there is none"""
+        key = json.dumps([namespace, args], default=str)
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for upper_tier in self.tiers[:i]:
+                    upper_tier.put(key, value)
+                break
+        else:
+            value = pickle.dumps(compute(), pickle.HIGHEST_PROTOCOL)
+            for tier in self.tiers:
+                tier.put(key, value)
+        # values are kept pickled, so that callers modifying a returned value don't modify the cached one
+        return pickle.loads(value)
+
+    def reopen(self):
+        for tier in self.tiers:
+            tier.reopen()
+
+    def stats(self):
+        """Returns the number of hits and misses and the hit rate by tier"""
+        return dict((tier.name, {"hits": tier.hits, "misses": tier.misses,
+                                 "hit_rate": float(tier.hits) / (tier.hits + tier.misses) if tier.hits + tier.misses else 0.0})
+                    for tier in self.tiers)
+
+    def log_stats(self):
+        for name, stats in sorted(self.stats().items()):
+            logging.info("HGVS cache %s tier: %d hits, %d misses, hit rate %.3f",
+                         name, stats["hits"], stats["misses"], stats["hit_rate"])
+
+
+class CachingDataProvider(object):
+    """
+    hgvs data provider answering the lookups in CACHED_LOOKUPS from the cache, asking the wrapped provider only
+    for values which aren't cached. Without a wrapped provider, lookups of values which aren't cached fail with
+    HGVSDataNotAvailableError.
+    """
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+
+    def __getattr__(self, name):
+        if name in CACHED_LOOKUPS:
+            def lookup(*args, **kwargs):
+                return self.cache.cached(name, [args, sorted(kwargs.items())],
+                                         lambda: self._lookup(name, args, kwargs))
+            return lookup
+        if self.provider is None:
+            raise AttributeError("{} isn't available without a data provider".format(name))
+        return getattr(self.provider, name)
+
+    def _lookup(self, name, args, kwargs):
+        if self.provider is None:
+            raise HGVSDataNotAvailableError("{}{} isn't in the recorded HGVS cache".format(name, args))
+        return getattr(self.provider, name)(*args, **kwargs)
+
+
+def cache_version(provider):
+    """Returns the version of the values looked up with the provider: its UTA data version and the hgvs version"""
+    return "{} {}".format(provider.data_version(), hgvs.__version__)
+
+
+def caching_data_provider(provider, path=None, maxsize=DEFAULT_MAXSIZE):
+    """
+    Given a hgvs data provider, or None to use the values recorded at path only, returns a CachingDataProvider
+    caching its lookups in memory and at path if given
+    """
+    version = cache_version(provider) if provider is not None else None
+    return CachingDataProvider(provider, HgvsCache(path, version, maxsize))
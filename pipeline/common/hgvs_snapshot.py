@@ -0,0 +1,293 @@
+"""
+Local snapshot of the UTA data and sequences needed for HGVS operations on the genes of a gene config, so that
+HgvsWrapper and SeqRepoWrapper don't need UTA or remote sequences (set HGVS_SNAPSHOT_DIR to a snapshot directory).
+
+A snapshot directory holds
+- uta.json.gz: the UTA records of the transcripts aligned to the gene regions (transcript info, exons, mapping
+  options, ...), the sequences of these transcripts and their proteins and the UTA data and schema versions
+- <assembly>.ref: packed reference (see packed_reference.py) of the gene regions plus margin, for GRCh38 and GRCh37
+
+Lookups of data which isn't in the snapshot, e.g. of transcripts of other genes or of sequences outside of the gene
+regions, fail with HGVSDataNotAvailableError.
+"""
+import argparse
+import functools
+import gzip
+import json
+import logging
+import os
+
+import hgvs.dataproviders.uta
+from bioutils.assemblies import make_ac_name_map, make_name_ac_map
+from bioutils.digests import seq_md5
+from hgvs.dataproviders.interface import Interface
+from hgvs.exceptions import HGVSDataNotAvailableError
+
+from .packed_reference import PackedReference, write_packed_reference
+from .utils import ChrInterval
+
+RECORDS_FILE = 'uta.json.gz'
+
+ASSEMBLIES = ['GRCh38', 'GRCh37']
+
+# gene config columns of the gene regions by assembly
+REGION_COLUMNS = {'GRCh38': [('start_hg38', 'end_hg38'), ('start_hg38_legacy_variants', 'end_hg38_legacy_variants')],
+                  'GRCh37': [('start_hg37', 'end_hg37')]}
+
+
+# tables of the records holding rows of UTA query results, by key
+ROW_TABLES = ['alignments', 'gene_info', 'tx_for_gene', 'tx_identity_info', 'tx_mapping_options', 'tx_info',
+              'tx_exons', 'similar_transcripts']
+
+
+class Row(dict):
+    '''
+    Row of a UTA query result. As the rows of psycopg2's DictCursor returned by UTA, values can be looked up by
+    column name as well as by index and iterating a row yields its values in column order.
+    '''
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return dict.__getitem__(self, key)
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+def _rows(value):
+    if isinstance(value, list):
+        return [Row(r) for r in value]
+    return Row(value) if value is not None else None
+
+
+def _key(*args):
+    return '|'.join(args)
+
+
+def merge_regions(regions):
+    '''
+    :param regions: Iterable[ChrInterval]
+    :return: list of ChrInterval with overlapping regions merged
+    '''
+    merged = []
+    for r in sorted(regions, key=lambda r: (str(r.chr), r.start)):
+        if merged and str(merged[-1].chr) == str(r.chr) and r.start <= merged[-1].end:
+            merged[-1] = ChrInterval(merged[-1].chr, merged[-1].start, max(merged[-1].end, r.end))
+        else:
+            merged.append(r)
+    return merged
+
+
+def gene_regions(gene_config_df, assembly, margin):
+    '''
+    :return: regions (1-based start, exclusive end) of the configured genes on assembly, plus margin on both sides
+    '''
+    regions = []
+    for start_col, end_col in REGION_COLUMNS[assembly]:
+        regions.extend(ChrInterval(str(c), int(s) - margin, int(e) + 1 + margin)
+                       for c, s, e in gene_config_df[['chr', start_col, end_col]].values)
+    return merge_regions(regions)
+
+
+def _record(row):
+    return dict(row) if row is not None else None
+
+
+def _accessions(gene_config_df):
+    acs = set()
+    for _, row in gene_config_df.iterrows():
+        acs.add(row['hgvs_cdna_default_ac'])
+        acs.update(ac for ac in str(row['synonyms_ac_col']).split(';') if ac != '-')
+    return acs
+
+
+def build_records(gene_config_df, hdp, margin):
+    '''
+    Looks up the UTA records of the transcripts aligned to the gene regions of the gene config and of the
+    transcripts configured in the gene config.
+
+    :param hdp: hgvs UTA data provider
+    :return: dict of records, see SnapshotDataProvider
+    '''
+    records = {'data_version': hdp.data_version(), 'schema_version': hdp.schema_version(),
+               'regions': {}, 'alignments': {}, 'gene_info': {}, 'tx_for_gene': {}, 'tx_identity_info': {},
+               'tx_mapping_options': {}, 'tx_info': {}, 'tx_exons': {}, 'similar_transcripts': {},
+               'pro_ac': {}, 'sequences': {}, 'acs_for_protein_md5': {}}
+
+    tx_acs = _accessions(gene_config_df)
+    for assembly in ASSEMBLIES:
+        name_ac_map = make_name_ac_map(assembly)
+        for r in gene_regions(gene_config_df, assembly, margin):
+            alt_ac = name_ac_map[str(r.chr)]
+            # 0-based, as in UTA
+            records['regions'].setdefault(alt_ac, []).append([r.start - 1, r.end - 1])
+            alignments = [_record(a) for a in hdp.get_alignments_for_region(alt_ac, r.start - 1, r.end - 1)]
+            records['alignments'].setdefault(alt_ac, []).extend(alignments)
+            tx_acs.update(a['tx_ac'] for a in alignments)
+
+    for symbol in gene_config_df['symbol']:
+        records['gene_info'][symbol] = _record(hdp.get_gene_info(symbol))
+        records['tx_for_gene'][symbol] = [_record(r) for r in hdp.get_tx_for_gene(symbol)]
+        tx_acs.update(r['tx_ac'] for r in records['tx_for_gene'][symbol])
+
+    for tx_ac in sorted(tx_acs):
+        try:
+            records['tx_identity_info'][tx_ac] = _record(hdp.get_tx_identity_info(tx_ac))
+        except HGVSDataNotAvailableError:
+            logging.warning("No transcript definition for %s in UTA, leaving it out", tx_ac)
+            continue
+        options = [_record(o) for o in hdp.get_tx_mapping_options(tx_ac)]
+        records['tx_mapping_options'][tx_ac] = options
+        for o in options:
+            key = _key(tx_ac, o['alt_ac'], o['alt_aln_method'])
+            try:
+                records['tx_info'][key] = _record(hdp.get_tx_info(tx_ac, o['alt_ac'], o['alt_aln_method']))
+                records['tx_exons'][key] = [_record(e) for e in hdp.get_tx_exons(tx_ac, o['alt_ac'], o['alt_aln_method'])]
+            except HGVSDataNotAvailableError as e:
+                logging.info("Leaving out alignment of %s to %s (%s): %s", tx_ac, o['alt_ac'], o['alt_aln_method'], e)
+        records['similar_transcripts'][tx_ac] = [_record(s) for s in hdp.get_similar_transcripts(tx_ac)]
+        records['sequences'][tx_ac] = hdp.get_seq(tx_ac)
+
+        pro_ac = hdp.get_pro_ac_for_tx_ac(tx_ac)
+        records['pro_ac'][tx_ac] = pro_ac
+        if pro_ac:
+            protein_seq = hdp.get_seq(pro_ac)
+            records['sequences'][pro_ac] = protein_seq
+            records['acs_for_protein_md5'][seq_md5(protein_seq)] = hdp.get_acs_for_protein_seq(protein_seq)
+
+    return records
+
+
+def build_snapshot(gene_config_df, output_dir, hdp, margin=2000):
+    '''
+    Builds a snapshot of the genes of the gene config in output_dir
+
+    :param hdp: hgvs UTA data provider, sequences of the gene regions are fetched through it as well
+    :param margin: number of bases added on both sides of the gene regions
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+
+    records = build_records(gene_config_df, hdp, margin)
+    with gzip.open(os.path.join(output_dir, RECORDS_FILE), 'wt') as f:
+        json.dump(records, f, default=str)
+
+    for assembly in ASSEMBLIES:
+        name_ac_map = make_name_ac_map(assembly)
+        write_packed_reference(os.path.join(output_dir, assembly + '.ref'), gene_regions(gene_config_df, assembly, margin),
+                               lambda c, s, e: hdp.get_seq(name_ac_map[str(c)], s - 1, e - 1), assembly)
+
+
+class SnapshotDataProvider(Interface):
+    '''
+    hgvs data provider serving the data of a snapshot (see build_snapshot). Drop-in for the UTA data provider
+    within the gene regions of the snapshot.
+    '''
+    required_version = hgvs.dataproviders.uta.UTABase.required_version
+
+    def __init__(self, path):
+        self.url = path
+        with gzip.open(os.path.join(path, RECORDS_FILE), 'rt') as f:
+            self._records = json.load(f)
+        for table in ROW_TABLES:
+            self._records[table] = {key: _rows(value) for key, value in self._records[table].items()}
+
+        # genomic accession -> (packed reference, chromosome)
+        self._genomic_acs = {}
+        for assembly in ASSEMBLIES:
+            reference = PackedReference(os.path.join(path, assembly + '.ref'))
+            for ac, name in make_ac_name_map(assembly).items():
+                self._genomic_acs[ac] = (reference, name)
+
+        super(SnapshotDataProvider, self).__init__()
+
+    def _lookup(self, table, key):
+        try:
+            return self._records[table][key]
+        except KeyError:
+            raise HGVSDataNotAvailableError("No {} for {} in HGVS snapshot {}".format(table, key, self.url))
+
+    def data_version(self):
+        return self._records['data_version']
+
+    def schema_version(self):
+        return self._records['schema_version']
+
+    def get_seq(self, ac, start_i=None, end_i=None):
+        if ac in self._records['sequences']:
+            return self._records['sequences'][ac][start_i:end_i]
+        if ac in self._genomic_acs and start_i is not None and end_i is not None:
+            reference, chr = self._genomic_acs[ac]
+            # packed references are 1-based
+            if reference.covers(chr, start_i + 1, end_i + 1):
+                return reference.get_seq(chr, start_i + 1, end_i + 1)
+        raise HGVSDataNotAvailableError("No sequence for {} from {} to {} in HGVS snapshot {}".format(
+            ac, start_i, end_i, self.url))
+
+    def get_acs_for_protein_seq(self, seq):
+        md5 = seq_md5(seq)
+        return self._records['acs_for_protein_md5'].get(md5, ["MD5_" + md5])
+
+    def get_assembly_map(self, assembly_name):
+        return make_ac_name_map(assembly_name)
+
+    def get_gene_info(self, gene):
+        return self._lookup('gene_info', gene)
+
+    def get_pro_ac_for_tx_ac(self, tx_ac):
+        return self._lookup('pro_ac', tx_ac)
+
+    def get_similar_transcripts(self, tx_ac):
+        return self._lookup('similar_transcripts', tx_ac)
+
+    def get_tx_exons(self, tx_ac, alt_ac, alt_aln_method):
+        return self._lookup('tx_exons', _key(tx_ac, alt_ac, alt_aln_method))
+
+    def get_tx_for_gene(self, gene):
+        return self._lookup('tx_for_gene', gene)
+
+    def get_tx_for_region(self, alt_ac, alt_aln_method, start_i, end_i):
+        # only regions within the snapshot are known to have all overlapping transcripts in it
+        if not any(s <= start_i and end_i <= e for s, e in self._records['regions'].get(alt_ac, [])):
+            raise HGVSDataNotAvailableError("Region {} from {} to {} is not in HGVS snapshot {}".format(
+                alt_ac, start_i, end_i, self.url))
+        # overlap as in the alignments_for_region query of UTA
+        return [a for a in self._records['alignments'][alt_ac]
+                if a['alt_aln_method'] == alt_aln_method and a['start_i'] < end_i and start_i <= a['end_i']]
+
+    def get_tx_identity_info(self, tx_ac):
+        return self._lookup('tx_identity_info', tx_ac)
+
+    def get_tx_info(self, tx_ac, alt_ac, alt_aln_method):
+        return self._lookup('tx_info', _key(tx_ac, alt_ac, alt_aln_method))
+
+    def get_tx_mapping_options(self, tx_ac):
+        return self._lookup('tx_mapping_options', tx_ac)
+
+
+@functools.lru_cache(maxsize=None)
+def get_snapshot(path):
+    """Returns the SnapshotDataProvider of the snapshot at path, loading it once per process"""
+    return SnapshotDataProvider(path)
+
+
+def options(parser):
+    parser.add_argument("-c", "--config", required=True, help="gene config file")
+    parser.add_argument("-o", "--output", required=True, help="snapshot output directory")
+    parser.add_argument("--margin", type=int, default=2000,
+                        help="number of bases added on both sides of the gene regions")
+
+
+def main():
+    from common import config
+
+    parser = argparse.ArgumentParser(description="Builds a local snapshot of the UTA data and sequences of the genes "
+                                                 "of a gene config, see HGVS_SNAPSHOT_DIR in common/hgvs_utils.py")
+    options(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_snapshot(config.load_config(args.config), args.output, hgvs.dataproviders.uta.connect(), args.margin)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,16 +10,35 @@ import hgvs.parser
 import hgvs.validator
 from hgvs.exceptions import HGVSError
 
+from common import hgvs_cache, hgvs_snapshot
+
 
 class HgvsWrapper:
     GRCh38_Assem = 'GRCh38'
     GRCh37_Assem = 'GRCh37'
 
-    def __init__(self):
+    def __init__(self, hgvs_dp=None, cache_path=None):
+        """
+        :param hgvs_dp: hgvs data provider, by default the snapshot at HGVS_SNAPSHOT_DIR if set (see
+        common/hgvs_snapshot.py), otherwise a connection to the UTA instance configured for hgvs (UTA_DB_URL).
+        Its lookups and the conversions of the wrapper are cached, see common/hgvs_cache.py
+        :param cache_path: path of the SQLite store of the cache, by default HGVS_CACHE_PATH. Without
+        one, values are only cached in memory
+        """
         logging.info("HGVS_SEQREPO_DIR: {}".format(os.environ.get('HGVS_SEQREPO_DIR', "Not set. Using public instance")))
 
-        self.hgvs_dp = hgvs.dataproviders.uta.connect()
-        logging.info("Using UTA instance at {}".format(self.hgvs_dp.url))
+        if hgvs_dp is None and os.environ.get('HGVS_SNAPSHOT_DIR'):
+            hgvs_dp = hgvs_snapshot.get_snapshot(os.environ['HGVS_SNAPSHOT_DIR'])
+            logging.info("Using HGVS snapshot at {}".format(hgvs_dp.url))
+        if hgvs_dp is None:
+            hgvs_dp = hgvs.dataproviders.uta.connect()
+            logging.info("Using UTA instance at {}".format(hgvs_dp.url))
+        if not isinstance(hgvs_dp, hgvs_cache.CachingDataProvider):
+            cache_path = cache_path or os.environ.get('HGVS_CACHE_PATH')
+            logging.info("HGVS_CACHE_PATH: {}".format(cache_path or "Not set. Caching in memory only"))
+            hgvs_dp = hgvs_cache.caching_data_provider(hgvs_dp, cache_path)
+        self.hgvs_dp = hgvs_dp
+        self.cache = hgvs_dp.cache
 
         self.hgvs_parser = hgvs.parser.Parser()
         self.hgvs_norm = hgvs.normalizer.Normalizer(self.hgvs_dp)
@@ -39,6 +58,10 @@ class HgvsWrapper:
             self.contig_maps[a] = m
 
     def genomic_to_cdna(self, hgvs_obj, assembly=GRCh38_Assem):
+        return self.cache.cached("genomic_to_cdna", [str(hgvs_obj), assembly],
+                                 lambda: self._genomic_to_cdna(hgvs_obj, assembly))
+
+    def _genomic_to_cdna(self, hgvs_obj, assembly):
         am = self.hgvs_ams[assembly]
 
         try:
@@ -56,6 +79,9 @@ class HgvsWrapper:
         if not hgvs_cdna:
             return None
 
+        return self.cache.cached("cdna_to_protein", [str(hgvs_cdna)], lambda: self._cdna_to_protein(hgvs_cdna))
+
+    def _cdna_to_protein(self, hgvs_cdna):
         try:
             return str(self.hgvs_ams[HgvsWrapper.GRCh38_Assem].c_to_p(
                 hgvs_cdna))
@@ -68,11 +94,15 @@ class HgvsWrapper:
 
     def normalizing(self, v):
         if v:
-            try:
-                return self.hgvs_norm.normalize(v)
-            except (hgvs.exceptions.HGVSError, IndexError) as e:
-                logging.info(
-                    "Issues with normalizing " + str(v) + ": " + str(e))
+            return self.cache.cached("normalizing", [str(v)], lambda: self._normalizing(v))
+        return None
+
+    def _normalizing(self, v):
+        try:
+            return self.hgvs_norm.normalize(v)
+        except (hgvs.exceptions.HGVSError, IndexError) as e:
+            logging.info(
+                "Issues with normalizing " + str(v) + ": " + str(e))
         return None
 
     __instance = None
@@ -83,6 +113,9 @@ class HgvsWrapper:
         :param v:
         :return:
         """
+        return self.cache.cached("hg19_to_hg38", [str(v)], lambda: self._hg19_to_hg38(v))
+
+    def _hg19_to_hg38(self, v):
         am37 = self.hgvs_ams[self.GRCh37_Assem]
 
         transcripts = [t for t in am37.relevant_transcripts(v) if t.startswith('NM_')]
@@ -122,6 +155,18 @@ class HgvsWrapper:
     def nm_to_genomic(self, v, target_assembly=GRCh38_Assem):
         return self.hgvs_ams[target_assembly].c_to_g(v)
 
+    def reconnect(self):
+        """
+        Connects the data provider to UTA and reopens the cache store again, which forked processes have to do
+        before using them, as connections can't be shared by processes. The UTA connection of the parent process is
+        kept referenced, as closing it would close it for the parent as well.
+        """
+        uta = self.hgvs_dp.provider
+        if isinstance(uta, hgvs.dataproviders.uta.UTABase):
+            self._parent_connections = (getattr(uta, '_conn', None), getattr(uta, '_pool', None))
+            uta._connect()
+        self.cache.reopen()
+
     @staticmethod
     def get_instance():
         if not HgvsWrapper.__instance:
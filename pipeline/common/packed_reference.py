@@ -0,0 +1,279 @@
+"""
+Packed, memory mapped store of reference sequences of genomic regions.
+
+The regions of interest (e.g. the configured gene regions plus some margin) are
+compiled once into a single file, storing 4 bases per byte. The file is memory
+mapped read-only, hence it is shared between all processes reading it through
+the OS page cache and sequences are only decoded when sliced.
+
+File layout:
+  MAGIC | header length (8 bytes, unsigned little endian) | JSON header | packed bases
+
+The JSON header holds the assembly of the sequences (e.g. GRCh38) and a list of
+regions with chromosome (as string, without 'chr' prefix), start and end (1-based, end exclusive, as in SeqRepoWrapper.get_seq),
+byte offset of the packed bases of the region and runs of bases which are not
+one of ACGT as [offset within region, length, base]. Bases are encoded as
+A=0, C=1, G=2, T=3, the first base of a byte in the highest bits. Other bases
+are stored as A and restored from the runs.
+
+calc_priors in the splicing pipeline reads this format as well, see
+splicing/calc_priors/packed_reference.py.
+"""
+import argparse
+import bisect
+import json
+import mmap
+import struct
+from typing import Callable, Iterable, List
+
+import numpy as np
+
+from .utils import ChrInterval
+
+MAGIC = b'BXPKREF1'
+HEADER_LENGTH_FORMAT = '<Q'
+
+BASES = 'ACGT'
+_BASE_CODES = np.full(256, 0, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+    _BASE_CODES[ord(_base)] = _code
+    _BASE_CODES[ord(_base.lower())] = _code
+_CODE_BASES = np.frombuffer(BASES.encode('ascii'), dtype=np.uint8)
+
+_COMPLEMENT = str.maketrans('ACGTRYKMBDHVN', 'TGCAYRMKVHDBN')
+
+
+def pack_sequence(seq: str):
+    '''
+    Packs a sequence into 4 bases per byte.
+
+    :param seq: sequence
+    :return: tuple of packed bytes and list of runs of non ACGT bases as [offset, length, base]
+    '''
+    raw = np.frombuffer(seq.upper().encode('ascii'), dtype=np.uint8)
+    codes = _BASE_CODES[raw]
+
+    runs = []
+    for i in np.flatnonzero(~np.isin(raw, _CODE_BASES)):
+        base = chr(raw[i])
+        if runs and runs[-1][0] + runs[-1][1] == i and runs[-1][2] == base:
+            runs[-1][1] += 1
+        else:
+            runs.append([int(i), 1, base])
+
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return packed.astype(np.uint8).tobytes(), runs
+
+
+def same_assembly(assembly, other) -> bool:
+    '''Whether two assembly names (e.g. GRCh38 and GRCh38.p11) refer to the same assembly, regardless of the patch'''
+    return assembly is not None and other is not None and assembly.split('.')[0] == other.split('.')[0]
+
+
+def write_packed_reference(path: str, regions: Iterable[ChrInterval], fetch_seq: Callable[[int, int, int], str],
+                           assembly: str) -> None:
+    '''
+    Compiles the sequences of regions into a packed reference file.
+
+    :param path: output file path
+    :param regions: regions with 1-based start and exclusive end
+    :param fetch_seq: function fetching the sequence of chromosome, start and end, e.g. SeqRepoWrapper.get_seq
+    :param assembly: name of the assembly the sequences are fetched from, e.g. GRCh38
+    '''
+    header_regions = []
+    chunks = []
+    offset = 0
+    for r in sorted(regions):
+        packed, runs = pack_sequence(fetch_seq(r.chr, r.start, r.end))
+        header_regions.append({'chr': str(r.chr), 'start': int(r.start), 'end': int(r.end),
+                               'offset': offset, 'runs': runs})
+        chunks.append(packed)
+        offset += len(packed)
+
+    header = json.dumps({'assembly': assembly, 'regions': header_regions}).encode('ascii')
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)))
+        f.write(header)
+        for packed in chunks:
+            f.write(packed)
+
+
+class PackedSequence:
+    '''
+    View on a packed sequence. Slicing and taking the reverse complement return
+    new views in constant time, the bases are only decoded by str().
+    '''
+
+    def __init__(self, packed, runs, run_starts, start, length, reverse=False):
+        '''
+        :param packed: numpy uint8 array of the packed bases of a region
+        :param runs: runs of non ACGT bases of the region
+        :param run_starts: offsets of the runs
+        :param start: offset of the view within the region
+        :param length: length of the view
+        :param reverse: whether the view is the reverse complement
+        '''
+        self._packed = packed
+        self._runs = runs
+        self._run_starts = run_starts
+        self._start = start
+        self._length = length
+        self._reverse = reverse
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError("slicing with steps is not supported")
+            length = max(0, stop - start)
+            if self._reverse:
+                start = self._length - start - length
+            return PackedSequence(self._packed, self._runs, self._run_starts, self._start + start, length,
+                                  self._reverse)
+
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("sequence index out of range")
+        return str(self[key:key + 1])
+
+    def reverse_complement(self):
+        return PackedSequence(self._packed, self._runs, self._run_starts, self._start, self._length,
+                              not self._reverse)
+
+    def __str__(self):
+        if self._length == 0:
+            return ''
+        end = self._start + self._length
+        first_byte, last_byte = self._start // 4, (end - 1) // 4 + 1
+        packed = self._packed[first_byte:last_byte]
+        codes = np.stack([packed >> 6, (packed >> 4) & 3, (packed >> 2) & 3, packed & 3], axis=1).ravel()
+        bases = _CODE_BASES[codes[self._start - first_byte * 4:end - first_byte * 4]]
+
+        # restore bases not being one of ACGT
+        i = max(0, bisect.bisect_right(self._run_starts, self._start) - 1)
+        while i < len(self._runs) and self._runs[i][0] < end:
+            run_start, run_length, base = self._runs[i]
+            s, e = max(run_start, self._start), min(run_start + run_length, end)
+            if s < e:
+                bases[s - self._start:e - self._start] = ord(base)
+            i += 1
+
+        seq = bases.tobytes().decode('ascii')
+        if self._reverse:
+            seq = seq.translate(_COMPLEMENT)[::-1]
+        return seq
+
+    def __repr__(self):
+        return "PackedSequence(start={}, length={}, reverse={})".format(self._start, self._length, self._reverse)
+
+
+class PackedReference:
+    '''
+    Read-only access to a packed reference file, see write_packed_reference.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a packed reference file".format(path))
+        header_start = len(MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT)
+        (header_length,) = struct.unpack(HEADER_LENGTH_FORMAT, self._mmap[len(MAGIC):header_start])
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode('ascii'))
+        data_start = header_start + header_length
+        # files written before the assembly was recorded have none
+        self.assembly = header.get('assembly')
+
+        # chromosome -> sorted list of (start, end, packed bases, runs, run offsets)
+        self._regions = {}
+        for r in header['regions']:
+            n_bytes = -(-(r['end'] - r['start']) // 4)
+            packed = np.frombuffer(self._mmap, dtype=np.uint8, count=n_bytes, offset=data_start + r['offset'])
+            self._regions.setdefault(r['chr'], []).append((r['start'], r['end'], packed, r['runs'],
+                                                           [run[0] for run in r['runs']]))
+        for chr_regions in self._regions.values():
+            chr_regions.sort(key=lambda t: t[0])
+        self._region_starts = {c: [t[0] for t in regs] for c, regs in self._regions.items()}
+
+    @property
+    def regions(self) -> List[ChrInterval]:
+        return [ChrInterval(int(c) if c.isdigit() else c, start, end)
+                for c, regs in self._regions.items() for (start, end, _, _, _) in regs]
+
+    def _find_region(self, chr, start: int, end: int):
+        c = str(chr)
+        if c.startswith('chr'):
+            c = c[3:]
+        if c not in self._regions:
+            return None
+        i = bisect.bisect_right(self._region_starts[c], start) - 1
+        if i < 0:
+            return None
+        region = self._regions[c][i]
+        if end > region[1]:
+            return None
+        return region
+
+    def covers(self, chr, start: int, end: int) -> bool:
+        return self._find_region(chr, start, end) is not None
+
+    def view(self, chr, start: int, end: int) -> PackedSequence:
+        '''
+        :param chr: chromosome, e.g. 13 or 'chr13'
+        :param start: 1-based start position
+        :param end: end position, exclusive
+        :return: view on the sequence
+        '''
+        region = self._find_region(chr, start, end)
+        if region is None:
+            raise ValueError("chr {} from {} to {} is not covered by {}".format(chr, start, end, self.path))
+        region_start, _, packed, runs, run_starts = region
+        return PackedSequence(packed, runs, run_starts, start - region_start, max(0, end - start))
+
+    def get_seq(self, chr, start: int, end: int) -> str:
+        return str(self.view(chr, start, end))
+
+
+def options(parser):
+    parser.add_argument("-c", "--config", required=True, help="gene config file")
+    parser.add_argument("-o", "--output", required=True, help="packed reference output file")
+    parser.add_argument("--margin", type=int, default=2000,
+                        help="number of bases added on both sides of the gene regions")
+    parser.add_argument("--start_col", default='start_hg38_legacy_variants')
+    parser.add_argument("--end_col", default='end_hg38_legacy_variants')
+    parser.add_argument("--assembly", default=None,
+                        help="assembly of the gene region columns, derived from the columns if they are known")
+
+
+def main():
+    from common import config, hgvs_snapshot, seq_utils
+
+    parser = argparse.ArgumentParser(description="Compiles the gene regions of a gene config into a packed reference file")
+    options(parser)
+    args = parser.parse_args()
+
+    assembly = args.assembly or next((a for a, columns in hgvs_snapshot.REGION_COLUMNS.items()
+                                      if (args.start_col, args.end_col) in columns), None)
+    if not assembly:
+        parser.error("--assembly is required for the columns {} and {}".format(args.start_col, args.end_col))
+
+    gene_config_df = config.load_config(args.config)
+    gene_regions = config.extract_gene_regions_dict(gene_config_df, args.start_col, args.end_col).keys()
+    regions = [ChrInterval(int(r.chr), int(r.start) - args.margin, int(r.end) + args.margin) for r in gene_regions]
+
+    seq_wrapper = seq_utils.SeqRepoWrapper(assembly_name=assembly)
+    write_packed_reference(args.output, regions, seq_wrapper.get_seq, assembly)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ from collections import namedtuple
 from biocommons.seqrepo import SeqRepo
 from bioutils import assemblies, seqfetcher
 
+from .hgvs_snapshot import get_snapshot
+from .packed_reference import PackedReference, same_assembly
 from .utils import build_interval_trees_by_chr, ChrInterval
 
 SeqWithStart = namedtuple("SeqWithStart", "sequence, start")
@@ -15,7 +17,9 @@ class SeqRepoWrapper:
     Wrap access to biocommons seqrepo.
 
     Has a mechanism to preload certain genomic regions. Queries falling into these
-    regions are then served from memory.
+    regions are then served from memory. Optionally, sequences are served from a
+    packed reference file (see packed_reference) instead, which is memory mapped
+    and shared among processes. Preloaded regions then don't need to be copied into memory.
 
     '''
 
@@ -24,20 +28,30 @@ class SeqRepoWrapper:
 
     DEFAULT_ASSY_NAME = ASSEMBLY_NAME_hg38
 
-    def __init__(self, seq_repo_path=None, regions_preload=None, preload_pos_margin=500, assembly_name=None):
+    def __init__(self, seq_repo_path=None, regions_preload=None, preload_pos_margin=500, assembly_name=None,
+                 packed_reference_path=None, snapshot_path=None):
         '''
         :param seq_repo_path: Path to local seqrepo directory. If None, read HGVS_SEQREPO_DIR environment variable
         :param regions_preload: Iterable[ChrInterval], optionally preload these genomic regions
         :param preload_pos_margin: adding margin at the end of a preloaded genome
           in order to have data to verify structural variants across the end of a gene
+        :param packed_reference_path: optional path to a packed reference file of the assembly. Sequences
+          covered by it are served from there rather than from seqrepo
+        :param snapshot_path: Path to a HGVS snapshot directory (see hgvs_snapshot) serving the sequences of
+          the gene regions if there is no local seqrepo. If None, read HGVS_SNAPSHOT_DIR environment variable
         '''
 
         if not seq_repo_path:
             seq_repo_path = os.environ.get("HGVS_SEQREPO_DIR")
+        if not snapshot_path:
+            snapshot_path = os.environ.get("HGVS_SNAPSHOT_DIR")
 
+        self.seq_repo_path = seq_repo_path
         if seq_repo_path:
             seq_repo = SeqRepo(seq_repo_path)
             self.seq_repo_fetcher = seq_repo.fetch
+        elif snapshot_path:
+            self.seq_repo_fetcher = get_snapshot(snapshot_path).get_seq
         else:
             logging.warning("Using remote sequence provider.")
             self.seq_repo_fetcher = seqfetcher.fetch_seq
@@ -47,10 +61,27 @@ class SeqRepoWrapper:
             self.assembly_name = self.DEFAULT_ASSY_NAME
         self.assy_map = assemblies.make_name_ac_map(self.assembly_name)
 
+        self.packed_reference = None
+        if packed_reference_path:
+            self.packed_reference = PackedReference(packed_reference_path)
+            if not same_assembly(self.packed_reference.assembly, self.assembly_name):
+                raise ValueError("{} holds sequences of assembly {}, not of {}".format(
+                    packed_reference_path, self.packed_reference.assembly, self.assembly_name))
+
         self.preloaded_regions = {}
         if regions_preload:
             self.preloaded_regions = build_interval_trees_by_chr(regions_preload,
-                                                                 lambda c, s, e: self._fetch_seq(c, s, e + preload_pos_margin))
+                                                                 lambda c, s, e: self._preload_seq(c, s, e + preload_pos_margin))
+
+    def reopen(self):
+        """
+        Opens the seqrepo again, which forked processes have to do before fetching sequences, as its SQLite
+        connection can't be shared by processes. The seqrepo of the parent process is kept referenced, as closing
+        it would close the connection for the parent as well. Preloaded regions and packed references are shared.
+        """
+        if self.seq_repo_path:
+            self._parent_seq_repo_fetcher = self.seq_repo_fetcher
+            self.seq_repo_fetcher = SeqRepo(self.seq_repo_path).fetch
 
     def get_seq_at(self, chr, pos, length):
         return self.get_seq(chr, pos, pos + length)
@@ -60,7 +91,7 @@ class SeqRepoWrapper:
 
         if preloaded:
             first_pos, _, seq = preloaded[0]
-            return seq[start_pos - first_pos: end_pos - first_pos]
+            return str(seq[start_pos - first_pos: end_pos - first_pos])
         else:
             return self._fetch_seq(chr, start_pos, end_pos)
 
@@ -71,7 +102,16 @@ class SeqRepoWrapper:
 
         return preloaded
 
+    def _preload_seq(self, chr, start_pos, end_pos):
+        # a view on the packed reference is only decoded when sliced
+        if self.packed_reference and self.packed_reference.covers(chr, start_pos, end_pos):
+            return self.packed_reference.view(chr, start_pos, end_pos)
+        return self._fetch_seq(chr, start_pos, end_pos)
+
     def _fetch_seq(self, chr, start_pos, end_pos):
+        if self.packed_reference and self.packed_reference.covers(chr, start_pos, end_pos):
+            return self.packed_reference.get_seq(chr, start_pos, end_pos)
+
         accession = self.assy_map[str(chr)]
 
         # SeqRepo used 0-based coordinates
@@ -101,6 +141,9 @@ class WholeSeqSeqProvider:
 
         self.seq_wrapper = seq_wrapper
 
+        # sequences decoded from views on a packed reference, by chr and start
+        self._decoded_seqs = {}
+
     def get_seq_with_start(self, chr, pos):
         preloaded = self.seq_wrapper.get_preloaded_seq_at(chr, pos)
 
@@ -108,6 +151,10 @@ class WholeSeqSeqProvider:
             raise ValueError("Expected to have a sequence preloaded at chr {} pos {}".format(chr, pos))
 
         first_pos, _, seq = preloaded[0]
+        if not isinstance(seq, str):
+            if (chr, first_pos) not in self._decoded_seqs:
+                self._decoded_seqs[(chr, first_pos)] = str(seq)
+            seq = self._decoded_seqs[(chr, first_pos)]
         return SeqWithStart(seq, first_pos)
 
 
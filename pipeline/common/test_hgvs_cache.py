@@ -0,0 +1,119 @@
+import os
+
+import pytest
+from hgvs.exceptions import HGVSDataNotAvailableError
+
+from common import hgvs_cache
+
+
+class CountingProvider(object):
+    """Stand-in for a UTA data provider counting its lookups"""
+    def __init__(self, data_version="uta_20180821"):
+        self._data_version = data_version
+        self.calls = []
+
+    def data_version(self):
+        return self._data_version
+
+    def get_tx_info(self, tx_ac, alt_ac, alt_aln_method):
+        self.calls.append(("get_tx_info", tx_ac))
+        return {"tx_ac": tx_ac, "alt_ac": alt_ac, "alt_aln_method": alt_aln_method}
+
+    def get_tx_exons(self, tx_ac, alt_ac, alt_aln_method):
+        self.calls.append(("get_tx_exons", tx_ac))
+        return [{"tx_start_i": 0, "tx_end_i": 100}]
+
+    def url(self):
+        return "postgresql://uta"
+
+
+def test_lookups_are_memoized():
+    provider = CountingProvider()
+    dp = hgvs_cache.caching_data_provider(provider)
+
+    for _ in range(3):
+        assert dp.get_tx_info("NM_007294.3", "NC_000017.11", "splign") == \
+            {"tx_ac": "NM_007294.3", "alt_ac": "NC_000017.11", "alt_aln_method": "splign"}
+    dp.get_tx_info("NM_000059.3", "NC_000013.11", "splign")
+
+    assert provider.calls == [("get_tx_info", "NM_007294.3"), ("get_tx_info", "NM_000059.3")]
+    assert dp.cache.stats()["memory"] == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+    # lookups which aren't cached are forwarded
+    assert dp.url() == "postgresql://uta"
+
+
+def test_returned_values_are_copies():
+    dp = hgvs_cache.caching_data_provider(CountingProvider())
+
+    dp.get_tx_exons("NM_007294.3", "NC_000017.11", "splign")[0]["tx_end_i"] = 0
+
+    assert dp.get_tx_exons("NM_007294.3", "NC_000017.11", "splign") == [{"tx_start_i": 0, "tx_end_i": 100}]
+
+
+def test_lru_tier_is_bounded():
+    provider = CountingProvider()
+    dp = hgvs_cache.caching_data_provider(provider, maxsize=2)
+
+    for tx_ac in ["NM_1", "NM_2", "NM_1", "NM_3", "NM_1", "NM_2"]:
+        dp.get_tx_info(tx_ac, "NC_1", "splign")
+
+    assert len(dp.cache.tiers[0].entries) == 2
+    # NM_2 was the least recently used when NM_3 was added
+    assert provider.calls == [("get_tx_info", tx_ac) for tx_ac in ["NM_1", "NM_2", "NM_3", "NM_2"]]
+
+
+def test_store_is_shared_by_stages(tmpdir):
+    path = str(tmpdir.join("hgvs_cache.sqlite"))
+    hgvs_cache.caching_data_provider(CountingProvider(), path).get_tx_info("NM_007294.3", "NC_000017.11", "splign")
+
+    provider = CountingProvider()
+    dp = hgvs_cache.caching_data_provider(provider, path)
+    dp.get_tx_info("NM_007294.3", "NC_000017.11", "splign")
+
+    assert provider.calls == []
+    assert dp.cache.stats()["disk"]["hits"] == 1
+
+
+def test_store_drops_values_of_other_versions(tmpdir):
+    path = str(tmpdir.join("hgvs_cache.sqlite"))
+    hgvs_cache.caching_data_provider(CountingProvider("uta_20170117"), path).get_tx_info("NM_007294.3", "NC_000017.11", "splign")
+
+    provider = CountingProvider("uta_20180821")
+    hgvs_cache.caching_data_provider(provider, path).get_tx_info("NM_007294.3", "NC_000017.11", "splign")
+
+    assert provider.calls == [("get_tx_info", "NM_007294.3")]
+
+
+def test_recorded_store_stands_in_for_provider(tmpdir):
+    path = str(tmpdir.join("hgvs_cache.sqlite"))
+    recording = hgvs_cache.caching_data_provider(CountingProvider(), path)
+    recording.get_tx_info("NM_007294.3", "NC_000017.11", "splign")
+    recording.data_version()
+
+    dp = hgvs_cache.caching_data_provider(None, path)
+
+    assert dp.data_version() == "uta_20180821"
+    assert dp.get_tx_info("NM_007294.3", "NC_000017.11", "splign")["tx_ac"] == "NM_007294.3"
+    with pytest.raises(HGVSDataNotAvailableError):
+        dp.get_tx_info("NM_000059.3", "NC_000013.11", "splign")
+    with pytest.raises(AttributeError):
+        dp.url()
+
+
+def test_conversions_are_cached(tmpdir):
+    cache = hgvs_cache.HgvsCache(str(tmpdir.join("hgvs_cache.sqlite")), "uta_20180821")
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return None
+
+    assert cache.cached("normalizing", ["NC_000013.11:g.32316482_32316483del"], compute) is None
+    assert cache.cached("normalizing", ["NC_000013.11:g.32316482_32316483del"], compute) is None
+    cache.reopen()
+    cache.tiers[0].entries.clear()
+    assert cache.cached("normalizing", ["NC_000013.11:g.32316482_32316483del"], compute) is None
+
+    # results which are None (failed conversions) are cached as well
+    assert computed == [1]
+    assert os.path.exists(str(tmpdir.join("hgvs_cache.sqlite")))
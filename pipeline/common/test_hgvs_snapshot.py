@@ -0,0 +1,144 @@
+import os
+import random
+
+import pytest
+import hgvs.parser
+from hgvs.exceptions import HGVSDataNotAvailableError
+
+from common import config, hgvs_snapshot
+from common.hgvs_utils import HgvsWrapper
+from common.seq_utils import SeqRepoWrapper
+
+pwd = os.path.dirname(os.path.realpath(__file__))
+gene_config_path = os.path.join(pwd, '..', 'data_merging', 'test_files', 'gene_config_test.txt')
+
+TX_AC = 'NM_999999.1'
+ALT_AC = 'NC_000013.11'
+# 0-based, end exclusive
+TX_START, TX_END = 32316000, 32316300
+
+
+class UTAStandIn(object):
+    """Serves a single synthetic transcript on BRCA2 like UTA, with a random genome repeating every 9973 bases"""
+    def __init__(self):
+        rng = random.Random(42)
+        self.block = ''.join(rng.choice('ACGT') for _ in range(9973))
+
+    def data_version(self):
+        return 'uta_test'
+
+    def schema_version(self):
+        return '1.1'
+
+    def get_seq(self, ac, start_i=None, end_i=None):
+        if ac == TX_AC:
+            return self.get_seq(ALT_AC, TX_START, TX_END)[start_i:end_i]
+        offset = start_i % len(self.block)
+        repeats = (offset + end_i - start_i) // len(self.block) + 1
+        return (self.block * repeats)[offset:offset + end_i - start_i]
+
+    def get_alignments_for_region(self, alt_ac, start_i, end_i, alt_aln_method=None):
+        if alt_ac == ALT_AC and start_i < TX_END and TX_START <= end_i:
+            return [{'tx_ac': TX_AC, 'alt_ac': ALT_AC, 'alt_strand': 1, 'alt_aln_method': 'splign',
+                     'start_i': TX_START, 'end_i': TX_END}]
+        return []
+
+    def get_gene_info(self, gene):
+        return {'hgnc': gene}
+
+    def get_tx_for_gene(self, gene):
+        if gene != 'BRCA2':
+            return []
+        return [{'hgnc': 'BRCA2', 'cds_start_i': 10, 'cds_end_i': 100, 'tx_ac': TX_AC, 'alt_ac': ALT_AC,
+                 'alt_aln_method': 'splign'}]
+
+    def get_tx_identity_info(self, tx_ac):
+        if tx_ac != TX_AC:
+            raise HGVSDataNotAvailableError(tx_ac)
+        return {'tx_ac': TX_AC, 'alt_ac': TX_AC, 'alt_aln_method': 'transcript', 'cds_start_i': 10,
+                'cds_end_i': 100, 'lengths': [TX_END - TX_START], 'hgnc': 'BRCA2'}
+
+    def get_tx_mapping_options(self, tx_ac):
+        return [{'tx_ac': TX_AC, 'alt_ac': ALT_AC, 'alt_aln_method': 'splign'}]
+
+    def get_tx_info(self, tx_ac, alt_ac, alt_aln_method):
+        return {'hgnc': 'BRCA2', 'cds_start_i': 10, 'cds_end_i': 100, 'tx_ac': TX_AC, 'alt_ac': ALT_AC,
+                'alt_aln_method': 'splign'}
+
+    def get_tx_exons(self, tx_ac, alt_ac, alt_aln_method):
+        return [{'tx_ac': TX_AC, 'alt_ac': ALT_AC, 'alt_strand': 1, 'alt_aln_method': 'splign', 'ord': 0,
+                 'tx_start_i': 0, 'tx_end_i': TX_END - TX_START, 'alt_start_i': TX_START, 'alt_end_i': TX_END,
+                 'cigar': '{}='.format(TX_END - TX_START)}]
+
+    def get_similar_transcripts(self, tx_ac):
+        return []
+
+    def get_pro_ac_for_tx_ac(self, tx_ac):
+        return None
+
+
+@pytest.fixture(scope="module")
+def uta():
+    return UTAStandIn()
+
+
+@pytest.fixture(scope="module")
+def snapshot_dir(tmpdir_factory, uta):
+    path = str(tmpdir_factory.mktemp("hgvs_snapshot"))
+    hgvs_snapshot.build_snapshot(config.load_config(gene_config_path), path, uta, margin=100)
+    return path
+
+
+def test_merge_regions():
+    merged = hgvs_snapshot.merge_regions([hgvs_snapshot.ChrInterval('13', 200, 300),
+                                          hgvs_snapshot.ChrInterval('13', 100, 250),
+                                          hgvs_snapshot.ChrInterval('17', 100, 150)])
+    assert merged == [('13', 100, 300), ('17', 100, 150)]
+
+
+def test_lookups(snapshot_dir, uta):
+    dp = hgvs_snapshot.SnapshotDataProvider(snapshot_dir)
+
+    assert dp.data_version() == 'uta_test'
+    assert dp.get_tx_info(TX_AC, ALT_AC, 'splign') == uta.get_tx_info(TX_AC, ALT_AC, 'splign')
+    assert dp.get_tx_exons(TX_AC, ALT_AC, 'splign') == uta.get_tx_exons(TX_AC, ALT_AC, 'splign')
+    assert dp.get_seq(TX_AC, 5, 20) == uta.get_seq(TX_AC, 5, 20)
+    assert dp.get_seq(ALT_AC, 32315000, 32315100) == uta.get_seq(ALT_AC, 32315000, 32315100)
+    assert dp.get_pro_ac_for_tx_ac(TX_AC) is None
+
+    # rows can be unpacked as the rows returned by UTA
+    [(hgnc, _, _, tx_ac, alt_ac, method)] = dp.get_tx_for_gene('BRCA2')
+    assert (hgnc, tx_ac, alt_ac, method) == ('BRCA2', TX_AC, ALT_AC, 'splign')
+    assert dp.get_tx_exons(TX_AC, ALT_AC, 'splign')[0][1] == ALT_AC
+
+    # transcripts which aren't in UTA are left out
+    with pytest.raises(HGVSDataNotAvailableError):
+        dp.get_tx_identity_info('NM_000059.3')
+
+
+def test_tx_for_region(snapshot_dir):
+    dp = hgvs_snapshot.SnapshotDataProvider(snapshot_dir)
+
+    assert [a['tx_ac'] for a in dp.get_tx_for_region(ALT_AC, 'splign', TX_START + 10, TX_START + 11)] == [TX_AC]
+    assert dp.get_tx_for_region(ALT_AC, 'splign', TX_END + 10, TX_END + 11) == []
+    assert dp.get_tx_for_region(ALT_AC, 'blat', TX_START + 10, TX_START + 11) == []
+
+    # outside of the gene regions, the snapshot can't tell which transcripts there are
+    with pytest.raises(HGVSDataNotAvailableError):
+        dp.get_tx_for_region(ALT_AC, 'splign', 1000, 1001)
+    with pytest.raises(HGVSDataNotAvailableError):
+        dp.get_seq(ALT_AC, 1000, 1001)
+
+
+def test_drop_in_for_wrappers(snapshot_dir, uta, monkeypatch):
+    monkeypatch.delenv('HGVS_SEQREPO_DIR', raising=False)
+    monkeypatch.setenv('HGVS_SNAPSHOT_DIR', snapshot_dir)
+
+    seq_wrapper = SeqRepoWrapper()
+    assert seq_wrapper.get_seq(13, 32315001, 32315101) == uta.get_seq(ALT_AC, 32315000, 32315100)
+
+    hgvs_wrapper = HgvsWrapper()
+    ref = uta.get_seq(ALT_AC, TX_START + 49, TX_START + 50)
+    alt = 'A' if ref != 'A' else 'C'
+    variant = hgvs.parser.Parser().parse_hgvs_variant('{}:g.{}{}>{}'.format(ALT_AC, TX_START + 50, ref, alt))
+    assert str(hgvs_wrapper.genomic_to_cdna(variant)) == '{}:c.40{}>{}'.format(TX_AC, ref, alt)
@@ -0,0 +1,83 @@
+import os
+import random
+
+import bioutils
+import pytest
+from mock import patch
+
+from common import seq_utils
+from common.config import load_config, extract_gene_regions_dict
+from common.packed_reference import PackedReference, write_packed_reference
+from common.utils import ChrInterval
+
+
+def reverse_complement(seq):
+    return seq.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1]
+
+
+def test_packed_reference(tmpdir):
+    rnd = random.Random(1)
+    seqs = {ChrInterval(13, 1001, 1001 + 1003): ''.join(rnd.choice('ACGT') for _ in range(1003)),
+            ChrInterval(17, 5, 5 + 17): 'ACGTNNNACGTTACGNA'}
+    path = str(tmpdir.join('ref.pack'))
+    write_packed_reference(path, seqs.keys(), lambda c, s, e: seqs[ChrInterval(c, s, e)], 'GRCh38')
+
+    ref = PackedReference(path)
+    assert ref.assembly == 'GRCh38'
+    assert sorted(ref.regions) == sorted(seqs.keys())
+
+    for region, seq in seqs.items():
+        for _ in range(50):
+            start = rnd.randint(region.start, region.end)
+            end = rnd.randint(start, region.end)
+            expected = seq[start - region.start:end - region.start]
+            assert ref.get_seq(region.chr, start, end) == expected
+            assert ref.get_seq('chr' + str(region.chr), start, end) == expected
+            assert str(ref.view(region.chr, start, end).reverse_complement()) == reverse_complement(expected)
+
+    view = ref.view(17, 5, 22).reverse_complement()
+    assert str(view[2:9]) == reverse_complement(seqs[ChrInterval(17, 5, 22)])[2:9]
+    assert str(view[2:9].reverse_complement()) == seqs[ChrInterval(17, 5, 22)][8:15]
+    assert view[0] == 'T'
+    assert len(view[3:]) == 14
+
+    assert ref.covers(13, 1001, 2004)
+    assert not ref.covers(13, 1000, 1010)
+    assert not ref.covers(13, 2000, 2005)
+    assert not ref.covers(2, 1, 2)
+
+
+def test_seq_repo_wrapper_packed_reference(tmpdir, fetch_seq_mock_data):
+    with patch.object(bioutils.seqfetcher, 'fetch_seq', side_effect=lambda ac, s, e: fetch_seq_mock_data[(str(ac), str(s), str(e))]):
+        cfg = load_config(os.path.join(os.path.dirname(__file__), '..', 'data_merging', 'test_files', 'gene_config_test.txt'))
+        regions = list(extract_gene_regions_dict(cfg, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants').keys())
+        seq_wrapper = seq_utils.SeqRepoWrapper(regions_preload=regions)
+
+        path = str(tmpdir.join('ref.pack'))
+        write_packed_reference(path, [ChrInterval(r.chr, r.start, r.end + 500) for r in regions], seq_wrapper.get_seq,
+                               seq_wrapper.assembly_name)
+
+    # sequences are served from the packed reference only
+    with patch.object(bioutils.seqfetcher, 'fetch_seq', side_effect=AssertionError):
+        packed_wrapper = seq_utils.SeqRepoWrapper(regions_preload=regions, packed_reference_path=path)
+
+        for c, pos, length in [(13, 32314514, 10), (13, 32339774, 30), (17, 43127860, 500)]:
+            assert packed_wrapper.get_seq_at(c, pos, length) == seq_wrapper.get_seq_at(c, pos, length)
+
+        whole_seq = seq_utils.WholeSeqSeqProvider(seq_wrapper).get_seq_with_start(17, 43090921)
+        assert seq_utils.WholeSeqSeqProvider(packed_wrapper).get_seq_with_start(17, 43090921) == whole_seq
+
+
+def test_seq_repo_wrapper_packed_reference_assembly(tmpdir):
+    path = str(tmpdir.join('ref.pack'))
+    write_packed_reference(path, [ChrInterval(13, 1, 9)], lambda c, s, e: 'ACGTACGT', 'GRCh38')
+
+    # the patch of the assembly doesn't matter
+    assert seq_utils.SeqRepoWrapper(packed_reference_path=path, assembly_name='GRCh38.p11').get_seq(13, 1, 5) == 'ACGT'
+    with pytest.raises(ValueError):
+        seq_utils.SeqRepoWrapper(packed_reference_path=path, assembly_name='GRCh37.p13')
+
+    # files of an unknown assembly aren't used either
+    write_packed_reference(path, [ChrInterval(13, 1, 9)], lambda c, s, e: 'ACGTACGT', None)
+    with pytest.raises(ValueError):
+        seq_utils.SeqRepoWrapper(packed_reference_path=path)
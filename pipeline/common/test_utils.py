@@ -16,3 +16,14 @@ def test_parallelize_dataframe():
 
     pd.testing.assert_series_equal(utils.parallelize_dataframe(df, double_numbers)['doubled'], expected,
                                    check_names=False)
+
+
+def test_external_sort():
+    assert list(utils.external_sort([])) == []
+
+    items = [(i % 7, i) for i in range(100)]
+    expected = sorted(items, key=lambda t: t[0])
+
+    # single chunk as well as multiple chunks spilled to disk
+    assert list(utils.external_sort(items, key=lambda t: t[0])) == expected
+    assert list(utils.external_sort(items, key=lambda t: t[0], chunk_size=9)) == expected
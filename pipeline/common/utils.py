@@ -1,8 +1,12 @@
+import heapq
 import importlib
+import itertools
 import logging
+import pickle
+import tempfile
 from collections import namedtuple
 from pathlib import Path
-from typing import List, Callable, Sequence, TypeVar, Union
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, TypeVar, Union
 
 import numpy as np
 import pandas as pd
@@ -55,6 +59,53 @@ def split_list_in_chunks(seq: Sequence[T], chunk_size: int) -> List[List[T]]:
     return [seq[pos:pos + chunk_size] for pos in range(0, len(seq), chunk_size)]
 
 
+def external_sort(items: Iterable[T], key: Optional[Callable[[T], Any]] = None, chunk_size: int = 100000,
+                  tmp_dir: Optional[str] = None) -> Iterator[T]:
+    '''
+    Sorts items which do not necessarily fit into memory.
+
+    Items are sorted in chunks of chunk_size, each chunk is spilled to a
+    temporary file and the chunks are lazily merged back together. The sort is
+    stable and at most chunk_size items are held in memory at a time.
+
+    :param items: items to sort, need to be picklable
+    :param key: sort key function as for `sorted`
+    :param chunk_size: maximal number of items sorted in memory
+    :param tmp_dir: directory for temporary files, system default if None
+    :return: iterator over the sorted items
+    '''
+    it = iter(items)
+    runs = []
+
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            break
+
+        chunk.sort(key=key)
+
+        if not runs and len(chunk) < chunk_size:
+            # everything fits into a single chunk, no need to go through disk
+            return iter(chunk)
+
+        run = tempfile.TemporaryFile(dir=tmp_dir)
+        for item in chunk:
+            pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        runs.append(run)
+
+    return heapq.merge(*[_read_sorted_run(r) for r in runs], key=key)
+
+
+def _read_sorted_run(run):
+    with run:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+
 def parallelize_dataframe(df: pd.DataFrame, func: Callable[[pd.DataFrame], pd.DataFrame], n_processes: int = 4):
     if df.empty:
         return df
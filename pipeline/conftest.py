@@ -7,6 +7,10 @@ When new tests are added, GENERATE_MOCK_DATA can be set to True, s.t. the webser
 is called and the result of this call (a sequence) added to a file in the 'data' directory.
 After this happened, the GENERATE_MOCK_DATA can be set to False and the call to that
 webservice is mocked using the data from the file just generated.
+
+The same holds for the lookups in UTA of the hgvs_wrapper fixture: with GENERATE_MOCK_DATA set to
+True they are recorded in the HGVS cache store data/hgvs_cache.sqlite, which then stands in for UTA
+(see common/hgvs_cache.py). Without a recorded store, UTA is used.
 """
 import glob
 import os
@@ -16,12 +20,13 @@ import pytest
 from bioutils import seqfetcher
 from mock import patch
 
-from common import seq_utils
+from common import hgvs_cache, seq_utils
 from common.hgvs_utils import HgvsWrapper
 
 
 pwd = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(pwd, 'data')
+hgvs_cache_path = os.path.join(data_dir, 'hgvs_cache.sqlite')
 
 
 @pytest.fixture(scope="session")
@@ -56,11 +61,13 @@ def hgvs_wrapper(fetch_seq_mock_data):
     if not GENERATE_MOCK_DATA:
         with patch.object(bioutils.seqfetcher, 'fetch_seq',
                               side_effect=lambda ac, s, e: fetch_seq_mock_data[(str(ac), str(s), str(e))]):
+            if os.path.exists(hgvs_cache_path):
+                return HgvsWrapper(hgvs_dp=hgvs_cache.caching_data_provider(None, hgvs_cache_path))
             return HgvsWrapper()
     else:
         with patch.object(bioutils.seqfetcher, 'fetch_seq',
                               side_effect=lambda ac, s, e: generate_mock_data(ac, s, e)):
-            return HgvsWrapper()
+            return HgvsWrapper(cache_path=hgvs_cache_path)
 
 
 @pytest.fixture(scope="module")
@@ -19,24 +19,20 @@ def write_reports_tsv(filename, columns, ready_files_dir, genome_regions_symbol_
 
     reports_files = [ready_files_dir + r for r in get_reports_files(ready_files_dir)]
 
-    reports = aggregate_reports(reports_files, columns, genome_regions_symbol_dict)
-
     reports_output.write("\t".join(columns)+"\n")
 
-    for report in reports:
-        if len(report) != len(columns):
-            raise Exception("mismatching number of columns in head and row")
-        for ii in range(len(report)):
-            if type(report[ii]) == list:
-                comma_delimited_string = ",".join(str(xx) for xx in report[ii])
-                report[ii] = comma_delimited_string
-            elif type(report[ii]) == int:
-                report[ii] = str(report[ii])
-        reports_output.write("\t".join(report)+"\n")
+    # writing reports file by file rather than aggregating them first keeps
+    # only the reports of a single file in memory
+    n_reports = 0
+    for file in reports_files:
+        for report in normalize_reports(file, columns, genome_regions_symbol_dict):
+            reports_output.write(variant_merging.format_row(columns, report))
+            n_reports += 1
+        print("finished normalizing %s" % (file))
 
     reports_output.close()
 
-    print("final number of reports: %d" % len(reports))
+    print("final number of reports: %d" % n_reports)
     print("Done")
 
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+benchmarks the strategies to find equivalent variants on synthetic, indel heavy
+repeat regions: editing the whole gene sequence, editing chunks of the sequence
+and comparing canonical edits
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from common import seq_utils
+from common.utils import ChrInterval
+from data_merging import variant_equivalence
+from data_merging.variant_merging_constants import VCFVariant
+
+BASES = "ACGT"
+REPEAT_UNITS = ["A", "C", "AT", "CA", "GGC", "TTAG"]
+# no variants are placed that close to the ends of the sequence, leaving room for the chunk margins
+FLANK_LENGTH = 1000
+
+
+def options(parser):
+    parser.add_argument("--n_variants", type=int, default=20000)
+    parser.add_argument("--seq_length", type=int, default=100000)
+    parser.add_argument("--chunk_margin", type=int, default=100,
+                        help="margin used by the chunk based sequence provider")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+class SyntheticSeqWrapper:
+    """serves a synthetic sequence like a SeqRepoWrapper with a single preloaded region"""
+    def __init__(self, chr, start, sequence):
+        region = ChrInterval(chr, start, start + len(sequence))
+        self.preloaded_regions = seq_utils.build_interval_trees_by_chr([region], lambda c, s, e: sequence)
+
+    def get_seq(self, chr, start_pos, end_pos):
+        first_pos, _, seq = list(self.preloaded_regions[chr].at(start_pos))[0]
+        return seq[start_pos - first_pos: end_pos - first_pos]
+
+    def get_seq_at(self, chr, pos, length):
+        return self.get_seq(chr, pos, pos + length)
+
+    def get_preloaded_seq_at(self, chr, pos):
+        if chr not in self.preloaded_regions:
+            return []
+        return list(self.preloaded_regions[chr].at(pos))
+
+
+def generate_sequence(length, rnd):
+    """random sequence, half of which consists of tandem repeats. Returns the sequence and repeats as (offset, unit, copies)"""
+    parts = []
+    repeats = []
+    n = 0
+    while n < length:
+        random_part = "".join(rnd.choice(BASES) for _ in range(rnd.randint(5, 40)))
+        unit = rnd.choice(REPEAT_UNITS)
+        copies = rnd.randint(3, 15)
+        repeats.append((n + len(random_part), unit, copies))
+        parts.extend([random_part, unit * copies])
+        n += len(random_part) + len(unit) * copies
+    return "".join(parts)[:length], [r for r in repeats
+                                     if FLANK_LENGTH <= r[0] and r[0] + len(r[1]) * r[2] < length - FLANK_LENGTH]
+
+
+def generate_variants(n_variants, chr, start, sequence, repeats, rnd):
+    """mostly insertions and deletions of repeat units, at varying positions within a repeat"""
+    variants = dict()
+    while len(variants) < n_variants:
+        offset, unit, copies = rnd.choice(repeats)
+        pos = offset + rnd.randint(0, copies - 1) * len(unit) + rnd.randint(0, len(unit) - 1)
+        kind = rnd.random()
+        n_units = rnd.randint(1, 3)
+        if kind < 0.4:
+            # deletion, with the preceding base as anchor
+            ref = sequence[pos - 1:pos + len(unit) * n_units]
+            alt = ref[0]
+            pos -= 1
+        elif kind < 0.8:
+            # insertion, with the preceding base as anchor
+            ref = sequence[pos - 1]
+            alt = ref + sequence[pos:pos + len(unit)] * n_units
+            pos -= 1
+        else:
+            ref = sequence[pos]
+            alt = rnd.choice([b for b in BASES if b != ref])
+        v = VCFVariant(chr, start + pos, ref, alt)
+        variants["chr{}:g.{}:{}>{}".format(chr, v.pos, ref, alt)] = v
+    return variants
+
+
+def run(name, strategy):
+    """runs the strategy twice, for timing and for tracing memory allocations, as tracing slows down allocations"""
+    started = time.perf_counter()
+    result = strategy()
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    strategy()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{:<12} {:>10.2f} s {:>10.1f} MB peak {:>8d} sets".format(name, elapsed, peak / 1e6, len(result)))
+    return frozenset(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    options(parser)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    chr, start = 13, 32314513
+    sequence, repeats = generate_sequence(args.seq_length, rnd)
+    variants = generate_variants(args.n_variants, chr, start, sequence, repeats, rnd)
+    seq_wrapper = SyntheticSeqWrapper(chr, start, sequence)
+    whole_seq_provider = seq_utils.WholeSeqSeqProvider(seq_wrapper)
+
+    print("{} variants on a sequence of length {}".format(len(variants), len(sequence)))
+
+    def chunk_based():
+        chunk_provider = seq_utils.ChunkBasedSeqProvider(list(variants.values()), args.chunk_margin, seq_wrapper)
+        return variant_equivalence.find_equivalent_variant(variants, chunk_provider)
+
+    results = [
+        run("whole seq", lambda: variant_equivalence.find_equivalent_variants_whole_seq(variants, whole_seq_provider)),
+        run("chunk based", chunk_based),
+        run("canonical", lambda: variant_equivalence.find_equivalent_variants_canonical(variants, whole_seq_provider))
+    ]
+
+    if results[0] != results[2]:
+        raise Exception("canonical strategy disagrees with the whole seq strategy")
+    if results[0] != results[1]:
+        print("chunk based strategy disagrees with the whole seq strategy, consider a larger chunk margin")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
+import collections
+import contextlib
 import logging
+import multiprocessing
 import subprocess
+import sys
 import tempfile
+import time
 from typing import Dict, List, Iterable, Optional
 from os import path
 
@@ -50,6 +55,12 @@ TMP_CDNA_NORM_FIELD = 'tmp_HGVS_CDNA_FIELD_norm'
 TMP_CDNA_NORM_LEFT_ALINGED_FIELD = 'tmp_HGVS_CDNA_FIELD_left'
 TMP_PROTEIN_LEFT_ALINGED_FIELD = 'tmp_Protein_Field_left'
 
+# number of variants read and processed at a time
+DEFAULT_CHUNK_SIZE = 1000
+
+# state shared with the worker processes, set up before they are forked
+POOL_CONTEXT = dict()
+
 
 def _normalize_genomic_coordinates(hgvs_obj: Optional[SequenceVariant], strand: str, hgvs_norm_3: Normalizer, hgvs_norm_5: Normalizer):
     normalizer = hgvs_norm_3 if strand == config.POSITIVE_STRAND else hgvs_norm_5
@@ -95,17 +106,20 @@ def cdna_from_cdna_field(row: pd.Series, cdna_ac_dict: Dict[str, str], hgvs_proc
     return None
 
 
-def convert_to_hg37(vars: Iterable[VCFVariant], brca_resources_dir: str):
+def convert_to_hg37(vars: Iterable[VCFVariant], brca_resources_dir: str) -> List[Optional[VCFVariant]]:
     """Lifting over hg38 variants to hg37 using crossmap
 
     Not using hgvs library since it doesn't handle intronic variants.
+
+    :return: hg37 variants in the order of vars, None for variants which couldn't be lifted over
     """
 
-    def pseudo_vcf_entry(v):
-        entries = [v.chr, v.pos, '.', v.ref, v.alt, '', '', '']
+    # the index of a variant is passed through as VCF ID
+    def pseudo_vcf_entry(i, v):
+        entries = [v.chr, v.pos, i, v.ref, v.alt, '', '', '']
         return '\t'.join([str(s) for s in entries])
 
-    lst = [pseudo_vcf_entry(v) for v in vars]
+    lst = [pseudo_vcf_entry(i, v) for i, v in enumerate(vars)]
 
     vcf_tmp = tempfile.mktemp('.vcf')
     with open(vcf_tmp, 'w') as f:
@@ -126,25 +140,18 @@ def convert_to_hg37(vars: Iterable[VCFVariant], brca_resources_dir: str):
     if err:
         logging.info("standard output of subprocess: {}".format(err))
 
-    vcf_out_lines = open(vcf_tmp_out, 'r').readlines()
+    vars_hg37 = [None] * len(lst)
+    with open(vcf_tmp_out, 'r') as f:
+        for v in [l.strip().split('\t') for l in f]:
+            vars_hg37[int(v[2])] = VCFVariant(v[0], int(v[1]), v[3], v[4])
 
     if path.exists(vcf_tmp_out + '.unmap'):
-        vcf_out_failed_lines = open(vcf_tmp_out + '.unmap', 'r').readlines()
-        return ([VCFVariant(v[0], int(v[1]), v[3], v[4]) for v in [l.strip().split('\t') for l in vcf_out_lines]],
-                [VCFVariant(v[0], int(v[1]), v[3], v[4]) for v in [l.strip().split('\t') for l in vcf_out_failed_lines]])
-    else:
-        return ([VCFVariant(v[0], int(v[1]), v[3], v[4]) for v in [l.strip().split('\t') for l in vcf_out_lines]], [])
-
+        with open(vcf_tmp_out + '.unmap', 'r') as f:
+            for v in [l.strip().split('\t') for l in f]:
+                logging.info("Could not compute hg37 representation of internal for {}".format(
+                    VCFVariant(v[0], int(v[1]), v[3], v[4])))
 
-def handle_failed_hg37_translations(df, var_objs_hg37, var_objs_hg37_failed, tmp_hgvs_hg37_values, hgvs_proc):
-    # set None values for any hg37 coordinates that cannot be derived and add to lists in proper order
-    for v in var_objs_hg37_failed:
-        hgvs_obj = v.to_hgvs_obj(hgvs_proc.contig_maps[HgvsWrapper.GRCh38_Assem])
-        row_number = df[df[GENOMIC_HGVS_HG38_COL] == str(hgvs_obj)].index[0]
-        var_objs_hg37.insert(row_number, None)
-        tmp_hgvs_hg37_values.insert(row_number, None)
-        logging.info("Could not compute hg37 representation of internal for {}".format(str(hgvs_obj)))
-    return (var_objs_hg37, tmp_hgvs_hg37_values, df)
+    return vars_hg37
 
 
 def get_synonyms(row: pd.Series, hgvs_proc: HgvsWrapper, syn_ac_dict: Dict[str, List[str]]):
@@ -208,6 +215,152 @@ def _merge_and_clean_synonyms(row: pd.Series):
     return ','.join(list_sorted_cleaned)
 
 
+def _vcf_variants(df: pd.DataFrame) -> List[VCFVariant]:
+    return [VCFVariant(c, p, r, a) for c, p, r, a in zip(df[CHR_COL], df[POS_COL], df[REF_COL], df[ALT_COL])]
+
+
+def _float_columns(dtypes_by_chunk: Iterable[pd.Series]) -> Dict[str, type]:
+    """
+    Columns parsed as integers in some chunks and as floats (due to missing values) in others, which are read as
+    floats in all chunks, as they are when reading the input at once
+    """
+    dtypes = collections.defaultdict(set)
+    for chunk_dtypes in dtypes_by_chunk:
+        for col, dtype in chunk_dtypes.items():
+            dtypes[col].add(dtype.kind)
+    return {col: float for col, kinds in dtypes.items() if kinds == {'i', 'f'}}
+
+
+def _timed(iterable, timings: collections.Counter, phase: str):
+    """Yields the items of iterable, adding the time spent to get them to the phase in timings"""
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            timings[phase] += time.perf_counter() - start
+        yield item
+
+
+def _imap_bounded(pool, func, iterable, max_pending: int):
+    """Like pool.imap, but reading iterable only as far as needed to keep max_pending items in process"""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def init_worker():
+    POOL_CONTEXT['hgvs_proc'].reconnect()
+
+
+def process_chunk(df: pd.DataFrame):
+    """
+    Derives the representations of the variants of a chunk of the input (normalized hg38 and hg37 representations,
+    cDNA, protein and synonyms) in a single pass per variant.
+
+    :return: the chunk with the derived columns as TSV with header and the time spent per phase
+    """
+    hgvs_proc = POOL_CONTEXT['hgvs_proc']
+    norms = POOL_CONTEXT['normalizers']
+    strand_dict = POOL_CONTEXT['strand_dict']
+    cdna_default_ac_dict = POOL_CONTEXT['cdna_default_ac_dict']
+    syn_ac_dict = POOL_CONTEXT['syn_ac_dict']
+
+    timings = collections.Counter()
+
+    def timed(phase, start):
+        now = time.perf_counter()
+        timings[phase] += now - start
+        return now
+
+    var_objs = _vcf_variants(df)
+    var_objs_hg37 = [POOL_CONTEXT['vars_hg37'][i] for i in df.index]
+    synonyms_col = df[SYNONYMS_COL].fillna('').str.strip()
+
+    cols = collections.defaultdict(list)
+    for v, v37, gene, cdna_src, ref_seq, synonyms in zip(var_objs, var_objs_hg37, df[GENE_SYMBOL_COL],
+                                                          df[HGVS_CDNA_COL], df[REFERENCE_SEQUENCE_COL], synonyms_col):
+        start = time.perf_counter()
+        strand = strand_dict.get(gene)
+        # right shifting normalization on the hgvs_norm_3 side, left shifting on the other
+        hg38 = _normalize_genomic_coordinates(v.to_hgvs_obj(hgvs_proc.contig_maps[HgvsWrapper.GRCh38_Assem]),
+                                              strand, norms[3], norms[5])
+        hg38_left = _normalize_genomic_coordinates(hg38, strand, norms[5], norms[3])
+        hg37 = v37.to_hgvs_obj(hgvs_proc.contig_maps[HgvsWrapper.GRCh37_Assem]) if v37 else None
+        hg37_norm = _normalize_genomic_coordinates(hg37, strand, norms[3], norms[5])
+        # normalizing again for the hg37 representation. An alternative would be to convert the normalized hg38
+        # representation to hg37. If we use crossmap, we would need a way to convert the VCF like representation
+        # back to an hgvs object, which we currently are unable to do properly. That is, we can use
+        # VCFVariant.to_hgvs_obj, however, structural variants will be converted to delins, losing information if
+        # a variant was e.g. a del, ins, or dup.
+        hg37_left = _normalize_genomic_coordinates(hg37, strand, norms[5], norms[3])
+        start = timed('normalization', start)
+
+        cdna = hgvs_proc.genomic_to_cdna(hg38)
+        cdna_left = hgvs_proc.genomic_to_cdna(hg38_left)
+        # extract cdna from source if it could not be computed
+        if not cdna:
+            cdna = cdna_from_cdna_field({HGVS_CDNA_COL: cdna_src, REFERENCE_SEQUENCE_COL: ref_seq,
+                                         GENE_SYMBOL_COL: gene}, cdna_default_ac_dict, hgvs_proc)
+        start = timed('cDNA', start)
+
+        protein = str(hgvs_proc.cdna_to_protein(cdna))
+        protein_left = str(hgvs_proc.cdna_to_protein(cdna_left))
+        start = timed('protein', start)
+
+        new_synonyms = get_synonyms({TMP_CDNA_FROM_SOURCE: cdna_src, TMP_HGVS_HG37_LEFT_ALIGNED: hg37_left,
+                                     TMP_HGVS_HG38_LEFT_ALIGNED: hg38_left, TMP_CDNA_NORM_LEFT_ALINGED_FIELD: cdna_left,
+                                     TMP_PROTEIN_LEFT_ALINGED_FIELD: protein_left, TMP_CDNA_NORM_FIELD: cdna,
+                                     GENE_SYMBOL_COL: gene}, hgvs_proc, syn_ac_dict)
+
+        #### CDNA and Genomic HGVS conversions
+        pyhgvs_cdna = str(cdna)
+        if pyhgvs_cdna.startswith("NM_"):
+            ref_seq, hgvs_cdna = pyhgvs_cdna.split(':')[:2]
+        else:
+            # still setting a reference sequence for downstream steps, even though no cDNA could be determined
+            ref_seq, hgvs_cdna = cdna_default_ac_dict[gene], '-'
+
+        row = {GENOMIC_HGVS_HG38_COL: str(hg38), GENOMIC_HGVS_HG37_COL: str(hg37_norm),
+               PYHGVS_CDNA_COL: pyhgvs_cdna, REFERENCE_SEQUENCE_COL: ref_seq, HGVS_CDNA_COL: hgvs_cdna,
+               PYHGVS_PROTEIN_COL: protein, SYNONYMS_COL: synonyms, NEW_SYNONYMS_FIELD: new_synonyms}
+        # merge existing synonyms with generated ones and sort them
+        row[SYNONYMS_COL] = _merge_and_clean_synonyms(row)
+        for col, value in row.items():
+            cols[col].append(value)
+        timed('synonyms', start)
+
+    start = time.perf_counter()
+    for col in [GENOMIC_HGVS_HG38_COL, GENOMIC_HGVS_HG37_COL, PYHGVS_CDNA_COL, REFERENCE_SEQUENCE_COL, HGVS_CDNA_COL]:
+        df[col] = cols[col]
+
+    #### Internal Genomic Coordinates
+    df[PYHGVS_GENOMIC_COORDINATE_38_COL] = [str(v) for v in var_objs]
+    df[PYHGVS_GENOMIC_COORDINATE_37_COL] = [str(v) for v in var_objs_hg37]
+
+    # handles missing hg37 coordinates, the column has the type it has for all variants
+    df[PYHGVS_HG37_START_COL] = pd.Series([v.pos if v else None for v in var_objs_hg37], index=df.index,
+                                          dtype=float if POOL_CONTEXT['hg37_missing'] else None)
+    df[PYHGVS_HG37_END_COL] = df[PYHGVS_HG37_START_COL] + (df[HG38_END_COL] - df[HG38_START_COL])
+
+    df[PYHGVS_PROTEIN_COL] = cols[PYHGVS_PROTEIN_COL]
+    df[SYNONYMS_COL] = cols[SYNONYMS_COL]
+
+    # removing temporary fields
+    df = df.drop(columns=[c for c in df.columns if c.startswith('tmp_')])
+    tsv = df.to_csv(sep='\t', index=False)
+    timed('output', start)
+
+    return tsv, timings
+
+
 @click.command()
 @click.argument('input', type=click.Path(readable=True))
 @click.argument('output', type=click.Path(writable=True))
@@ -215,8 +368,10 @@ def _merge_and_clean_synonyms(row: pd.Series):
 @click.option("--config-file", required=True, help="path to gene configuration file")
 @click.option('--resources', help="path to directory containing reference sequences")
 @click.option('--processes', type=int, help='Number of processes to use for parallelization', default=8)
-def main(input, output, log_path, config_file, resources, processes):
+@click.option('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Number of variants processed at a time')
+def main(input, output, log_path, config_file, resources, processes, chunk_size):
     utils.setup_logfile(log_path)
+    timings = collections.Counter()
 
     cfg_df = config.load_config(config_file)
 
@@ -226,126 +381,51 @@ def main(input, output, log_path, config_file, resources, processes):
 
     hgvs_proc = HgvsWrapper()
 
-    logging.info("Loading data from {}".format(input))
-    df = pd.read_csv(input, sep='\t')
-
-    df[VAR_OBJ_FIELD] = df.apply(lambda r: VCFVariant(r[CHR_COL], r[POS_COL], r[REF_COL], r[ALT_COL]), axis=1)
-
-    logging.info("Converting variants to hgvs objects")
-
-    df[TMP_HGVS_HG38] = df[VAR_OBJ_FIELD].apply(
-        lambda v: v.to_hgvs_obj(hgvs_proc.contig_maps[HgvsWrapper.GRCh38_Assem]))
-
-    logging.info("Normalize genomic representation")
-
-    df = utils.parallelize_dataframe(df, _normalize_genomic_fnc(TMP_HGVS_HG38,
-                                                                TMP_HGVS_HG38, True,
-                                                                strand_dict), processes)
-    df = utils.parallelize_dataframe(df, _normalize_genomic_fnc(TMP_HGVS_HG38,
-                                                                TMP_HGVS_HG38_LEFT_ALIGNED, False,
-                                                                strand_dict), processes)
-
-    df[GENOMIC_HGVS_HG38_COL] = df[TMP_HGVS_HG38].apply(str)
+    logging.info("Loading variants from {}".format(input))
+    dtypes_by_chunk = []
+    var_objs = []
+    for df in _timed(pd.read_csv(input, sep='\t', chunksize=chunk_size), timings, 'input'):
+        dtypes_by_chunk.append(df.dtypes)
+        var_objs.extend(_vcf_variants(df))
 
     logging.info("Compute hg37 representation of internal representation")
-    var_objs_hg37, var_objs_hg37_failed = convert_to_hg37(df[VAR_OBJ_FIELD], resources)
-
-    tmp_hgvs_hg37_values = [v.to_hgvs_obj(hgvs_proc.contig_maps[HgvsWrapper.GRCh37_Assem]) for v in var_objs_hg37]
-
-    var_objs_hg37, tmp_hgvs_hg37_values, df = handle_failed_hg37_translations(df, var_objs_hg37, var_objs_hg37_failed, tmp_hgvs_hg37_values, hgvs_proc)
-
-    df[TMP_HGVS_HG37] = pd.Series(tmp_hgvs_hg37_values)
-
-    logging.info("Compute hg37 normalized representation of internal")
-    # normalizing again for the hg37 representation. An alternative would be to convert the normalized hg38 representation to hg37.
-    # If we use crossmap, we would need a way to convert the VCF like representation back to an hgvs object, which we currently
-    # are unable to do properly. That is, we can use VCFVariant.to_hgvs_obj, however, structural variants will be converted
-    # to delins, losing information if a variant was e.g. a del, ins, or dup.
-
-    df = utils.parallelize_dataframe(df, _normalize_genomic_fnc(TMP_HGVS_HG37,
-                                                                GENOMIC_HGVS_HG37_COL, True, strand_dict), processes)
-    df[GENOMIC_HGVS_HG37_COL] = df[GENOMIC_HGVS_HG37_COL].apply(str)
-
-    df = utils.parallelize_dataframe(df, _normalize_genomic_fnc(TMP_HGVS_HG37,
-                                                                TMP_HGVS_HG37_LEFT_ALIGNED, False, strand_dict), processes)
-
-    logging.info("Compute cDNA representation")
-
-    def _compute_cdna(df_part):
-        hgvs_proc = HgvsWrapper()  # create it to avoid pickle issues when copying to subprocess
-        df_part[TMP_CDNA_NORM_FIELD] = df_part[TMP_HGVS_HG38].apply(
-            lambda hgvs_obj: hgvs_proc.genomic_to_cdna(hgvs_obj))
-        df_part[TMP_CDNA_NORM_LEFT_ALINGED_FIELD] = df_part[TMP_HGVS_HG38_LEFT_ALIGNED].apply(
-            lambda hgvs_obj: hgvs_proc.genomic_to_cdna(hgvs_obj))
-        return df_part
-
-    df = utils.parallelize_dataframe(df, _compute_cdna, processes)
-
-    # extract cdna from source if it could not be computed
-    df[TMP_CDNA_FROM_SOURCE] = df[HGVS_CDNA_COL]  # "backup" to be used later during synonym computation
-    df[TMP_CDNA_NORM_FIELD] = df.apply(
-        lambda r: cdna_from_cdna_field(r, cdna_default_ac_dict, hgvs_proc) if not r[TMP_CDNA_NORM_FIELD] else r[
-            TMP_CDNA_NORM_FIELD], axis=1)
-
-    #### CDNA and Genomic HGVS conversions
-    df[PYHGVS_CDNA_COL] = df[TMP_CDNA_NORM_FIELD].apply(str)
-
-    available_cdna = df[PYHGVS_CDNA_COL].str.startswith("NM_")
-    df.loc[available_cdna, REFERENCE_SEQUENCE_COL] = df.loc[available_cdna, PYHGVS_CDNA_COL].str.split(':').apply(
-        lambda l: l[0])
-    df.loc[available_cdna, HGVS_CDNA_COL] = df.loc[available_cdna, PYHGVS_CDNA_COL].str.split(':').apply(lambda l: l[1])
-
-    # still setting a reference sequence for downstream steps, even though no cDNA could be determined
-    df.loc[~available_cdna, REFERENCE_SEQUENCE_COL] = df.loc[~available_cdna, GENE_SYMBOL_COL].apply(
-        lambda g: cdna_default_ac_dict[g])
-    df.loc[~available_cdna, HGVS_CDNA_COL] = '-'
-
-    #### Internal Genomic Coordinates
-    df[PYHGVS_GENOMIC_COORDINATE_38_COL] = df[VAR_OBJ_FIELD].apply(lambda v: str(v))
-
-    df[PYHGVS_GENOMIC_COORDINATE_37_COL] = pd.Series([str(v) for v in var_objs_hg37])
-
-    # handles missing hg37 coordinates
-    hg37_start_col_pos = [ v.pos if v else None for v in var_objs_hg37 ]
-
-    df[PYHGVS_HG37_START_COL] = pd.Series(hg37_start_col_pos)
-
-    df[PYHGVS_HG37_END_COL] = df[PYHGVS_HG37_START_COL] + (df[HG38_END_COL] - df[HG38_START_COL])
-
-    #### Protein
-    logging.info("Protein Conversion")
-
-    def _compute_proteins(df_part):
-        hgvs_proc = HgvsWrapper()
-        df_part[PYHGVS_PROTEIN_COL] = df_part[TMP_CDNA_NORM_FIELD].apply(lambda x: str(hgvs_proc.cdna_to_protein(x)))
-        df_part[TMP_PROTEIN_LEFT_ALINGED_FIELD] = df_part[TMP_CDNA_NORM_LEFT_ALINGED_FIELD].apply(
-            lambda x: str(hgvs_proc.cdna_to_protein(x)))
-        return df_part
-
-    df = utils.parallelize_dataframe(df, _compute_proteins, processes)
-
-    #### Synonyms
-    logging.info("Compute Synonyms")
-
-    def _compute_synonyms(df_part):
-        hgvs_proc = HgvsWrapper()
-        df_part[NEW_SYNONYMS_FIELD] = df_part.apply(lambda s: get_synonyms(s, hgvs_proc, syn_ac_dict), axis=1)
-        return df_part
-
-    df = utils.parallelize_dataframe(df, _compute_synonyms, processes)
-
-    df[SYNONYMS_COL] = df[SYNONYMS_COL].fillna('').str.strip()
-
-    # merge existing synonyms with generated ones and sort them
-    df[SYNONYMS_COL] = df.apply(_merge_and_clean_synonyms, axis=1)
-
-    #### Writing out
-    # removing temporary fields
-    tmp_fields = [c for c in df.columns if c.startswith('tmp_')]
-    df = df.drop(columns=[VAR_OBJ_FIELD, NEW_SYNONYMS_FIELD] + tmp_fields)
-
-    logging.info(f"Writing out to {output}")
-    df.to_csv(output, sep='\t', index=False)
+    start = time.perf_counter()
+    vars_hg37 = convert_to_hg37(var_objs, resources)
+    timings['hg37 lift over'] += time.perf_counter() - start
+
+    POOL_CONTEXT.update({
+        'hgvs_proc': hgvs_proc,
+        'normalizers': {d: hgvs.normalizer.Normalizer(hgvs_proc.hgvs_dp, shuffle_direction=d) for d in [3, 5]},
+        'strand_dict': strand_dict,
+        'cdna_default_ac_dict': cdna_default_ac_dict,
+        'syn_ac_dict': syn_ac_dict,
+        'vars_hg37': vars_hg37,
+        'hg37_missing': any(v is None for v in vars_hg37),
+    })
+
+    logging.info("Derive representations of {} variants in chunks of {}".format(len(var_objs), chunk_size))
+    chunks = _timed(pd.read_csv(input, sep='\t', chunksize=chunk_size, dtype=_float_columns(dtypes_by_chunk)),
+                    timings, 'input')
+
+    with open(output, 'w') as f, contextlib.ExitStack() as stack:
+        if processes > 1:
+            sys.stdout.flush()  # otherwise buffered output of the parent would get written by the workers as well
+            pool = stack.enter_context(multiprocessing.Pool(processes, initializer=init_worker))
+            results = _imap_bounded(pool, process_chunk, chunks, 2 * processes)
+        else:
+            results = map(process_chunk, chunks)
+
+        for i, (tsv, chunk_timings) in enumerate(results):
+            start = time.perf_counter()
+            # header is written once
+            f.write(tsv if i == 0 else tsv.split('\n', 1)[1])
+            timings['output'] += time.perf_counter() - start
+            timings.update(chunk_timings)
+
+    logging.info(f"Wrote {output}")
+    # time spent in the worker processes is summed over the processes
+    for phase, seconds in timings.items():
+        logging.info("Time spent on {}: {:.1f}s".format(phase, seconds))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import io
+import multiprocessing
+import os
+
+import hgvs.normalizer
+import numpy as np
+import pandas as pd
+import pytest
+
+from common import config, hgvs_snapshot
+from common.hgvs_utils import HgvsWrapper
+from common.test_hgvs_snapshot import UTAStandIn, ALT_AC, TX_START
+from common.variant_utils import VCFVariant
+from . import brca_pseudonym_generator as pg
+
+pwd = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture(scope="module")
+def pool_context(tmpdir_factory):
+    uta = UTAStandIn()
+    snapshot_dir = str(tmpdir_factory.mktemp("hgvs_snapshot"))
+    cfg_df = config.load_config(os.path.join(pwd, '..', 'workflow', 'gene_config_brca_only.txt'))
+    hgvs_snapshot.build_snapshot(cfg_df, snapshot_dir, uta, margin=100)
+
+    hgvs_proc = HgvsWrapper(hgvs_dp=hgvs_snapshot.SnapshotDataProvider(snapshot_dir))
+    pg.POOL_CONTEXT.update({
+        'hgvs_proc': hgvs_proc,
+        'normalizers': {d: hgvs.normalizer.Normalizer(hgvs_proc.hgvs_dp, shuffle_direction=d) for d in [3, 5]},
+        'strand_dict': {'BRCA2': config.POSITIVE_STRAND},
+        'cdna_default_ac_dict': {'BRCA2': 'NM_000059.3'},
+        'syn_ac_dict': {'BRCA2': ['U43746.1']},
+    })
+    yield uta
+    pg.POOL_CONTEXT.clear()
+
+
+def test_process_chunk(pool_context):
+    uta = pool_context
+    pos = TX_START + 50
+    ref = uta.get_seq(ALT_AC, pos - 1, pos)
+    alt = 'A' if ref != 'A' else 'C'
+    df = pd.DataFrame({pg.CHR_COL: [13, 13], pg.POS_COL: [pos, TX_START - 500], pg.REF_COL: [ref, 'A'],
+                       pg.ALT_COL: [alt, 'G'], pg.GENE_SYMBOL_COL: ['BRCA2', 'BRCA2'],
+                       pg.HGVS_CDNA_COL: ['-', '-'], pg.REFERENCE_SEQUENCE_COL: ['NM_000059.3', 'NM_000059.3'],
+                       pg.HG38_START_COL: [pos, TX_START - 500], pg.HG38_END_COL: [pos, TX_START - 500],
+                       pg.SYNONYMS_COL: [np.nan, ' c.1A>G '], 'tmp_column': [1, 2]})
+    pg.POOL_CONTEXT['vars_hg37'] = [VCFVariant(13, pos + 574143, ref, alt), None]
+    pg.POOL_CONTEXT['hg37_missing'] = True
+
+    tsv, timings = pg.process_chunk(df)
+
+    out = pd.read_csv(io.StringIO(tsv), sep='\t')
+    assert 'tmp_column' not in out.columns
+    assert list(out[pg.GENOMIC_HGVS_HG38_COL]) == ['{}:g.{}{}>{}'.format(ALT_AC, pos, ref, alt),
+                                                  '{}:g.{}A>G'.format(ALT_AC, TX_START - 500)]
+    # no transcript at the second variant, the default accession is used as reference sequence
+    assert list(out[pg.PYHGVS_CDNA_COL]) == ['NM_999999.1:c.40{}>{}'.format(ref, alt), 'None']
+    assert list(out[pg.REFERENCE_SEQUENCE_COL]) == ['NM_999999.1', 'NM_000059.3']
+    assert list(out[pg.HGVS_CDNA_COL]) == ['c.40{}>{}'.format(ref, alt), '-']
+    assert out[pg.PYHGVS_HG37_START_COL][0] == pos + 574143
+    assert np.isnan(out[pg.PYHGVS_HG37_START_COL][1])
+    assert list(out[pg.SYNONYMS_COL].fillna('')) == ['', 'c.1A>G']
+    assert set(timings) == {'normalization', 'cDNA', 'protein', 'synonyms', 'output'}
+
+
+def test_float_columns():
+    dtypes = [pd.DataFrame({'a': [1], 'b': [1.5], 'c': ['x']}).dtypes,
+              pd.DataFrame({'a': [np.nan], 'b': [2.5], 'c': [1]}).dtypes]
+
+    assert pg._float_columns(dtypes) == {'a': float}
+
+
+def _square(x):
+    return x * x
+
+
+def test_imap_bounded():
+    read = []
+
+    def items():
+        for i in range(10):
+            read.append(i)
+            yield i
+
+    with multiprocessing.Pool(2) as pool:
+        results = pg._imap_bounded(pool, _square, items(), 3)
+        assert next(results) == 0
+        # only as many items are read as are in process
+        assert len(read) == 3
+        assert list(results) == [i * i for i in range(1, 10)]
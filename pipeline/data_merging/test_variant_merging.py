@@ -1,5 +1,7 @@
+import csv
 import itertools
 import os
+import shutil
 import unittest
 
 import pytest
@@ -11,14 +13,19 @@ from hypothesis.strategies import integers, tuples, sampled_from, lists
 from mock import patch
 
 from common import seq_utils
-from common.config import load_config, extract_gene_regions_dict
+from common.config import load_config, extract_gene_regions_dict, get_genome_regions_symbol_dict
+from common.utils import ChrInterval
 from .utilities import round_sigfigs
-from .variant_equivalence import variant_equal, find_equivalent_variant, find_equivalent_variants_whole_seq
+from .variant_equivalence import variant_equal, find_equivalent_variant, find_equivalent_variants_whole_seq, \
+    edit_footprint, calculate_edited_seq, canonical_edit, find_equivalent_variants_canonical
 from .variant_merging import normalize_values, add_variant_to_dict, \
-    COLUMN_SOURCE, append_exac_allele_frequencies, EXAC_SUBPOPULATIONS
+    COLUMN_SOURCE, append_exac_allele_frequencies, EXAC_SUBPOPULATIONS, iter_locus_windows, merge_locus_window, \
+    variant_standardize, merge_equivalent_variants, split_by_region, in_memory_merge, sharded_merge
+from . import variant_merging
 
 
-from .variant_merging_constants import VCFVariant
+from .variant_merging_constants import VCFVariant, ENIGMA_FILE, GENOME1K_FILE, CLINVAR_FILE, LOVD_FILE, \
+    EX_LOVD_FILE, EXAC_FILE, ESP_FILE, BIC_FILE, GNOMAD_V2_FILE, GNOMAD_V3_FILE, FUNCTIONAL_ASSAYS_SCORES_FILE
 
 runtimes = 500000
 settings.register_profile('ci', settings(max_examples=runtimes, deadline=None))
@@ -274,6 +281,46 @@ def test_variant_equal_equiv(v, ref_id):
         if is_in_bounds(veq):
             assert variant_equal(add_start(v, ref_id), add_start(veq, ref_id), ref_id, seq_provider)
 
+@given(variant_on_ref, reference_id)
+def test_edit_footprint_equiv(v, ref_id):
+    (chrom, pos, reflen, alt) = v
+    refsequence = chrom_ref[chrom][ref_id]["sequence"]
+    assume(pos + reflen <= len(refsequence))
+    v = inject_ref(refsequence, v)
+    assume(v[2] != v[3])
+
+    def footprint(var):
+        (c, p, r, a) = add_start(var, ref_id)
+        return edit_footprint(VCFVariant(int(c), p - 1, r, a), seq_provider)
+
+    for veq in all_norm_equiv(refsequence, v):
+        if is_in_bounds(veq):
+            assert footprint(v) == footprint(veq)
+
+
+@given(variant_on_ref, variant_on_ref, reference_id)
+def test_canonical_edit_equiv(v1, v2, ref_id):
+    (chrom1, pos1, reflen1, _) = v1
+    (chrom2, pos2, reflen2, _) = v2
+    refsequence1 = chrom_ref[chrom1][ref_id]["sequence"]
+    refsequence2 = chrom_ref[chrom2][ref_id]["sequence"]
+    assume(pos1 + reflen1 <= len(refsequence1))
+    assume(pos2 + reflen2 <= len(refsequence2))
+    v1 = inject_ref(refsequence1, v1)
+    v2 = inject_ref(refsequence2, v2)
+
+    def to_vcf_variant(var):
+        (c, p, r, a) = add_start(var, ref_id)
+        return VCFVariant(int(c), p - 1, r, a)
+
+    vcf_v1 = to_vcf_variant(v1)
+    for veq in all_norm_equiv(refsequence1, v1) + [v2]:
+        if is_in_bounds(veq):
+            vcf_veq = to_vcf_variant(veq)
+            assert (canonical_edit(vcf_v1, seq_provider) == canonical_edit(vcf_veq, seq_provider)) == \
+                   (calculate_edited_seq(vcf_v1, seq_provider) == calculate_edited_seq(vcf_veq, seq_provider))
+
+
 def equiv_set(refsequence, v):
     return set(all_norm_equiv(refsequence, v) + [normalize_variant(v)])
 
@@ -453,6 +500,109 @@ def test_find_equivalent_variant_whole_seq(fetch_seq_mock_data):
         assert frozenset(example_variants) == frozenset(
             find_equivalent_variants_whole_seq(variant_dict, whole_seq_provider))
 
+        assert frozenset(example_variants) == frozenset(
+            find_equivalent_variants_canonical(variant_dict, whole_seq_provider))
+
+
+def test_merge_locus_windows(fetch_seq_mock_data):
+    with patch.object(bioutils.seqfetcher, 'fetch_seq', side_effect=lambda ac, s, e: fetch_seq_mock_data[(str(ac), str(s), str(e))]):
+        gene_config_path = os.path.join(pwd, 'test_files', 'gene_config_test.txt')
+
+        cfg = load_config(gene_config_path)
+        regions = list(extract_gene_regions_dict(cfg, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants').keys())
+        seq_wrapper = seq_utils.SeqRepoWrapper(regions_preload=regions)
+        gene_regions_trees = seq_utils.build_interval_trees_by_chr(regions, lambda c, s, e: None)
+
+        columns = ['Source', 'Gene_Symbol', 'Genomic_Coordinate', 'Chr', 'Pos', 'Ref', 'Alt', 'BX_ID_ClinVar']
+
+        # ordinal, genome coordinate. The last two are merged during standardization,
+        # the ones at 32339774 and 32339776 by the equivalence merge
+        variants = [(3, 'chr13:g.32339774:GAT>G'),
+                    (0, 'chr13:g.32339776:TAT>T'),
+                    (4, 'chr13:g.32355030:A>AA'),
+                    (2, 'chr17:g.43090921:G>GCA'),
+                    (1, 'chr17:g.43090921:GCA>GCACA')]
+
+        def make_rows():
+            rows = []
+            for ordinal, v in variants:
+                chrom, pos, ref_alt = v.lstrip('chr').split(':')
+                ref, alt = ref_alt.split('>')
+                pos = pos.lstrip('g.')
+                row = ['ClinVar', 'BRCA', v, chrom, pos, ref, alt, str(ordinal)]
+                rows.append((int(chrom), int(pos), ordinal, v, row))
+            return rows
+
+        in_memory = {v: row for (_, _, _, v, row) in sorted(make_rows(), key=lambda r: r[2])}
+        in_memory = variant_standardize(columns, seq_wrapper, gene_regions_trees, variants=in_memory)
+        (in_memory, _, _) = merge_equivalent_variants(in_memory, seq_wrapper)
+
+        windows = list(iter_locus_windows(make_rows(), seq_wrapper, gene_regions_trees, 100))
+        assert len(windows) == 3
+
+        streamed = {}
+        for window in windows:
+            (merged, _, _) = merge_locus_window(columns, window, seq_wrapper, gene_regions_trees)
+            streamed.update(merged)
+
+        assert sorted(in_memory.items()) == sorted(streamed.items())
+
+
+def test_split_by_region(tmpdir):
+    regions = [ChrInterval(13, 32314514, 32400266), ChrInterval(17, 43008077, 43127866)]
+    region_trees = seq_utils.build_interval_trees_by_chr(regions, lambda c, s, e: regions.index(ChrInterval(c, s, e)))
+
+    header = ["##fileformat=VCFv4.0\n", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+    records = ["17\t43090921\t.\tG\tGCA\t.\t.\t.\n",
+               "13\t32339774\t.\tGAT\tG\t.\t.\t.\n",
+               "13\t32400266\t.\tA\tT\t.\t.\t.\n"]
+    source_file = tmpdir.join("rightClinVar")
+    source_file.write("".join(header + records))
+
+    region_files = [str(tmpdir.join("region{}".format(i))) for i in range(len(regions))]
+    split_by_region(str(source_file), region_files, region_trees)
+
+    assert open(region_files[0]).readlines() == header + records[1:]
+    assert open(region_files[1]).readlines() == header + records[:1]
+
+
+def test_sharded_merge_equals_in_memory_merge(fetch_seq_mock_data, tmpdir, monkeypatch):
+    # input file name by test file
+    input_files = {'enigma_from_clinvar.tsv': ENIGMA_FILE, '1000_Genomes.vcf': GENOME1K_FILE,
+                   'ClinVar.vcf': CLINVAR_FILE, 'LOVD.vcf': LOVD_FILE, 'exLOVD.vcf': EX_LOVD_FILE,
+                   'ExAC.vcf': EXAC_FILE, 'ESP.vcf': ESP_FILE, 'BIC.vcf': BIC_FILE, 'GnomAD.vcf': GNOMAD_V2_FILE,
+                   'GnomADv3.vcf': GNOMAD_V3_FILE, 'ENIGMA_BRCA12_Functional_Assays.vcf': FUNCTIONAL_ASSAYS_SCORES_FILE}
+    input_dir = tmpdir.mkdir("input")
+    for test_file, input_file in input_files.items():
+        shutil.copy(os.path.join(pwd, 'test_files', test_file), str(input_dir.join(input_file)))
+
+    # the 1000 Genomes preprocessing script is run from the data_merging directory
+    monkeypatch.chdir(pwd)
+
+    with patch.object(bioutils.seqfetcher, 'fetch_seq', side_effect=lambda ac, s, e: fetch_seq_mock_data[(str(ac), str(s), str(e))]):
+        cfg = load_config(os.path.join(pwd, 'test_files', 'gene_config_test.txt'))
+        regions = list(extract_gene_regions_dict(cfg, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants').keys())
+        genome_regions_symbol_dict = get_genome_regions_symbol_dict(cfg, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants')
+        seq_wrapper = seq_utils.SeqRepoWrapper(regions_preload=regions)
+        gene_regions_trees = seq_utils.build_interval_trees_by_chr(regions, lambda c, s, e: None)
+
+        def merge_in_two_processes(input_dir, output_dir, seq_provider, gene_regions_trees, genome_regions_symbol_dict):
+            return sharded_merge(input_dir, output_dir, seq_provider, gene_regions_trees, regions,
+                                 genome_regions_symbol_dict, 2)
+
+        merged = []
+        for output_dir, merge in [(tmpdir.mkdir("in_memory"), in_memory_merge),
+                                  (tmpdir.mkdir("sharded"), merge_in_two_processes)]:
+            with open(str(output_dir.join("discarded_reports.tsv")), "w") as discarded:
+                monkeypatch.setattr(variant_merging, 'DISCARDED_REPORTS_WRITER',
+                                    csv.DictWriter(discarded, delimiter="\t", fieldnames=['Report_id', 'Source', 'Reason', 'Variant']))
+                (_, n_variants) = merge(str(input_dir) + "/", str(output_dir) + "/", seq_wrapper, gene_regions_trees,
+                                        genome_regions_symbol_dict)
+            merged.append((n_variants, output_dir.join("merged.tsv").read()))
+
+    assert merged[0][0] > 0
+    assert merged[0] == merged[1]
+
 
 def test_chunking():
     def chunker(vars, margin):
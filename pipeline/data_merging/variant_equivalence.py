@@ -30,6 +30,134 @@ def calculate_edited_seq(vcf_var, seq_provider):
     return vcf_var.chr, seq_start, edited
 
 
+def edit_footprint(vcf_var, seq_provider):
+    '''
+    Determines the region of the reference in which the edited sequence of a
+    variant differs from the reference, without building the edited sequence.
+
+    The region is extended through repeats, i.e. it covers all positions an
+    indel could be shifted to. Equivalent variants thus have the same
+    footprint, which allows to process variants locus by locus.
+
+    :param vcf_var: VCFVariant record
+    :param seq_provider: seq_provider instance returning a sequence fragment along with an offset
+    :return: Tuple[int, int, int]: chromosome, first and last position (wrt chromosome) of the footprint
+    '''
+    seq, seq_start = seq_provider.get_seq_with_start(vcf_var.chr, vcf_var.pos)
+
+    pos_seq = int(vcf_var.pos) - seq_start
+    ref = vcf_var.ref
+    alt = vcf_var.alt
+    len_seq = len(seq)
+    len_edited = len_seq - len(ref) + len(alt)
+    tail = pos_seq + len(ref)
+
+    def edited_at(i):
+        if i < pos_seq:
+            return seq[i]
+        elif i < pos_seq + len(alt):
+            return alt[i - pos_seq]
+        return seq[tail + i - pos_seq - len(alt)]
+
+    # first position where the edited sequence differs, scanning from the left
+    first_diff = pos_seq
+    while first_diff < min(len_seq, len_edited) and seq[first_diff] == edited_at(first_diff):
+        first_diff += 1
+
+    # last position where the edited sequence differs, scanning from the right.
+    # Everything after the ref allele is shared, hence start scanning from there.
+    i_seq = tail - 1
+    i_edited = pos_seq + len(alt) - 1
+    while i_seq >= 0 and i_edited >= 0 and seq[i_seq] == edited_at(i_edited):
+        i_seq -= 1
+        i_edited -= 1
+
+    return vcf_var.chr, seq_start + min(first_diff, i_seq), seq_start + max(first_diff, i_seq)
+
+
+def canonical_edit(vcf_var, seq_provider):
+    '''
+    Determines a canonical representation of the edited sequence of a variant,
+    without building the edited sequence.
+
+    The edit is trimmed to the minimal region in which the edited sequence
+    differs from the reference, left aligned within repeats. Only this region is
+    scanned, hence the cost depends on the length of the surrounding repeat
+    rather than on the length of the reference sequence. Two variants on the
+    same reference sequence result in the same edited sequence if and only if
+    their canonical representations are equal.
+
+    :param vcf_var: VCFVariant record
+    :param seq_provider: seq_provider instance returning a sequence fragment along with an offset
+    :return: Tuple[int, int, int, int, str]: chromosome, offset of the sequence fragment (wrt chromosome),
+      position (wrt chromosome) and length of the deleted sequence and the inserted sequence
+    '''
+    seq, seq_start = seq_provider.get_seq_with_start(vcf_var.chr, vcf_var.pos)
+
+    pos_seq = int(vcf_var.pos) - seq_start
+    ref = vcf_var.ref
+    alt = vcf_var.alt
+
+    assert pos_seq >= 0,  "position is below the reference for {}. Truncating for comparison".format(vcf_var)
+
+    len_seq = len(seq)
+    if pos_seq + len(ref) < len_seq:
+        assert seq.startswith(ref, pos_seq), "Sequences don't match"
+    else:
+        logging.warning("Sequence goes on above the reference for {}. ref len {}. seq len {}".format(vcf_var, len(ref), len_seq))
+        assert ref.startswith(seq[pos_seq:]), "Sequences don't match for variant going over reference"
+
+    # the edited sequence is seq[:pos_seq] + alt + seq[tail:]
+    tail = min(pos_seq + len(ref), len_seq)
+    len_edited = pos_seq + len(alt) + len_seq - tail
+
+    def edited_at(i):
+        if i < pos_seq:
+            return seq[i]
+        elif i < pos_seq + len(alt):
+            return alt[i - pos_seq]
+        return seq[tail + i - pos_seq - len(alt)]
+
+    min_len = min(len_seq, len_edited)
+
+    # length of the common prefix of reference and edited sequence
+    prefix = pos_seq
+    while prefix < min_len and seq[prefix] == edited_at(prefix):
+        prefix += 1
+
+    # length of the common suffix, not overlapping with the common prefix
+    max_suffix = min_len - prefix
+    suffix = min(len_seq - tail, max_suffix)
+    while suffix < max_suffix and seq[len_seq - 1 - suffix] == edited_at(len_edited - 1 - suffix):
+        suffix += 1
+
+    inserted = ''.join(edited_at(i) for i in range(prefix, len_edited - suffix))
+    return vcf_var.chr, seq_start, seq_start + prefix, len_seq - suffix - prefix, inserted
+
+
+def find_equivalent_variants_canonical(variants_dict, whole_seq_provider):
+    '''
+    Determines equivalent variants by comparing the canonical representations
+    of their edited sequences, see canonical_edit.
+
+    Gives the same result as find_equivalent_variants_whole_seq, but neither
+    builds nor hashes the edited sequence of the entire gene.
+
+    :param variants_dict: dictionary from variant (VCF String, e.g chr13:g.32326103:C>G) to its corresponding VCF row
+    :param whole_seq_provider SeqProvider instance obtain sequence information
+    :return: list of sets of equivalent variants represented as VCF string
+    '''
+
+    logging.info("Running find_equivalent_variants using canonical edits")
+
+    # dictionary from canonical edits to a list of variant names
+    canonical_dict = defaultdict(list)
+    for v_name, v_rec in variants_dict.items():
+        canonical_dict[canonical_edit(v_rec, whole_seq_provider)].append(v_name)
+
+    return [frozenset(var_lst) for var_lst in canonical_dict.values()]
+
+
 def find_equivalent_variants_whole_seq(variants_dict, whole_seq_provider):
     '''
     Determines equivalent variants by editing the reference according to pos,
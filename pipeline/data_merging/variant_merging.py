@@ -5,11 +5,15 @@ it also merges equivalent variants together
 """
 import argparse
 import csv
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
 import pickle
 import re
 import subprocess
+import sys
 from copy import deepcopy
 from numbers import Number
 from shutil import copy
@@ -17,13 +21,20 @@ from shutil import copy
 import vcf
 
 from data_merging import aggregate_reports
-from common import seq_utils, config
+from common import seq_utils, config, utils
 from data_merging import utilities
 from data_merging import variant_equivalence
 from data_merging.variant_merging_constants import *
 
 DISCARDED_REPORTS_WRITER = None
 
+# suffix of the sidecar files holding the input order of the records of a sorted VCF file
+ORDINALS_SUFFIX = ".ordinals"
+
+# objects of the parent process used by the workers of a process pool. Set before
+# forking the pool, as they can't be pickled (e.g. the sequence provider)
+POOL_CONTEXT = dict()
+
 def options(parser):
     parser.add_argument("-i", "--input", help="Input VCF directory",
                         default="/home/brca/pipeline-data/pipeline-input/")
@@ -32,6 +43,16 @@ def options(parser):
     parser.add_argument("-c", "--config")
     parser.add_argument('-a', "--artifacts_dir", help='Artifacts directory with pipeline artifact files.')
     parser.add_argument("-v", "--verbose", action="count", default=False, help="determines logging")
+    parser.add_argument("--streaming", action="store_true",
+                        help="merge variants locus by locus on position sorted sources instead of keeping all variants in memory")
+    parser.add_argument("--window_margin", type=int, default=100,
+                        help="streaming mode: minimal distance between two loci to be merged independently")
+    parser.add_argument("--sort_chunk_size", type=int, default=10000,
+                        help="streaming mode: maximal number of records sorted in memory at a time")
+    parser.add_argument("--packed_reference",
+                        help="packed reference file of the gene regions, see common/packed_reference.py")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes to merge the variants of different gene regions in parallel")
 
 
 def main():
@@ -42,6 +63,9 @@ def main():
 
     args = parser.parse_args()
 
+    if args.processes > 1 and args.streaming:
+        parser.error("--processes is not supported in streaming mode")
+
     gene_config_df = config.load_config(args.config)
 
     gene_regions_dict = config.extract_gene_regions_dict(gene_config_df, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants')
@@ -50,7 +74,8 @@ def main():
 
     genome_regions_symbol_dict = config.get_genome_regions_symbol_dict(gene_config_df, 'start_hg38_legacy_variants', 'end_hg38_legacy_variants')
 
-    seq_provider = seq_utils.SeqRepoWrapper(regions_preload=gene_regions_dict.keys())
+    seq_provider = seq_utils.SeqRepoWrapper(regions_preload=gene_regions_dict.keys(),
+                                            packed_reference_path=args.packed_reference)
 
     if args.verbose:
         logging_level = logging.DEBUG
@@ -68,25 +93,15 @@ def main():
     DISCARDED_REPORTS_WRITER = csv.DictWriter(discarded_reports_file, delimiter="\t", fieldnames=fieldnames)
     DISCARDED_REPORTS_WRITER.writeheader()
 
-    # merge repeats within data sources before merging between data sources
-    source_dict, columns, variants = preprocessing(args.input, args.output, seq_provider, gene_regions_trees)
-
-    # merges repeats from different data sources, adds necessary columns and data
-    print("\n------------merging different datasets------------------------------")
-    for source_name, file in source_dict.items():
-        (columns, variants) = add_new_source(columns, variants, source_name,
-                                             file, FIELD_DICT[source_name], genome_regions_symbol_dict)
-
-    # standardizes genomic coordinates for variants
-    print("\n------------standardizing genomic coordinates-------------")
-    variants = variant_standardize(columns, seq_provider, gene_regions_trees, variants=variants)
-
-    # compare dna sequence results of variants and merge if equivalent
-    print("------------dna sequence comparison merge-------------------------------")
-    variants = string_comparison_merge(variants, seq_provider)
-
-    # write final output to file
-    write_new_tsv(args.output + "merged.tsv", columns, variants)
+    if args.streaming:
+        (columns, n_variants) = streaming_merge(args.input, args.output, seq_provider, gene_regions_trees,
+                                                genome_regions_symbol_dict, args.window_margin, args.sort_chunk_size)
+    elif args.processes > 1:
+        (columns, n_variants) = sharded_merge(args.input, args.output, seq_provider, gene_regions_trees,
+                                              gene_regions_dict.keys(), genome_regions_symbol_dict, args.processes)
+    else:
+        (columns, n_variants) = in_memory_merge(args.input, args.output, seq_provider, gene_regions_trees,
+                                                genome_regions_symbol_dict)
 
     # copy enigma file to artifacts directory along with other ready files
     copy(os.path.join(args.input, ENIGMA_FILE), args.output)
@@ -96,7 +111,7 @@ def main():
 
     discarded_reports_file.close()
 
-    print("final number of variants: %d" % len(variants))
+    print("final number of variants: %d" % n_variants)
     print("Done")
 
 
@@ -120,19 +135,8 @@ def variant_standardize(columns, seq_provider, gene_regions_tree, variants="pick
     variants_to_add = {}
     for ev, items in variants.items():
         bx_ids_for_variant = get_bx_ids_for_variant(bx_id_column_indexes, items)
-        chr = items[COLUMN_VCF_CHR]
-        pos = items[COLUMN_VCF_POS]
-        ref = items[COLUMN_VCF_REF]
-        alt = items[COLUMN_VCF_ALT]
-        if ref == "None":
-            ref = ""
-        if alt == "None":
-            alt = ""
-        if re.search("^-", ref) or re.search("^-", alt):
-            (chr, pos, ref, alt) = add_leading_base(chr, pos, ref, alt, seq_provider)
-        if len(ref) < 1 or len(alt) < 1:
-            (chr, pos, ref, alt) = add_leading_base(chr, pos, ref, alt, seq_provider)
-        (chr, pos, ref, alt) = trim_bases(chr, pos, ref, alt)
+        (chr, pos, ref, alt) = standardize_representation(items[COLUMN_VCF_CHR], items[COLUMN_VCF_POS],
+                                                          items[COLUMN_VCF_REF], items[COLUMN_VCF_ALT], seq_provider)
 
         hgvs = "chr%s:g.%s:%s>%s" % (str(chr), str(pos), ref, alt)
 
@@ -166,6 +170,18 @@ def variant_standardize(columns, seq_provider, gene_regions_tree, variants="pick
     return variants
 
 
+def standardize_representation(chr, pos, ref, alt, seq_provider):
+    if ref == "None":
+        ref = ""
+    if alt == "None":
+        alt = ""
+    if re.search("^-", ref) or re.search("^-", alt):
+        (chr, pos, ref, alt) = add_leading_base(chr, pos, ref, alt, seq_provider)
+    if len(ref) < 1 or len(alt) < 1:
+        (chr, pos, ref, alt) = add_leading_base(chr, pos, ref, alt, seq_provider)
+    return trim_bases(chr, pos, ref, alt)
+
+
 def remove_bad_variants(variants_to_remove, variants):
     for old_variant in variants_to_remove:
         del variants[old_variant]
@@ -321,7 +337,7 @@ def add_leading_base(chr, pos, ref, alt, seq_provider):
         alt = ""
         empty_alt = True
 
-    seq = seq_provider.get_seq(int(chr), pos - 1, 2)
+    seq = seq_provider.get_seq_at(int(chr), pos - 1, 2)
     seq_pos = 1
 
     if empty_ref is True and empty_alt is True:
@@ -345,6 +361,13 @@ def variant_is_false(ref, alt):
 
 
 def string_comparison_merge(variants, seq_wrapper):
+    (variants, n_before_merge, n_after_merge) = merge_equivalent_variants(variants, seq_wrapper)
+    print("%d equivalent variants are merged into %d unique variants" %(
+          n_before_merge, n_after_merge))
+    return variants
+
+
+def merge_equivalent_variants(variants, seq_wrapper):
     # makes sure the input genomic coordinate strings are unique (no dupes)
     assert (len(variants.keys()) == len(set(variants.keys())))
 
@@ -356,7 +379,7 @@ def string_comparison_merge(variants, seq_wrapper):
 
     whole_seq_provider = seq_utils.WholeSeqSeqProvider(seq_wrapper)
 
-    equivalence = variant_equivalence.find_equivalent_variants_whole_seq(vcf_variant_dict, whole_seq_provider)
+    equivalence = variant_equivalence.find_equivalent_variants_canonical(vcf_variant_dict, whole_seq_provider)
 
     n_before_merge = 0
     for each in equivalence:
@@ -364,8 +387,6 @@ def string_comparison_merge(variants, seq_wrapper):
     n_after_merge = len(equivalence)
     logging.info('Before merge: %s', str(n_before_merge))
     logging.info('After merge: %s', str(n_after_merge))
-    print("%d equivalent variants are merged into %d unique variants" %(
-          n_before_merge, n_after_merge))
 
     for equivalent_v in equivalence:
         #
@@ -416,12 +437,11 @@ def string_comparison_merge(variants, seq_wrapper):
             # set.
             variants.pop(each_v)
         variants[",".join(list(equivalent_v))] = merged_row
-    return variants
+    return (variants, n_before_merge, n_after_merge)
 
 
-def preprocessing(input_dir, output_dir, seq_provider, gene_regions_trees):
-    # Preprocessing variants:
-    source_dict = {
+def get_source_dict():
+    return {
                    "1000_Genomes": GENOME1K_FILE + "for_pipeline",
                    "ClinVar": CLINVAR_FILE,
                    "LOVD": LOVD_FILE,
@@ -433,6 +453,29 @@ def preprocessing(input_dir, output_dir, seq_provider, gene_regions_trees):
                    "GnomADv3": GNOMAD_V3_FILE,
                    "ENIGMA_BRCA12_Functional_Assays": FUNCTIONAL_ASSAYS_SCORES_FILE
                    }
+
+
+def preprocessing(input_dir, output_dir, seq_provider, gene_regions_trees):
+    # Preprocessing variants:
+    source_dict = preprocess_sources(input_dir, output_dir, repeat_merging)
+
+    print("-------check if genomic coordinates are correct----------")
+    (columns, variants) = save_enigma_to_dict(os.path.join(input_dir, ENIGMA_FILE), output_dir, seq_provider, gene_regions_trees)
+
+    new_source_dict = check_genome_coordinates(source_dict, output_dir, seq_provider, gene_regions_trees)
+
+    return new_source_dict, columns, variants
+
+
+def preprocess_sources(input_dir, output_dir, merge_repeats, processes=1):
+    '''
+    Splits multi allelic records and collapses repeated records of every source.
+
+    :param merge_repeats: function collapsing repeated records of an input file handle into an output file handle
+    :param processes: number of sources processed in parallel. merge_repeats needs to be picklable if larger than 1
+    :return: dict from source name to file with the collapsed records
+    '''
+    source_dict = get_source_dict()
     print("\n" + input_dir + ":")
     print("---------------------------------------------------------")
     print("ENIGMA: {0}".format(ENIGMA_FILE))
@@ -445,56 +488,108 @@ def preprocessing(input_dir, output_dir, seq_provider, gene_regions_trees):
        ["bash", "1000g_preprocess.sh", os.path.join(input_dir, GENOME1K_FILE)], stdout=f_1000G)
 
     # merge multiple variant per vcf into multiple lines
-    for source_name, file_name in source_dict.items():
-        print("convert to one variant per line in ", source_name)
-        f_in = open(os.path.join(input_dir, file_name), "r")
-        f_out = open(os.path.join(output_dir, source_name + ".vcf"), "w")
-        # Individual reports (lines in VCF/TSV) are given ids as part of the one_variant_transform method.
-        one_variant_transform(f_in, f_out, source_name)
-        f_in.close()
-        f_out.close()
-
-        print("merge repetitive variants within ", source_name)
-        f_in = open(os.path.join(output_dir, source_name + ".vcf"), "r")
-        f_out = open(os.path.join(output_dir, source_name + "ready.vcf"), "w")
-        repeat_merging(f_in, f_out)
-        source_dict[source_name] = f_out.name
+    ready_files = run_in_pool(preprocess_source,
+                              [(input_dir, output_dir, source_name, file_name, merge_repeats)
+                               for source_name, file_name in source_dict.items()],
+                              processes)
 
-    print("-------check if genomic coordinates are correct----------")
-    (columns, variants) = save_enigma_to_dict(os.path.join(input_dir, ENIGMA_FILE), output_dir, seq_provider, gene_regions_trees)
+    return dict(zip(source_dict.keys(), ready_files))
 
-    new_source_dict = {}
-    for source_name, file_name in source_dict.items():
-        f = open(file_name, "r")
-        d_wrong = output_dir + "wrong_genome_coors/"
-        if not os.path.exists(d_wrong):
-            os.makedirs(d_wrong)
-        f_wrong = open(output_dir + "wrong_genome_coors/" +
-                       source_name + "_wrong_genome_coor.vcf", "w")
-        f_right = open(output_dir+ "right" + source_name, "w")
-
-        new_source_dict[source_name] = f_right.name
-
-        vcf_reader = vcf.Reader(f, strict_whitespace=True)
-        vcf_wrong_writer = vcf.Writer(f_wrong, vcf_reader)
-        vcf_right_writer = vcf.Writer(f_right, vcf_reader)
-        n_wrong, n_total = 0, 0
-        for record in vcf_reader:
-            ref = record.REF.replace("-", "")
-            v = [record.CHROM, record.POS, ref, "dummy"]
-            if not ref_correct(record.CHROM, record.POS, record.REF, record.ALT, seq_provider) or is_outside_boundaries(record.CHROM, record.POS, gene_regions_trees):
-                logging.warning("Reference incorrect for Chrom: %s, Pos: %s, Ref: %s, and Alt: %s",
-                                record.CHROM, record.POS, record.REF, record.ALT)
-                vcf_wrong_writer.write_record(record)
-                n_wrong += 1
-            else:
-                vcf_right_writer.write_record(record)
-            n_total += 1
-        f_right.close()
-        f_wrong.close()
-        print("in {0}, wrong: {1}, total: {2}".format(source_name, n_wrong, n_total))
 
-    return new_source_dict, columns, variants
+def preprocess_source(input_dir, output_dir, source_name, file_name, merge_repeats):
+    print("convert to one variant per line in ", source_name)
+    f_in = open(os.path.join(input_dir, file_name), "r")
+    f_out = open(os.path.join(output_dir, source_name + ".vcf"), "w")
+    # Individual reports (lines in VCF/TSV) are given ids as part of the one_variant_transform method.
+    one_variant_transform(f_in, f_out, source_name)
+    f_in.close()
+    f_out.close()
+
+    print("merge repetitive variants within ", source_name)
+    f_in = open(os.path.join(output_dir, source_name + ".vcf"), "r")
+    f_out = open(os.path.join(output_dir, source_name + "ready.vcf"), "w")
+    merge_repeats(f_in, f_out)
+    return f_out.name
+
+
+def check_genome_coordinates(source_dict, output_dir, seq_provider, gene_regions_trees, with_ordinals=False,
+                             processes=1):
+    '''
+    Splits the records of every source into records with correct and incorrect
+    genomic coordinates.
+
+    :param with_ordinals: whether the source files come with an ordinals sidecar file,
+      which is then filtered along with the records
+    :param processes: number of sources checked in parallel
+    :return: dict from source name to file with the records with correct coordinates
+    '''
+    d_wrong = output_dir + "wrong_genome_coors/"
+    if not os.path.exists(d_wrong):
+        os.makedirs(d_wrong)
+
+    POOL_CONTEXT.update(seq_provider=seq_provider, gene_regions_trees=gene_regions_trees)
+    right_files = run_in_pool(check_source_genome_coordinates,
+                              [(source_name, file_name, output_dir, with_ordinals)
+                               for source_name, file_name in source_dict.items()],
+                              processes)
+
+    return dict(zip(source_dict.keys(), right_files))
+
+
+def check_source_genome_coordinates(source_name, file_name, output_dir, with_ordinals):
+    seq_provider = POOL_CONTEXT['seq_provider']
+    gene_regions_trees = POOL_CONTEXT['gene_regions_trees']
+
+    f = open(file_name, "r")
+    f_wrong = open(output_dir + "wrong_genome_coors/" +
+                   source_name + "_wrong_genome_coor.vcf", "w")
+    f_right = open(output_dir+ "right" + source_name, "w")
+
+    vcf_reader = vcf.Reader(f, strict_whitespace=True)
+    vcf_wrong_writer = vcf.Writer(f_wrong, vcf_reader)
+    vcf_right_writer = vcf.Writer(f_right, vcf_reader)
+    if with_ordinals:
+        f_ordinals = open(file_name + ORDINALS_SUFFIX, "r")
+        f_right_ordinals = open(f_right.name + ORDINALS_SUFFIX, "w")
+    n_wrong, n_total = 0, 0
+    for record in vcf_reader:
+        if with_ordinals:
+            ordinal = f_ordinals.readline()
+        if not ref_correct(record.CHROM, record.POS, record.REF, record.ALT, seq_provider) or is_outside_boundaries(record.CHROM, record.POS, gene_regions_trees):
+            logging.warning("Reference incorrect for Chrom: %s, Pos: %s, Ref: %s, and Alt: %s",
+                            record.CHROM, record.POS, record.REF, record.ALT)
+            vcf_wrong_writer.write_record(record)
+            n_wrong += 1
+        else:
+            vcf_right_writer.write_record(record)
+            if with_ordinals:
+                f_right_ordinals.write(ordinal)
+        n_total += 1
+    f.close()
+    f_right.close()
+    f_wrong.close()
+    if with_ordinals:
+        f_ordinals.close()
+        f_right_ordinals.close()
+    print("in {0}, wrong: {1}, total: {2}".format(source_name, n_wrong, n_total))
+    return f_right.name
+
+
+def run_in_pool(function, args_list, processes):
+    """applies function to each argument tuple, using a pool of processes if processes > 1.
+       Results are returned in the order of the arguments"""
+    if processes <= 1:
+        return [function(*args) for args in args_list]
+
+    # otherwise buffered output of the parent would get written by the workers as well
+    sys.stdout.flush()
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        return pool.starmap(function, args_list)
+
+
+def init_worker():
+    if 'seq_provider' in POOL_CONTEXT:
+        POOL_CONTEXT['seq_provider'].reopen()
 
 
 def repeat_merging(f_in, f_out):
@@ -504,48 +599,12 @@ def repeat_merging(f_in, f_out):
     variant_dict = {}  # str -> Record
     num_repeats = 0
     for record in vcf_reader:
-        genome_coor = "chr{0}:{1}:{2}>{3}".format(
-            record.CHROM, str(record.POS), record.REF, record.ALT[0])
+        genome_coor = get_repeat_key(record)
         if genome_coor not in variant_dict.keys():
             variant_dict[genome_coor] = deepcopy(record)
         else:
             num_repeats += 1
-            for key in record.INFO:
-                if key not in variant_dict[genome_coor].INFO.keys():
-                    variant_dict[genome_coor].INFO[key] = deepcopy(record.INFO[key])
-                else:
-                    new_value = deepcopy(record.INFO[key])
-                    new_value = [xx for xx in new_value if xx is not None]
-                    old_value = deepcopy(variant_dict[genome_coor].INFO[key])
-                    old_value = [xx for xx in old_value if xx is not None]
-
-                    if type(new_value) != list:
-                        new_value = [new_value]
-                    if type(old_value) != list:
-                        old_value = [old_value]
-
-                    # This if statement is crucial to not mess up text fields
-                    # containing ',' and hence being treated as separate fields.
-                    # The list(set(new_value + old_value)) statement below would
-                    # garble it otherwise.
-                    if new_value == old_value and key != "individuals":
-                        continue
-                    else:
-                        # FIXME: is there a better name for this? it seems it now only
-                        # applies to scv to ensure the order is the same,
-                        # but we don't hold this concern for other list fields...
-                        if key in LIST_TYPE_FIELDS:
-                            merged_value = list(new_value + old_value)
-                        # The "individuals" values from LOVD submissions are
-                        # added together when merging variants.
-                        elif key == "individuals":
-                            merged_value = [str(int(new_value[0]) + int(old_value[0]))]
-                        else:
-                            merged_value = sorted(list(set(new_value + old_value)))
-
-                        # Remove empty strings from list
-                        merged_value = [_f for _f in merged_value if _f]
-                        variant_dict[genome_coor].INFO[key] = deepcopy(merged_value)
+            merge_repeated_record(variant_dict[genome_coor], record)
     print("number of repeat records: ", num_repeats, "\n")
     vcf_writer = vcf.Writer(f_out, vcf_reader)
     for record in variant_dict.values():
@@ -554,6 +613,83 @@ def repeat_merging(f_in, f_out):
     f_out.close()
 
 
+def sorted_repeat_merging(f_in, f_out, sort_chunk_size):
+    """same as repeat_merging, but writes the collapsed records sorted by genomic
+        position using bounded memory. Within a position, records keep the order
+        of their first appearance. The index of the first appearance of each
+        record in the input is written to a sidecar ordinals file, which allows
+        to reproduce the order of the in memory merge."""
+    vcf_reader = vcf.Reader(f_in, strict_whitespace=True)
+    vcf_writer = vcf.Writer(f_out, vcf_reader)
+    f_ordinals = open(f_out.name + ORDINALS_SUFFIX, "w")
+
+    sorted_records = utils.external_sort(((int(record.CHROM), record.POS, i, record)
+                                          for i, record in enumerate(vcf_reader)),
+                                         key=lambda t: t[:3], chunk_size=sort_chunk_size)
+    num_repeats = 0
+    for _, position_records in itertools.groupby(sorted_records, key=lambda t: t[:2]):
+        variant_dict = {}  # str -> (int, Record)
+        for _, _, ordinal, record in position_records:
+            genome_coor = get_repeat_key(record)
+            if genome_coor not in variant_dict:
+                variant_dict[genome_coor] = (ordinal, deepcopy(record))
+            else:
+                num_repeats += 1
+                merge_repeated_record(variant_dict[genome_coor][1], record)
+        for ordinal, record in variant_dict.values():
+            vcf_writer.write_record(record)
+            f_ordinals.write("%d\n" % ordinal)
+    print("number of repeat records: ", num_repeats, "\n")
+    f_in.close()
+    f_out.close()
+    f_ordinals.close()
+
+
+def get_repeat_key(record):
+    return "chr{0}:{1}:{2}>{3}".format(
+        record.CHROM, str(record.POS), record.REF, record.ALT[0])
+
+
+def merge_repeated_record(merged_record, record):
+    """merges the INFO fields of a repeated vcf record into the record seen first"""
+    for key in record.INFO:
+        if key not in merged_record.INFO.keys():
+            merged_record.INFO[key] = deepcopy(record.INFO[key])
+        else:
+            new_value = deepcopy(record.INFO[key])
+            new_value = [xx for xx in new_value if xx is not None]
+            old_value = deepcopy(merged_record.INFO[key])
+            old_value = [xx for xx in old_value if xx is not None]
+
+            if type(new_value) != list:
+                new_value = [new_value]
+            if type(old_value) != list:
+                old_value = [old_value]
+
+            # This if statement is crucial to not mess up text fields
+            # containing ',' and hence being treated as separate fields.
+            # The list(set(new_value + old_value)) statement below would
+            # garble it otherwise.
+            if new_value == old_value and key != "individuals":
+                continue
+            else:
+                # FIXME: is there a better name for this? it seems it now only
+                # applies to scv to ensure the order is the same,
+                # but we don't hold this concern for other list fields...
+                if key in LIST_TYPE_FIELDS:
+                    merged_value = list(new_value + old_value)
+                # The "individuals" values from LOVD submissions are
+                # added together when merging variants.
+                elif key == "individuals":
+                    merged_value = [str(int(new_value[0]) + int(old_value[0]))]
+                else:
+                    merged_value = sorted(list(set(new_value + old_value)))
+
+                # Remove empty strings from list
+                merged_value = [_f for _f in merged_value if _f]
+                merged_record.INFO[key] = deepcopy(merged_value)
+
+
 def get_header(f):
     header = ""
     for line in f:
@@ -621,18 +757,22 @@ def write_new_tsv(filename, columns, variants):
     merged_file = open(filename, "w")
     merged_file.write("\t".join(columns)+"\n")
     for key, variant in sorted(variants.items()):
-        if len(variant) != len(columns):
-            raise Exception("mismatching number of columns in head and row")
-        for ii in range(len(variant)):
-            if type(variant[ii]) == list:
-                comma_delimited_string = ",".join(str(xx) for xx in variant[ii])
-                variant[ii] = comma_delimited_string
-            elif type(variant[ii]) == int:
-                variant[ii] = str(variant[ii])
-        merged_file.write("\t".join(variant)+"\n")
+        merged_file.write(format_row(columns, variant))
     merged_file.close()
 
 
+def format_row(columns, variant):
+    if len(variant) != len(columns):
+        raise Exception("mismatching number of columns in head and row")
+    for ii in range(len(variant)):
+        if type(variant[ii]) == list:
+            comma_delimited_string = ",".join(str(xx) for xx in variant[ii])
+            variant[ii] = comma_delimited_string
+        elif type(variant[ii]) == int:
+            variant[ii] = str(variant[ii])
+    return "\t".join(variant)+"\n"
+
+
 def add_new_source(columns, variants, source, source_file, source_dict, genome_regions_symbol_dict):
     print("adding {0} into merged file.....".format(source))
     old_column_num = len(columns)
@@ -652,16 +792,7 @@ def add_new_source(columns, variants, source, source_file, source_dict, genome_r
             variants[genome_coor][COLUMN_SOURCE].append(source)
         else:
             variants[genome_coor] = associate_chr_pos_ref_alt_with_item(record, old_column_num, source, genome_coor, genome_regions_symbol_dict)
-        for value in source_dict.values():
-            try:
-                variants[genome_coor].append(record.INFO[value])
-            except KeyError:
-                logging.warning("KeyError appending VCF record.INFO[value] to variant. Variant: %s \n Record.INFO: %s \n value: %s", variants[genome_coor], record.INFO, value)
-                if source == "BIC":
-                    variants[genome_coor].append(DEFAULT_CONTENTS)
-                    logging.debug("Could not find value %s for source %s in variant %s, inserting default content %s instead.", value, source, DEFAULT_CONTENTS)
-                else:
-                    raise Exception("There was a problem appending a value for %s to variant %s" % (value, variants[genome_coor]))
+        append_source_values(variants[genome_coor], record, source, source_dict)
     # for those enigma record that doesn't have a hit with new genome coordinate
     # add extra cells of "-" to the end of old record
     for value in variants.values():
@@ -676,6 +807,19 @@ def add_new_source(columns, variants, source, source_file, source_dict, genome_r
     return (columns, variants)
 
 
+def append_source_values(variant, record, source, source_dict):
+    for value in source_dict.values():
+        try:
+            variant.append(record.INFO[value])
+        except KeyError:
+            logging.warning("KeyError appending VCF record.INFO[value] to variant. Variant: %s \n Record.INFO: %s \n value: %s", variant, record.INFO, value)
+            if source == "BIC":
+                variant.append(DEFAULT_CONTENTS)
+                logging.debug("Could not find value %s for source %s in variant %s, inserting default content %s instead.", value, source, DEFAULT_CONTENTS)
+            else:
+                raise Exception("There was a problem appending a value for %s to variant %s" % (value, variant))
+
+
 def associate_chr_pos_ref_alt_with_item(line, column_num, source, genome_coor, genome_regions_symbol_dict):
     # places genomic coordinate data in correct positions to align with relevant columns in output tsv file.
     item = ['-'] * column_num
@@ -731,10 +875,23 @@ def add_columns_to_enigma_data(line):
 
 
 def save_enigma_to_dict(path, output_dir, seq_provider, gene_regions_trees):
+    variants = dict()
+    for (_, _, _, hgvs, items) in iter_correct_enigma_reports(path, output_dir, seq_provider, gene_regions_trees):
+        variants = add_variant_to_dict(variants, hgvs, items)
+    return (read_enigma_columns(path), variants)
+
+
+def read_enigma_columns(path):
+    with open(path, "r") as enigma_file:
+        return add_columns_to_enigma_data(enigma_file.readline())
+
+
+def iter_correct_enigma_reports(path, output_dir, seq_provider, gene_regions_trees):
+    """yields (line number, chrom, pos, hgvs, items) of the ENIGMA reports with correct
+       genomic coordinates. Other reports are written to a separate file and logged as discarded"""
     global DISCARDED_REPORTS_WRITER
 
     enigma_file = open(path, "r")
-    variants = dict()
     line_num = 0
     f_wrong = open(output_dir + "ENIGMA_wrong_genome.txt", "w")
     n_wrong, n_total = 0, 0
@@ -742,8 +899,7 @@ def save_enigma_to_dict(path, output_dir, seq_provider, gene_regions_trees):
     for line in enigma_file:
         line_num += 1
         if line_num == 1:
-            columns = add_columns_to_enigma_data(line)
-            for i, column in enumerate(columns):
+            for i, column in enumerate(add_columns_to_enigma_data(line)):
                 if "BX_ID" in column:
                     bx_id_column_index = i
             f_wrong.write(line)
@@ -753,7 +909,7 @@ def save_enigma_to_dict(path, output_dir, seq_provider, gene_regions_trees):
             hgvs = "chr%s:g.%s:%s>%s" % (str(chrom), str(pos), ref, alt)
 
             if ref_correct(chrom, pos, ref, alt, seq_provider) and not is_outside_boundaries(chrom, pos, gene_regions_trees):
-                variants = add_variant_to_dict(variants, hgvs, items)
+                yield (line_num, chrom, pos, hgvs, items)
             elif pos == 'None':
                 logging.warning("Position is none for Enigma report, throwing away: %s", line)
                 log_discarded_reports("ENIGMA", bx_id, hgvs, "None position")
@@ -767,9 +923,9 @@ def save_enigma_to_dict(path, output_dir, seq_provider, gene_regions_trees):
 
             n_total += 1
 
+    enigma_file.close()
     f_wrong.close()
     print("in ENIGMA, wrong: {0}, total: {1}".format(n_wrong, n_total))
-    return (columns, variants)
 
 
 def is_outside_boundaries(c, pos, gene_regions_trees):
@@ -838,5 +994,375 @@ def log_discarded_report(source, report, hgvs, reason):
     DISCARDED_REPORTS_WRITER.writerow({'Report_id': report, 'Source': source, 'Reason': reason, 'Variant': hgvs})
 
 
+def in_memory_merge(input_dir, output_dir, seq_provider, gene_regions_trees, genome_regions_symbol_dict):
+    '''
+    Merges the variants of all sources in memory and writes them to merged.tsv in output_dir.
+
+    :return: tuple of output columns and number of merged variants
+    '''
+    # merge repeats within data sources before merging between data sources
+    source_dict, columns, variants = preprocessing(input_dir, output_dir, seq_provider, gene_regions_trees)
+
+    # merges repeats from different data sources, adds necessary columns and data
+    print("\n------------merging different datasets------------------------------")
+    for source_name, file in source_dict.items():
+        (columns, variants) = add_new_source(columns, variants, source_name,
+                                             file, FIELD_DICT[source_name], genome_regions_symbol_dict)
+
+    # standardizes genomic coordinates for variants
+    print("\n------------standardizing genomic coordinates-------------")
+    variants = variant_standardize(columns, seq_provider, gene_regions_trees, variants=variants)
+
+    # compare dna sequence results of variants and merge if equivalent
+    print("------------dna sequence comparison merge-------------------------------")
+    variants = string_comparison_merge(variants, seq_provider)
+
+    # write final output to file
+    write_new_tsv(output_dir + "merged.tsv", columns, variants)
+    return (columns, len(variants))
+
+
+def sharded_merge(input_dir, output_dir, seq_provider, gene_regions_trees, gene_regions, genome_regions_symbol_dict,
+                  processes):
+    '''
+    Merges variants like preprocessing, add_new_source, variant_standardize and
+    string_comparison_merge do, but processes gene regions in parallel.
+
+    Sources are preprocessed and checked in parallel, then split by gene region.
+    Variants of different gene regions can't be merged with each other, hence
+    every region is merged separately in a pool of processes. The sorted region
+    outputs are finally stitched together, giving the same output as the in
+    memory merge.
+
+    :param gene_regions: Iterable[ChrInterval] of the gene regions
+    :return: tuple of output columns and number of merged variants
+    '''
+    source_dict = preprocess_sources(input_dir, output_dir, repeat_merging, processes)
+
+    print("-------check if genomic coordinates are correct----------")
+    enigma_path = os.path.join(input_dir, ENIGMA_FILE)
+    columns = read_enigma_columns(enigma_path)
+
+    regions = sorted(gene_regions)
+    region_dirs = [os.path.join(output_dir, "regions", "{}_{}_{}".format(*region), "") for region in regions]
+    region_trees = seq_utils.build_interval_trees_by_chr(regions, lambda c, s, e: regions.index(utils.ChrInterval(c, s, e)))
+
+    enigma_reports = [[] for _ in regions]
+    for (_, chrom, pos, hgvs, items) in iter_correct_enigma_reports(enigma_path, output_dir, seq_provider,
+                                                                    gene_regions_trees):
+        enigma_reports[get_region_index(region_trees, chrom, pos)].append((hgvs, items))
+
+    source_dict = check_genome_coordinates(source_dict, output_dir, seq_provider, gene_regions_trees,
+                                           processes=processes)
+
+    for region_dir in region_dirs:
+        if not os.path.exists(region_dir):
+            os.makedirs(region_dir)
+    for source_name, file_name in source_dict.items():
+        split_by_region(file_name, [d + os.path.basename(file_name) for d in region_dirs], region_trees)
+
+    print("\n------------merging gene regions in parallel------------------------")
+    POOL_CONTEXT.update(seq_provider=seq_provider, gene_regions_trees=gene_regions_trees,
+                        genome_regions_symbol_dict=genome_regions_symbol_dict)
+    region_sources = [[(source_name, region_dir + os.path.basename(file_name))
+                       for source_name, file_name in source_dict.items()] for region_dir in region_dirs]
+    results = run_in_pool(merge_gene_region,
+                          list(zip(region_dirs, itertools.repeat(columns), enigma_reports, region_sources)),
+                          processes)
+
+    for source_name in source_dict.keys():
+        columns = columns + [column_title + "_{0}".format(source_name) for column_title in FIELD_DICT[source_name]]
+
+    # stitch the region outputs, which are sorted by variant already
+    def read_region_output(region_dir):
+        with open(region_dir + "merged.tsv", "r") as f:
+            for line in f:
+                yield tuple(line.split("\t", 1))
+
+    with open(output_dir + "merged.tsv", "w") as merged_file:
+        merged_file.write("\t".join(columns)+"\n")
+        for (_, line) in heapq.merge(*[read_region_output(d) for d in region_dirs], key=lambda t: t[0]):
+            merged_file.write(line)
+
+    # discarded reports of the regions are appended in region order
+    for region_dir in region_dirs:
+        with open(region_dir + "discarded_reports.tsv", "r") as f:
+            for row in csv.DictReader(f, delimiter="\t", fieldnames=DISCARDED_REPORTS_WRITER.fieldnames):
+                DISCARDED_REPORTS_WRITER.writerow(row)
+
+    n_variants, n_before_merge, n_after_merge = [sum(c) for c in zip(*results)]
+    print("%d equivalent variants are merged into %d unique variants" % (n_before_merge, n_after_merge))
+    return (columns, n_variants)
+
+
+def get_region_index(region_trees, chrom, pos):
+    return min(interval.data for interval in region_trees[int(chrom)].at(int(pos)))
+
+
+def split_by_region(file_name, region_file_names, region_trees):
+    """copies the header of a VCF file to every region file and each record to the
+       file of the region it's located in"""
+    region_files = [open(f, "w") for f in region_file_names]
+    with open(file_name, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                for region_file in region_files:
+                    region_file.write(line)
+            else:
+                (chrom, pos, _) = line.split("\t", 2)
+                region_files[get_region_index(region_trees, chrom, pos)].write(line)
+    for region_file in region_files:
+        region_file.close()
+
+
+def merge_gene_region(region_dir, columns, enigma_reports, sources):
+    '''
+    Merges the variants of a single gene region, writing the merged variants
+    sorted by key along with the key to a merged.tsv file in region_dir.
+
+    :param enigma_reports: list of (hgvs, items) of the correct ENIGMA reports of the region
+    :param sources: list of (source name, file with the records of the region)
+    :return: tuple of number of merged variants, number of equivalent variants before and after merging them
+    '''
+    global DISCARDED_REPORTS_WRITER
+
+    seq_provider = POOL_CONTEXT['seq_provider']
+    gene_regions_trees = POOL_CONTEXT['gene_regions_trees']
+    genome_regions_symbol_dict = POOL_CONTEXT['genome_regions_symbol_dict']
+
+    parent_writer = DISCARDED_REPORTS_WRITER
+    discarded_reports_file = open(region_dir + "discarded_reports.tsv", "w")
+    DISCARDED_REPORTS_WRITER = csv.DictWriter(discarded_reports_file, delimiter="\t",
+                                              fieldnames=parent_writer.fieldnames)
+    try:
+        variants = dict()
+        for (hgvs, items) in enigma_reports:
+            variants = add_variant_to_dict(variants, hgvs, items)
+
+        columns = list(columns)
+        for source_name, file_name in sources:
+            (columns, variants) = add_new_source(columns, variants, source_name,
+                                                 file_name, FIELD_DICT[source_name], genome_regions_symbol_dict)
+
+        variants = variant_standardize(columns, seq_provider, gene_regions_trees, variants=variants)
+        (variants, n_before_merge, n_after_merge) = merge_equivalent_variants(variants, seq_provider)
+
+        with open(region_dir + "merged.tsv", "w") as f:
+            for key, variant in sorted(variants.items()):
+                f.write(key + "\t" + format_row(columns, variant))
+    finally:
+        discarded_reports_file.close()
+        DISCARDED_REPORTS_WRITER = parent_writer
+
+    return (len(variants), n_before_merge, n_after_merge)
+
+
+def streaming_merge(input_dir, output_dir, seq_provider, gene_regions_trees, genome_regions_symbol_dict,
+                    window_margin, sort_chunk_size):
+    '''
+    Merges variants like preprocessing, add_new_source, variant_standardize and
+    string_comparison_merge do, but without keeping all variants in memory.
+
+    The sources are sorted by genomic position (on disk if needed) and merged
+    in a single pass. Variants are then grouped into loci, s.t. variants of
+    different loci cannot end up being merged into the same variant. Each locus
+    is standardized and merged separately, replaying the order in which the
+    variants would have been added to the in memory dictionary. The output is
+    the same as for the in memory merge.
+
+    :return: tuple of output columns and number of merged variants
+    '''
+    source_dict = preprocess_sources(input_dir, output_dir,
+                                     lambda f_in, f_out: sorted_repeat_merging(f_in, f_out, sort_chunk_size))
+
+    print("-------check if genomic coordinates are correct----------")
+    enigma_path = os.path.join(input_dir, ENIGMA_FILE)
+    columns = read_enigma_columns(enigma_path)
+    enigma_variants = iter_sorted_enigma(enigma_path, output_dir, seq_provider, gene_regions_trees, sort_chunk_size)
+
+    source_dict = check_genome_coordinates(source_dict, output_dir, seq_provider, gene_regions_trees,
+                                           with_ordinals=True)
+
+    print("\n------------merging sorted datasets---------------------------------")
+    n_enigma_columns = len(columns)
+    sources = []
+    for source_name, file_name in source_dict.items():
+        columns = columns + [column_title + "_{0}".format(source_name) for column_title in FIELD_DICT[source_name]]
+        sources.append((source_name, FIELD_DICT[source_name], iter_sorted_source(file_name)))
+
+    rows = iter_merged_rows(n_enigma_columns, enigma_variants, sources, genome_regions_symbol_dict)
+
+    merge_counts = [0, 0]
+
+    def merged_variants():
+        for window in iter_locus_windows(rows, seq_provider, gene_regions_trees, window_margin):
+            (variants, n_before_merge, n_after_merge) = merge_locus_window(columns, window, seq_provider,
+                                                                           gene_regions_trees)
+            merge_counts[0] += n_before_merge
+            merge_counts[1] += n_after_merge
+            yield from variants.items()
+
+    n_variants = write_sorted_tsv(output_dir + "merged.tsv", columns, merged_variants(), sort_chunk_size)
+
+    print("%d equivalent variants are merged into %d unique variants" % tuple(merge_counts))
+    return (columns, n_variants)
+
+
+def iter_sorted_enigma(path, output_dir, seq_provider, gene_regions_trees, sort_chunk_size):
+    """streaming counterpart of save_enigma_to_dict. Yields (chrom, pos, ordinal, hgvs, items)
+       sorted by genomic position, where ordinal is the line of the first report of a variant"""
+    reports = ((int(chrom), int(pos), line_num, hgvs, items) for (line_num, chrom, pos, hgvs, items)
+               in iter_correct_enigma_reports(path, output_dir, seq_provider, gene_regions_trees))
+
+    sorted_reports = utils.external_sort(reports, key=lambda t: t[:3], chunk_size=sort_chunk_size)
+    for (chrom, pos), position_reports in itertools.groupby(sorted_reports, key=lambda t: t[:2]):
+        variants = dict()
+        ordinals = dict()
+        for (_, _, ordinal, hgvs, items) in position_reports:
+            ordinals.setdefault(hgvs, ordinal)
+            variants = add_variant_to_dict(variants, hgvs, items)
+        for hgvs, items in variants.items():
+            yield (chrom, pos, ordinals[hgvs], hgvs, items)
+
+
+def iter_sorted_source(file_name):
+    """yields (chrom, pos, ordinal, genome_coor, record) of a position sorted source file
+       along with its ordinals sidecar file"""
+    vcf_reader = vcf.Reader(open(file_name, "r"), strict_whitespace=True)
+    with open(file_name + ORDINALS_SUFFIX, "r") as f_ordinals:
+        for record in vcf_reader:
+            ordinal = int(f_ordinals.readline())
+            genome_coor = ("chr" + str(record.CHROM) + ":g." + str(record.POS) + ":" +
+                           record.REF + ">" + str(record.ALT[0]))
+            yield (int(record.CHROM), record.POS, ordinal, genome_coor, record)
+
+
+def iter_merged_rows(n_enigma_columns, enigma_variants, sources, genome_regions_symbol_dict):
+    '''
+    Merges position sorted ENIGMA variants and source records, yielding the same
+    rows add_new_source would produce when adding one source after the other.
+
+    :param n_enigma_columns: number of columns of the ENIGMA data
+    :param enigma_variants: iterator as returned by iter_sorted_enigma
+    :param sources: list of (source name, source fields, iterator as returned by iter_sorted_source)
+    :param genome_regions_symbol_dict: dict from chromosome to interval tree with gene symbols
+    :return: iterator of (chrom, pos, ordinal, genome_coor, row) sorted by position. The
+      ordinal reflects the order in which the row would have been added to the in memory dictionary
+    '''
+    def tag_source(stream, rank):
+        for (chrom, pos, ordinal, genome_coor, payload) in stream:
+            yield (chrom, pos, rank, ordinal, genome_coor, payload)
+
+    streams = [tag_source(enigma_variants, 0)] + [tag_source(stream, rank + 1)
+                                                  for rank, (_, _, stream) in enumerate(sources)]
+
+    for (chrom, pos), position_entries in itertools.groupby(heapq.merge(*streams, key=lambda t: t[:2]),
+                                                            key=lambda t: t[:2]):
+        payloads = dict()  # genome_coor -> dict[int, payload]
+        ordinals = dict()
+        for (_, _, rank, ordinal, genome_coor, payload) in position_entries:
+            payloads.setdefault(genome_coor, dict())[rank] = payload
+            ordinals[genome_coor] = min(ordinals.get(genome_coor, (rank, ordinal)), (rank, ordinal))
+
+        for genome_coor, source_payloads in payloads.items():
+            row = source_payloads.get(0)
+            n_columns = n_enigma_columns
+            for rank, (source_name, source_fields, _) in enumerate(sources, 1):
+                record = source_payloads.get(rank)
+                if record is not None:
+                    if row is None:
+                        row = associate_chr_pos_ref_alt_with_item(record, n_columns, source_name, genome_coor,
+                                                                  genome_regions_symbol_dict)
+                    else:
+                        if type(row[COLUMN_SOURCE]) != list:
+                            row[COLUMN_SOURCE] = [row[COLUMN_SOURCE]]
+                        row[COLUMN_SOURCE].append(source_name)
+                    append_source_values(row, record, source_name, source_fields)
+                elif row is not None:
+                    row += [DEFAULT_CONTENTS] * len(source_fields)
+                n_columns += len(source_fields)
+
+            yield (chrom, pos, ordinals[genome_coor], genome_coor, row)
+
+
+def iter_locus_windows(rows, seq_provider, gene_regions_trees, window_margin):
+    '''
+    Groups position sorted rows into windows of variants which may get merged
+    with each other, either by variant_standardize or string_comparison_merge.
+
+    A window is closed once a variant is further than window_margin away from it
+    and its footprint doesn't overlap with the window. Should the footprint of
+    a later variant still reach into a closed window, an exception is raised
+    rather than producing a different result than the in memory merge.
+
+    :return: iterator of lists of (ordinal, genome_coor, row)
+    '''
+    whole_seq_provider = seq_utils.WholeSeqSeqProvider(seq_provider)
+
+    window = []
+    window_chr, window_end = None, None
+    closed_window_ends = dict()
+    for (chrom, pos, ordinal, genome_coor, row) in rows:
+        start, end = variant_footprint(row, seq_provider, whole_seq_provider, gene_regions_trees)
+
+        if window and (chrom != window_chr or (pos - window_margin > window_end and start > window_end)):
+            yield window
+            closed_window_ends[window_chr] = window_end
+            window = []
+
+        if chrom in closed_window_ends and start <= closed_window_ends[chrom]:
+            raise ValueError("Variant {} reaches into an already merged locus ending at {}. "
+                             "Try a larger window margin.".format(genome_coor, closed_window_ends[chrom]))
+
+        if not window:
+            window_chr, window_end = chrom, end
+        else:
+            window_end = max(window_end, end)
+        window.append((ordinal, genome_coor, row))
+
+    if window:
+        yield window
+
+
+def variant_footprint(items, seq_provider, whole_seq_provider, gene_regions_trees):
+    """returns the range of positions a row may interact with other rows in. Rows
+       which will be discarded during standardization only cover their position"""
+    (chr, pos, ref, alt) = standardize_representation(items[COLUMN_VCF_CHR], items[COLUMN_VCF_POS],
+                                                      items[COLUMN_VCF_REF], items[COLUMN_VCF_ALT], seq_provider)
+    chr = int(chr)
+    pos = int(pos)
+
+    if is_outside_boundaries(chr, pos, gene_regions_trees) or variant_is_false(ref, alt):
+        return (pos, pos)
+
+    genome_ref = seq_provider.get_seq_at(chr, pos, len(ref))
+    if not ref.upper().startswith(genome_ref.upper()):
+        return (pos, pos)
+
+    (_, start, end) = variant_equivalence.edit_footprint(VCFVariant(chr, pos, ref, alt), whole_seq_provider)
+    return (min(start, pos), max(end, pos))
+
+
+def merge_locus_window(columns, window, seq_provider, gene_regions_trees):
+    # replay the insertion order of the in memory merge
+    variants = {genome_coor: row for (_, genome_coor, row) in sorted(window, key=lambda w: w[0])}
+    variants = variant_standardize(columns, seq_provider, gene_regions_trees, variants=variants)
+    return merge_equivalent_variants(variants, seq_provider)
+
+
+def write_sorted_tsv(filename, columns, variants, sort_chunk_size):
+    """same as write_new_tsv, but takes an iterator of (genome_coor, row) and sorts
+       the formatted rows on disk"""
+    merged_file = open(filename, "w")
+    merged_file.write("\t".join(columns)+"\n")
+    lines = ((key, format_row(columns, variant)) for key, variant in variants)
+    n_variants = 0
+    for (_, line) in utils.external_sort(lines, key=lambda t: t[0], chunk_size=sort_chunk_size):
+        merged_file.write(line)
+        n_variants += 1
+    merged_file.close()
+    return n_variants
+
+
 if __name__ == "__main__":
     main()
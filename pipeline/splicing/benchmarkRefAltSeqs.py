@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+benchmarkRefAltSeqs
+
+Compares building the alt sequences of the sliding splice site windows used by calcVarPriors
+with a dictionary entry per base (getSeqLocDict, getAltSeqDict, getAltSeq) to splicing the alt allele
+into the reference sequence (spliceAltSeq), for the substitution variants of the test variant sets.
+Both ways have to produce identical sequences.
+"""
+
+import csv
+import timeit
+
+import click
+
+from calc_priors.constants import STD_ACC_SIZE, STD_DONOR_SIZE
+from calc_priors.extract import getAltSeq, getAltSeqDict, getFastaSeq, getSeqLocDict, getVarChrom, getVarType, \
+    initSeqAccess, spliceAltSeq
+from calc_priors.verify import getVarStrand
+
+
+def getWindowRegions(variant):
+    """
+    Given a variant, returns the (rangeStart, rangeStop) tuples of the regions
+    passed to getRefAltSeqs by getMaxEntScanScoresSlidingWindowSNS for splice donors and acceptors
+    """
+    varGenPos = int(variant["Pos"])
+    regions = []
+    for windowSize in [STD_DONOR_SIZE, STD_ACC_SIZE]:
+        offset = windowSize - 1
+        if getVarStrand(variant) == "-":
+            regions.append((varGenPos + offset, varGenPos - offset))
+        else:
+            regions.append((varGenPos - offset, varGenPos + offset))
+    return regions
+
+
+def dictAltSeq(variant, rangeStart, rangeStop):
+    varStrand = getVarStrand(variant)
+    seqLocDict = getSeqLocDict(getVarChrom(variant), varStrand, rangeStart, rangeStop)
+    return getAltSeq(getAltSeqDict(variant, seqLocDict), varStrand)
+
+
+def splicedAltSeq(variant, rangeStart, rangeStop):
+    regionStart, regionEnd = min(rangeStart, rangeStop), max(rangeStart, rangeStop)
+    sequence = getFastaSeq(getVarChrom(variant), regionStart, regionEnd, plusStrandSeq=True)
+    return spliceAltSeq(variant, sequence, regionStart, getVarStrand(variant))
+
+
+def timePerVariant(build, variants, repeat):
+    """Returns the best of repeat runs of building the alt sequences of all windows, in microseconds per variant"""
+    def runAll():
+        for variant, regions in variants:
+            for rangeStart, rangeStop in regions:
+                build(variant, rangeStart, rangeStop)
+    return min(timeit.repeat(runAll, number=1, repeat=repeat)) / len(variants) * 1e6
+
+
+@click.command()
+@click.option("--genome", type=click.Path(exists=False), default="/references/hg38.fa",
+              help="Fasta file containing hg38 reference genome")
+@click.option("--packed-reference", type=click.Path(exists=True), default=None,
+              help="Packed reference file of the gene regions, used instead of the fasta file where possible")
+@click.option("--repeat", type=int, default=20, help="Number of timed runs, the fastest one is reported")
+@click.argument("lengths", nargs=-1, type=click.Choice(["one", "short", "long", "concerning", "fullblacklist"]))
+def benchmark(genome, packed_reference, repeat, lengths):
+    initSeqAccess(genome, packed_reference)
+    for length in lengths or ["short", "long"]:
+        with open("tests/variants_%s.tsv" % length, "r") as f:
+            variants = [(variant, getWindowRegions(variant)) for variant in csv.DictReader(f, delimiter="\t")
+                        if getVarType(variant) == "substitution" and getVarStrand(variant) != ""]
+
+        for variant, regions in variants:
+            for rangeStart, rangeStop in regions:
+                if dictAltSeq(variant, rangeStart, rangeStop) != splicedAltSeq(variant, rangeStart, rangeStop):
+                    raise Exception("alt sequences of %s differ for region %s-%s" %
+                                    (variant["HGVS_cDNA"], rangeStart, rangeStop))
+
+        # sequences are cached by getFastaSeq after the check above, hence only sequence construction is timed
+        dictTime = timePerVariant(dictAltSeq, variants, repeat)
+        splicedTime = timePerVariant(splicedAltSeq, variants, repeat)
+        click.echo("%s: %d substitution variants, per variant %.1f us with dictionaries, %.1f us spliced, %.1fx speedup" %
+                   (length, len(variants), dictTime, splicedTime, dictTime / splicedTime))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -8,6 +8,8 @@ calculates either the prior probability of pathogenicity or a prior ENGIMA class
 """
 
 import csv
+import hashlib
+import os
 from itertools import chain
 
 import subprocess
@@ -17,10 +19,13 @@ import multiprocessing
 import pytest
 import pyhgvs.utils as pyhgvs_utils
 
+from calc_priors import checkpoint
 from calc_priors.constants import BRCA1_RefSeq, BRCA2_RefSeq
 from calc_priors.dataproc import BLANK_DICT, addVarDataToRow
-from calc_priors.extract import getVarType
+from calc_priors.extract import getVarType, initSeqAccess, getSeqCacheStats
 from calc_priors.compute import getVarLocation
+from calc_priors.maxentscan import initMaxEntScanCache, getMaxEntScanCacheStats
+from calc_priors.resultstore import ResultStore, StoredResultsWriter, fileDigest, priorsVersion
 from calc_priors.priors import getPriorProbAfterGreyZoneSNS, getPriorProbSpliceDonorSNS, getPriorProbSpliceAcceptorSNS, \
     getPriorProbInGreyZoneSNS, getPriorProbInExonSNS, getPriorProbOutsideTranscriptBoundsSNS, getPriorProbInIntronSNS, \
     getPriorProbInUTRSNS
@@ -118,9 +123,18 @@ def calc_one(variant):
         raise e
 
 
-def calc_all(variants, priors, genome, transcripts, processes):
+def calc_shard(shard):
+    index, digest, rows = shard
+    return index, digest, [calc_one(row) for row in rows]
+
+
+def calc_all(variants, priors, genome, transcripts, processes, packedReference=None, checkpointDir=None,
+             chunkSize=200, resultStorePath=None):
     global brca1Transcript, brca2Transcript
 
+    initSeqAccess(genome, packedReference)
+    initMaxEntScanCache()
+
     inputData = csv.DictReader(variants, delimiter="\t")
     fieldnames = inputData.fieldnames
     newHeaders = open("headers.tsv", "r").read().split()
@@ -129,16 +143,33 @@ def calc_all(variants, priors, genome, transcripts, processes):
     outputData = csv.DictWriter(priors, delimiter="\t", lineterminator="\n", fieldnames=fieldnames)
     outputData.writerow(dict((fn, fn) for fn in inputData.fieldnames))
 
-    # read RefSeq transcripts
-    transcripts = pyhgvs_utils.read_transcripts(transcripts)
+    # read RefSeq transcripts, their lines are part of the version of stored results
+    transcriptLines = transcripts.readlines()
+    transcripts = pyhgvs_utils.read_transcripts(transcriptLines)
 
     brca1Transcript = transcripts.get(BRCA1_RefSeq)
     brca2Transcript = transcripts.get(BRCA2_RefSeq)
 
-    if processes > 1:
+    store = None
+    reusedRows = []
+    if resultStorePath:
+        # only calculate variants without results of the current priors version in the store. The genome is only
+        # opened when sequences aren't covered by the packed reference, so it doesn't need to exist
+        references = {"genome": fileDigest(genome) if os.path.exists(genome) else None,
+                      "transcripts": hashlib.md5("".join(transcriptLines).encode("utf-8")).hexdigest(),
+                      "packedReference": fileDigest(packedReference) if packedReference else None}
+        store = ResultStore(resultStorePath, priorsVersion(references))
+        inputData = reuse_stored_results(store, inputData, reusedRows)
+        outputData = StoredResultsWriter(outputData, store, reusedRows, newHeaders)
+
+    if checkpointDir:
+        calc_checkpointed(inputData, outputData, fieldnames, genome, processes, packedReference, checkpointDir,
+                          chunkSize)
+    elif processes > 1:
         # Create a pool of processes and calculate in parallel
         click.echo("Processing using {} processes".format(processes), err=True)
-        pool = multiprocessing.Pool(processes)
+        # every worker opens its own fasta file handle and keeps its own sequence cache
+        pool = multiprocessing.Pool(processes, initializer=initSeqAccess, initargs=(genome, packedReference))
         try:
             # Normal map has a bug if there is no timout that prevents Keyboard interrupts:
             # https://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool/1408476#1408476
@@ -147,16 +178,78 @@ def calc_all(variants, priors, genome, transcripts, processes):
             calculatedVariants = pool.map_async(calc_one, list(inputData)).get(99999999)
 
             # Sort output as the order of p.map is not deterministic
-            outputData.writerows(sorted(
-                calculatedVariants,
-                key=lambda d: "{0}:g.{1}:{2}>{3}".format(d["Chr"], d["Pos"], d["Ref"], d["Alt"])))
+            outputData.writerows(sorted(calculatedVariants, key=checkpoint.variantSortKey))
         except KeyboardInterrupt:
             pool.terminate()
     else:
-        outputData.writerows(sorted(
-            map(calc_one, inputData),
-            key=lambda d: "{0}:g.{1}:{2}>{3}".format(d["Chr"], d["Pos"], d["Ref"], d["Alt"])
-        ))
+        outputData.writerows(sorted(map(calc_one, inputData), key=checkpoint.variantSortKey))
+        click.echo("Sequence cache: {hits} hits, {misses} misses".format(**getSeqCacheStats()), err=True)
+        click.echo("MaxEntScan cache: {hits} hits, {misses} sequences scored".format(**getMaxEntScanCacheStats()),
+                   err=True)
+
+    if store is not None:
+        click.echo("Reused {} stored results from {}".format(len(reusedRows), resultStorePath), err=True)
+        store.close()
+
+
+def reuse_stored_results(store, inputData, reusedRows):
+    """
+    Yields the input rows without stored results, appending the rows with stored results
+    (with the stored prior fields added) to reusedRows
+    """
+    for row in inputData:
+        storedData = store.get(row)
+        if storedData is None:
+            yield row
+        else:
+            reusedRows.append(addVarDataToRow(storedData, row))
+
+
+def calc_checkpointed(inputData, outputData, fieldnames, genome, processes, packedReference, checkpointDir,
+                      chunkSize):
+    """
+    Calculates the input rows in shards of chunkSize rows, writing every shard to checkpointDir as soon as it
+    is done. Shards computed by a previous, failed or interrupted run on the same input are skipped.
+    Finally merges the shards into the output, sorted like the output of the other modes
+    """
+    if not os.path.isdir(checkpointDir):
+        os.makedirs(checkpointDir)
+    manifest = checkpoint.loadManifest(checkpointDir, fieldnames)
+
+    numShards = [0]
+    skipped = [0]
+
+    def pendingShards():
+        for index, rows in enumerate(checkpoint.iterShards(inputData, chunkSize)):
+            numShards[0] += 1
+            digest = checkpoint.shardDigest(rows)
+            if checkpoint.isShardDone(checkpointDir, manifest, index, digest):
+                skipped[0] += 1
+            else:
+                yield index, digest, rows
+
+    if processes > 1:
+        click.echo("Processing shards of {} variants using {} processes".format(chunkSize, processes), err=True)
+        pool = multiprocessing.Pool(processes, initializer=initSeqAccess, initargs=(genome, packedReference))
+        calculatedShards = pool.imap(calc_shard, pendingShards())
+    else:
+        pool = None
+        calculatedShards = (calc_shard(shard) for shard in pendingShards())
+
+    try:
+        for index, digest, calculatedRows in calculatedShards:
+            checkpoint.writeShard(checkpointDir, manifest, index, digest, calculatedRows)
+            click.echo("Finished shard {}".format(index), err=True)
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+
+    click.echo("Reused {} of {} shards from {}".format(skipped[0], numShards[0], checkpointDir), err=True)
+    outputData.writerows(checkpoint.mergeShards(checkpointDir, manifest, numShards[0]))
 
 
 def run(command):
@@ -176,9 +269,12 @@ def run(command):
               help="RefSeq annotation hg38-based genepred file")
 @click.option("--processes", type=int, default=8,
               help="Number of processes to use")
+@click.option("--packed-reference", type=click.Path(exists=True), default=None,
+              help="Packed reference file of the gene regions, used instead of the fasta file where possible")
 @click.pass_context
-def cli(ctx, genome, transcripts, processes):
-    ctx.obj = {"genome": genome, "transcripts": transcripts, "processes": processes}
+def cli(ctx, genome, transcripts, processes, packed_reference):
+    ctx.obj = {"genome": genome, "transcripts": transcripts, "processes": processes,
+               "packed_reference": packed_reference}
 
 
 @cli.command()
@@ -201,7 +297,7 @@ def test(ctx, length):
         pytest.main(["-p", "no:cacheprovider", "-x", "."])
         calc_all(click.open_file("tests/variants_%s.tsv" % length, mode="r"),
                  click.open_file("/tmp/priors_%s.tsv" % length, mode="w"),
-                 ctx.obj["genome"], ctx.obj["transcripts"], ctx.obj["processes"])
+                 ctx.obj["genome"], ctx.obj["transcripts"], ctx.obj["processes"], ctx.obj["packed_reference"])
 
     # FIXME: we unfortunately can't use the md5sum test until we've replaced the sums
     # 1) we changed the protein_priors resource file
@@ -222,11 +318,19 @@ def test(ctx, length):
 @cli.command()
 @click.argument("variants", type=click.File("r"))
 @click.argument("priors", type=click.File("w"))
+@click.option("--checkpoint-dir", type=click.Path(file_okay=False), default=None,
+              help="Directory for the shards of calculated variants, a rerun skips the shards already calculated")
+@click.option("--chunk-size", type=int, default=200,
+              help="Number of variants per shard when using a checkpoint directory")
+@click.option("--result-store", type=click.Path(dir_okay=False), default=None,
+              help="Store of calculated priors, only variants which are new or changed since the last run "
+                   "(or calculated by another version of the priors code) are calculated")
 @click.pass_context
-def calc(ctx, variants, priors):
+def calc(ctx, variants, priors, checkpoint_dir, chunk_size, result_store):
     with Benchmark("finished processing, duration"):
         calc_all(variants, priors,
-                 ctx.obj["genome"], ctx.obj["transcripts"], ctx.obj["processes"])
+                 ctx.obj["genome"], ctx.obj["transcripts"], ctx.obj["processes"], ctx.obj["packed_reference"],
+                 checkpointDir=checkpoint_dir, chunkSize=chunk_size, resultStorePath=result_store)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""
+Checkpointed computation of priors in shards of input rows.
+
+Every shard of calculated rows is written to its own file in the checkpoint directory as soon as it is done
+and recorded in a manifest, together with a digest of its input rows. A rerun on the same input skips the
+shards recorded in the manifest, so only the shards missing after a failure or an interrupt are computed again.
+"""
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import os
+
+MANIFEST_FILE = "manifest.json"
+
+
+def variantSortKey(row):
+    """Given a row of variant data, returns the key the output of calcVarPriors is sorted by"""
+    return "{0}:g.{1}:{2}>{3}".format(row["Chr"], row["Pos"], row["Ref"], row["Alt"])
+
+
+def iterShards(rows, shardSize):
+    """Given an iterable of rows, yields lists of shardSize consecutive rows (the last one may be shorter)"""
+    rows = iter(rows)
+    while True:
+        shard = list(itertools.islice(rows, shardSize))
+        if not shard:
+            return
+        yield shard
+
+
+def shardDigest(rows):
+    """Given the input rows of a shard, returns a digest identifying them"""
+    return hashlib.md5(json.dumps(rows, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def shardPath(checkpointDir, index):
+    return os.path.join(checkpointDir, "shard_%06d.tsv" % index)
+
+
+def loadManifest(checkpointDir, fieldnames):
+    """
+    Given checkpoint directory and output fieldnames, returns the manifest of the shards computed so far:
+    a dictionary with the fieldnames and the input digest of every computed shard by shard index (as string)
+    Shards computed for other output fieldnames are discarded
+    """
+    manifest = {"fieldnames": fieldnames, "shards": {}}
+    path = os.path.join(checkpointDir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            stored = json.load(f)
+        if stored["fieldnames"] == fieldnames:
+            manifest["shards"] = stored["shards"]
+    return manifest
+
+
+def saveManifest(checkpointDir, manifest):
+    """Writes the manifest, replacing the previous one atomically"""
+    path = os.path.join(checkpointDir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def isShardDone(checkpointDir, manifest, index, digest):
+    """Returns True if the shard with index was computed from input rows with the given digest"""
+    return manifest["shards"].get(str(index)) == digest and os.path.exists(shardPath(checkpointDir, index))
+
+
+def writeShard(checkpointDir, manifest, index, digest, calculatedRows):
+    """Writes the calculated rows of a shard sorted by variantSortKey and records the shard in the manifest"""
+    path = shardPath(checkpointDir, index)
+    with open(path + ".tmp", "w") as f:
+        writer = csv.DictWriter(f, delimiter="\t", lineterminator="\n", fieldnames=manifest["fieldnames"])
+        writer.writerows(sorted(calculatedRows, key=variantSortKey))
+    os.rename(path + ".tmp", path)
+    manifest["shards"][str(index)] = digest
+    saveManifest(checkpointDir, manifest)
+
+
+def readShard(checkpointDir, manifest, index):
+    with open(shardPath(checkpointDir, index), "r") as f:
+        for row in csv.DictReader(f, delimiter="\t", fieldnames=manifest["fieldnames"]):
+            yield row
+
+
+def mergeSorted(iterables):
+    """
+    Given iterables of rows sorted by variantSortKey, yields all rows sorted by variantSortKey
+    Rows with equal keys are yielded in the order of the iterables
+    """
+    def decorated(index, rows):
+        for position, row in enumerate(rows):
+            yield variantSortKey(row), index, position, row
+
+    for _, _, _, row in heapq.merge(*[decorated(index, rows) for index, rows in enumerate(iterables)]):
+        yield row
+
+
+def mergeShards(checkpointDir, manifest, numShards):
+    """Yields the rows of shards 0 to numShards - 1 sorted by variantSortKey, merging the shards in input order"""
+    return mergeSorted([readShard(checkpointDir, manifest, index) for index in range(numShards)])
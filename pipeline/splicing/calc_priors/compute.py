@@ -1,8 +1,8 @@
-import calcMaxEntScanMeanStd
 from calc_priors.constants import STD_ACC_INTRONIC_LENGTH, STD_ACC_EXONIC_LENGTH, STD_DE_NOVO_LENGTH, \
     STD_DONOR_INTRONIC_LENGTH, STD_DONOR_EXONIC_LENGTH, brca1CIDomains, brca2CIDomains, STD_EXONIC_PORTION, \
     STD_DONOR_SIZE, STD_ACC_SIZE
 from calc_priors import extract
+from calc_priors import maxentscan
 from calc_priors import verify
 
 
@@ -562,7 +562,7 @@ def getClosestSpliceSiteScores(variant, deNovoOffset, donor=True, deNovo=False,
                     "maxEntScanScore": "N/A",
                     "zScore": "N/A",
                     "genomicSplicePos": "N/A"}
-        closestMaxEntScanScore = calcMaxEntScanMeanStd.runMaxEntScan(refSeq, donor=donor)
+        closestMaxEntScanScore = maxentscan.getMaxEntScanScore(refSeq, donor=donor)
         closestZScore = extract.getZScore(closestMaxEntScanScore, donor=donor)
         return {"exonName": exonName,
                 "sequence": refSeq.upper(),
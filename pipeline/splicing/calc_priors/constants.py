@@ -82,3 +82,10 @@ BRCA_ZSCORES = {
     "donors": { "std": 2.3289956850167082, "mean": 7.9380909090909073 },
     "acceptors": { "std": 2.4336623152078452, "mean": 7.984909090909091 }
 }
+
+# reference genome and number of sequence slices cached per process by extract.getFastaSeq
+DEFAULT_GENOME = "/references/hg38.fa"
+SEQ_CACHE_SIZE = 4096
+
+# number of MaxEntScan scores cached per process by maxentscan.scoreMany
+MES_CACHE_SIZE = 65536
@@ -1,3 +1,4 @@
+import collections
 import json
 import os
 import re
@@ -6,10 +7,9 @@ import subprocess
 from Bio.Seq import Seq
 from pyfaidx import Fasta
 
-from calc_priors.constants import BRCA1_CANONICAL, BRCA2_CANONICAL, BRCA_ZSCORES
-from calc_priors import verify
-
-import calcMaxEntScanMeanStd
+from calc_priors.constants import BRCA1_CANONICAL, BRCA2_CANONICAL, BRCA_ZSCORES, DEFAULT_GENOME, SEQ_CACHE_SIZE
+from calc_priors import maxentscan, verify
+from calc_priors.packed_reference import PackedReference
 
 
 def getExonBoundaries(variant):
@@ -207,6 +207,62 @@ def getSpliceAcceptorBoundaries(variant, intronicLength, exonicLength):
     return acceptorBoundaries
 
 
+# Per process access to the reference genome, see initSeqAccess.
+# pyfaidx is NOT thread safe, hence every process opens its own handle.
+fastaPath = DEFAULT_GENOME
+fastaHandle = None
+
+# packed reference file of the gene regions, see setPackedReference
+packedReference = None
+
+# least recently used sequence slices by (chrom, regionStart, regionEnd, plusStrandSeq)
+seqCache = collections.OrderedDict()
+seqCacheSize = SEQ_CACHE_SIZE
+seqCacheStats = {"hits": 0, "misses": 0}
+
+
+def initSeqAccess(genome=DEFAULT_GENOME, packedReferencePath=None, cacheSize=SEQ_CACHE_SIZE):
+    """
+    Sets up sequence access for the current process, to be used as initializer of worker processes
+    genome is the path to the fasta file, opened once per process when first needed
+    packedReferencePath is an optional packed reference file, see setPackedReference
+    cacheSize is the maximal number of sequence slices cached by getFastaSeq
+    """
+    global fastaPath, fastaHandle, seqCacheSize
+    fastaPath = genome
+    fastaHandle = None
+    seqCacheSize = cacheSize
+    seqCache.clear()
+    seqCacheStats["hits"] = 0
+    seqCacheStats["misses"] = 0
+    setPackedReference(packedReferencePath)
+
+
+def setPackedReference(path):
+    """
+    Given path to a packed reference file (see pipeline/common/packed_reference.py), sequences covered
+    by it are served by getFastaSeq from the memory mapped file rather than from the fasta file
+    If path is None, all sequences are read from the fasta file
+    """
+    global packedReference
+    packedReference = PackedReference(path) if path else None
+
+
+def getFastaHandle():
+    """Returns the fasta file handle of the current process, opening it if needed"""
+    global fastaHandle
+    if fastaHandle is None:
+        fastaHandle = Fasta(fastaPath, sequence_always_upper=True)
+    return fastaHandle
+
+
+def getSeqCacheStats():
+    """Returns a dictionary with the number of hits and misses and the size of the sequence cache of the current process"""
+    return {"hits": seqCacheStats["hits"],
+            "misses": seqCacheStats["misses"],
+            "size": len(seqCache)}
+
+
 def getFastaSeq(chrom, rangeStart, rangeStop, plusStrandSeq=True):
     """
     Given chromosome (in format 'chr13'), region genomic start position, and
@@ -214,6 +270,7 @@ def getFastaSeq(chrom, rangeStart, rangeStop, plusStrandSeq=True):
     Returns a string containing the sequence inclusive of rangeStart and rangeStop
     If plusStrandSeq=True, returns plus strand sequence
     If plusStrandSeq=False, returns minus strand sequence
+    Sequences are cached, see initSeqAccess
     """
     if rangeStart < rangeStop:
         regionStart = rangeStart
@@ -222,10 +279,28 @@ def getFastaSeq(chrom, rangeStart, rangeStop, plusStrandSeq=True):
         regionStart = rangeStop
         regionEnd = rangeStart
 
-    # NOTE: pyfaidx is NOT thread safe. Would be better to have one
-    # REMIND: Switch to one per thread/process
-    hg38 = Fasta("/references/hg38.fa", sequence_always_upper=True)
-    sequence = hg38[chrom][regionStart - 1:regionEnd]
+    key = (chrom, regionStart, regionEnd, plusStrandSeq)
+    if key in seqCache:
+        seqCacheStats["hits"] += 1
+        # move to the end, as most recently used
+        sequence = seqCache.pop(key)
+        seqCache[key] = sequence
+        return sequence
+
+    seqCacheStats["misses"] += 1
+    sequence = readFastaSeq(chrom, regionStart, regionEnd, plusStrandSeq)
+    seqCache[key] = sequence
+    if len(seqCache) > seqCacheSize:
+        seqCache.popitem(last=False)
+    return sequence
+
+
+def readFastaSeq(chrom, regionStart, regionEnd, plusStrandSeq):
+    """Reads the sequence from regionStart to regionEnd (inclusive) from the packed reference or the fasta file"""
+    if packedReference is not None and packedReference.covers(chrom, regionStart, regionEnd):
+        return packedReference.getSeq(chrom, regionStart, regionEnd, plusStrandSeq=plusStrandSeq)
+
+    sequence = getFastaHandle()[chrom][regionStart - 1:regionEnd]
 
     if plusStrandSeq:
         return sequence.seq
@@ -287,6 +362,31 @@ def getAltSeq(altSeqDict, varStrand):
     return sequence
 
 
+def spliceAltSeq(variant, sequence, regionStart, varStrand):
+    """
+    Given a variant, the plus strand sequence (string or bytearray) of a region starting at regionStart
+    and the strand that the alternate allele is on
+    Returns a string of the sequence with the alternate allele in place of the reference allele
+    at the variant's genomic position, reverse complemented for minus strand variants
+    Gives the same sequence as getAltSeq(getAltSeqDict(variant, getSeqLocDict(...)), varStrand)
+    without building a dictionary with an entry per base
+    """
+    varRef = variant["Ref"]
+    varAlt = variant["Alt"]
+    varGenPos = int(variant["Pos"])
+    index = varGenPos - regionStart
+    if index < 0 or index >= len(sequence):
+        raise KeyError(varGenPos)
+    sequence = str(sequence.decode("ascii") if isinstance(sequence, bytearray) else sequence)
+    if sequence[index] != varRef:
+        raise ValueError("reference allele %s of variant at %s does not match the reference sequence base %s" %
+                         (varRef, varGenPos, sequence[index]))
+    altSeq = sequence[:index] + varAlt + sequence[index + 1:]
+    if varStrand == "-":
+        altSeq = str(Seq(altSeq).reverse_complement())
+    return altSeq
+
+
 def getRefAltSeqs(variant, rangeStart, rangeStop):
     """
     Given a variant, rangeStart, and rangeStop:
@@ -296,11 +396,12 @@ def getRefAltSeqs(variant, rangeStart, rangeStop):
     varStrand = verify.getVarStrand(variant)
     if varStrand == "-":
         refSeq = getFastaSeq(varChrom, rangeStart, rangeStop, plusStrandSeq=False)
+        regionStart, regionEnd = int(rangeStop), int(rangeStart)
     else:
         refSeq = getFastaSeq(varChrom, rangeStart, rangeStop, plusStrandSeq=True)
-    refSeqDict = getSeqLocDict(varChrom, varStrand, rangeStart, rangeStop)
-    altSeqDict = getAltSeqDict(variant, refSeqDict)
-    altSeq = getAltSeq(altSeqDict, varStrand)
+        regionStart, regionEnd = int(rangeStart), int(rangeStop)
+    plusStrandSeq = getFastaSeq(varChrom, regionStart, regionEnd, plusStrandSeq=True)
+    altSeq = spliceAltSeq(variant, plusStrandSeq, regionStart, varStrand)
     return {"refSeq": refSeq,
             "altSeq": altSeq}
 
@@ -348,16 +449,9 @@ def getRefAltScores(refSeq, altSeq, donor=False):
     Given ref and alt sequences and if sequence is in a splice donor region or not (True/False)
     Returns a dictionary containing raw MaxEntScan scores and zscores for ref and alt sequences
     """
-    if not donor:
-        refMaxEntScanScore = calcMaxEntScanMeanStd.runMaxEntScan(refSeq, donor=False)
-        refZScore = getZScore(refMaxEntScanScore, donor=False)
-        altMaxEntScanScore = calcMaxEntScanMeanStd.runMaxEntScan(altSeq, donor=False)
-        altZScore = getZScore(altMaxEntScanScore, donor=False)
-    else:
-        refMaxEntScanScore = calcMaxEntScanMeanStd.runMaxEntScan(refSeq, donor=True)
-        refZScore = getZScore(refMaxEntScanScore, donor=True)
-        altMaxEntScanScore = calcMaxEntScanMeanStd.runMaxEntScan(altSeq, donor=True)
-        altZScore = getZScore(altMaxEntScanScore, donor=True)
+    refMaxEntScanScore, altMaxEntScanScore = maxentscan.scoreMany([refSeq, altSeq], donor=donor)
+    refZScore = getZScore(refMaxEntScanScore, donor=donor)
+    altZScore = getZScore(altMaxEntScanScore, donor=donor)
 
     scoreDict = {"refScores": {"maxEntScanScore": refMaxEntScanScore,
                                "zScore": refZScore},
@@ -397,23 +491,26 @@ def getMaxEntScanScoresSlidingWindowSNS(variant, windowSize, donor=False):
     altSeq = refAltSeqs["altSeq"]
     windowStart = 0
     windowSeqs = {}
-    windowScores = {}
-    windowAltMaxEntScanScores = {}
     while windowStart < totalPositions:
-        refWindowSeq = refSeq[windowStart:windowEnd]
-        altWindowSeq = altSeq[windowStart:windowEnd]
-        windowSeqs[varPos] = {"refSeq": refWindowSeq,
-                              "altSeq": altWindowSeq}
-        refAltWindowScores = getRefAltScores(refWindowSeq, altWindowSeq, donor=donor)
-        windowScores[varPos] = {"refMaxEntScanScore": refAltWindowScores["refScores"]["maxEntScanScore"],
-                                "refZScore": refAltWindowScores["refScores"]["zScore"],
-                                "altMaxEntScanScore": refAltWindowScores["altScores"]["maxEntScanScore"],
-                                "altZScore": refAltWindowScores["altScores"]["zScore"]}
-        windowAltMaxEntScanScores[varPos] = refAltWindowScores["altScores"]["maxEntScanScore"]
+        windowSeqs[varPos] = {"refSeq": refSeq[windowStart:windowEnd],
+                              "altSeq": altSeq[windowStart:windowEnd]}
         varPos -= 1
         windowStart += 1
         windowEnd += 1
 
+    # score the ref and alt sequences of all windows at once, windows shared with neighbouring variants are cached
+    positions = sorted(windowSeqs.keys())
+    refScores = maxentscan.scoreMany([windowSeqs[pos]["refSeq"] for pos in positions], donor=donor)
+    altScores = maxentscan.scoreMany([windowSeqs[pos]["altSeq"] for pos in positions], donor=donor)
+    windowScores = {}
+    windowAltMaxEntScanScores = {}
+    for pos, refMaxEntScanScore, altMaxEntScanScore in zip(positions, refScores, altScores):
+        windowScores[pos] = {"refMaxEntScanScore": refMaxEntScanScore,
+                             "refZScore": getZScore(refMaxEntScanScore, donor=donor),
+                             "altMaxEntScanScore": altMaxEntScanScore,
+                             "altZScore": getZScore(altMaxEntScanScore, donor=donor)}
+        windowAltMaxEntScanScores[pos] = altMaxEntScanScore
+
     return {"windowSeqs": windowSeqs,
             "windowScores": windowScores,
             "windowAltMaxEntScanScores": windowAltMaxEntScanScores}
@@ -0,0 +1,153 @@
+"""
+Memoized MaxEntScan scoring of splice donor (9 bp) and splice acceptor (23 bp) sequences.
+
+SNVs at adjacent positions share most of their sliding windows, hence scores are cached per
+process by (sequence, donor). Sequences missing from the cache are scored as a batch with NumPy
+lookups into the MaxEntScan models used by score5.pl and score3.pl (me2x5 and splicemodels/me2x3acc1-9),
+which are the models maxentpy ships as well. Sequences which can't be scored that way
+(other length or bases than ACGT) are passed on to calcMaxEntScanMeanStd.runMaxEntScan.
+"""
+import collections
+import math
+import os
+
+import numpy as np
+
+from calc_priors.constants import MES_CACHE_SIZE, STD_ACC_SIZE, STD_DONOR_SIZE
+
+import calcMaxEntScanMeanStd
+
+SPLICE_MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# base -> index into the arrays below, 255 for bases other than ACGT
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.lower())] = code
+
+# background and consensus dinucleotide base frequencies (A, C, G, T), see scoreconsensus in score5.pl and score3.pl
+BACKGROUND = np.array([0.27, 0.23, 0.23, 0.27])
+DONOR_CONSENSUS = (np.array([0.004, 0.0032, 0.9896, 0.0032]), np.array([0.0034, 0.0039, 0.0042, 0.9884]))
+ACCEPTOR_CONSENSUS = (np.array([0.9903, 0.0032, 0.0034, 0.0030]), np.array([0.0027, 0.0037, 0.9905, 0.0030]))
+
+# (start, length) of the subsequences of the acceptor sequence without consensus scored by me2x3acc1-9,
+# see maxentscore in score3.pl
+ACCEPTOR_SUBSEQUENCES = [(0, 7), (7, 7), (14, 7), (4, 7), (11, 7), (4, 3), (7, 4), (11, 3), (14, 4)]
+
+# lazily loaded by loadModels
+donorModel = None
+acceptorModels = None
+
+# least recently used scores by (sequence, donor)
+scoreCache = collections.OrderedDict()
+scoreCacheSize = MES_CACHE_SIZE
+scoreCacheStats = {"hits": 0, "misses": 0}
+
+
+def initMaxEntScanCache(cacheSize=MES_CACHE_SIZE):
+    """Empties the score cache of the current process, keeping at most cacheSize scores from now on"""
+    global scoreCacheSize
+    scoreCacheSize = cacheSize
+    scoreCache.clear()
+    scoreCacheStats["hits"] = 0
+    scoreCacheStats["misses"] = 0
+
+
+def getMaxEntScanCacheStats():
+    """Returns a dictionary with the number of hits and misses and the size of the score cache of the current process"""
+    return {"hits": scoreCacheStats["hits"],
+            "misses": scoreCacheStats["misses"],
+            "size": len(scoreCache)}
+
+
+def loadModels():
+    """Loads the donor model and the acceptor models, one score per base 4 hash of a subsequence"""
+    global donorModel, acceptorModels
+    if donorModel is None:
+        donorModel = np.loadtxt(os.path.join(SPLICE_MODELS_DIR, "me2x5"))
+        acceptorModels = [np.loadtxt(os.path.join(SPLICE_MODELS_DIR, "splicemodels", "me2x3acc%d" % i))
+                          for i in range(1, 10)]
+    return donorModel, acceptorModels
+
+
+def hashSubsequences(codes, start, length):
+    """Given a matrix of base codes (one row per sequence), returns the base 4 hashes of the columns start to start + length"""
+    weights = 4 ** np.arange(length - 1, -1, -1)
+    return codes[:, start:start + length].astype(np.int64).dot(weights)
+
+
+def isScorable(sequence, donor):
+    """Returns True if the sequence has the length of a donor or acceptor sequence and consists of ACGT only"""
+    if len(sequence) != (STD_DONOR_SIZE if donor else STD_ACC_SIZE):
+        return False
+    return not (BASE_CODES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)] == 255).any()
+
+
+def scoreBatch(sequences, donor=False):
+    """
+    Given a list of splice donor (donor=True) or splice acceptor (donor=False) sequences consisting of ACGT only
+    Returns a list of their MaxEntScan scores, rounded to two decimal places like runMaxEntScan
+    """
+    donorModel, acceptorModels = loadModels()
+    raw = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)
+    codes = BASE_CODES[raw].reshape(len(sequences), -1)
+
+    if donor:
+        cons1, cons2 = DONOR_CONSENSUS
+        consensusStart = 3
+        rest = np.hstack([codes[:, :3], codes[:, 5:]])
+        restScores = donorModel[hashSubsequences(rest, 0, 7)]
+    else:
+        cons1, cons2 = ACCEPTOR_CONSENSUS
+        consensusStart = 18
+        rest = np.hstack([codes[:, :18], codes[:, 20:]])
+        subScores = [model[hashSubsequences(rest, start, length)]
+                     for model, (start, length) in zip(acceptorModels, ACCEPTOR_SUBSEQUENCES)]
+        restScores = (subScores[0] * subScores[1] * subScores[2] * subScores[3] * subScores[4] /
+                      (subScores[5] * subScores[6] * subScores[7] * subScores[8]))
+
+    first, second = codes[:, consensusStart], codes[:, consensusStart + 1]
+    consensusScores = cons1[first] * cons2[second] / (BACKGROUND[first] * BACKGROUND[second])
+    return [round(math.log(score, 2), 2) for score in (consensusScores * restScores).tolist()]
+
+
+def scoreMany(sequences, donor=False):
+    """
+    Given a list of splice donor (donor=True) or splice acceptor (donor=False) sequences
+    Returns a list of their MaxEntScan scores, scoring only the distinct sequences missing from the cache
+    """
+    sequences = [str(sequence) for sequence in sequences]
+    scores = {}
+    missing = []
+    for sequence in sequences:
+        key = (sequence, donor)
+        if key in scores:
+            continue
+        if key in scoreCache:
+            scoreCacheStats["hits"] += 1
+            # move to the end, as most recently used
+            scores[key] = scoreCache.pop(key)
+            scoreCache[key] = scores[key]
+        else:
+            scores[key] = None
+            missing.append(sequence)
+
+    scoreCacheStats["misses"] += len(missing)
+    batch = [sequence for sequence in missing if isScorable(sequence, donor)]
+    if batch:
+        for sequence, score in zip(batch, scoreBatch(batch, donor=donor)):
+            scores[(sequence, donor)] = score
+    for sequence in missing:
+        key = (sequence, donor)
+        if scores[key] is None:
+            scores[key] = calcMaxEntScanMeanStd.runMaxEntScan(sequence, donor=donor)
+        scoreCache[key] = scores[key]
+        if len(scoreCache) > scoreCacheSize:
+            scoreCache.popitem(last=False)
+
+    return [scores[(sequence, donor)] for sequence in sequences]
+
+
+def getMaxEntScanScore(sequence, donor=False):
+    """Given a splice donor (donor=True) or splice acceptor (donor=False) sequence, returns its (cached) MaxEntScan score"""
+    return scoreMany([sequence], donor=donor)[0]
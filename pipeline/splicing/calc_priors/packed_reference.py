@@ -0,0 +1,90 @@
+"""
+Read-only access to a packed reference file compiled by pipeline/common/packed_reference.py,
+which also describes the file format.
+
+The file is memory mapped, hence forked worker processes share it through the OS
+page cache and bases are only decoded for the requested region.
+"""
+import bisect
+import json
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b'BXPKREF1'
+HEADER_LENGTH_FORMAT = '<Q'
+
+CODE_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT_BASES = np.arange(256, dtype=np.uint8)
+for base, complement in zip("ACGTRYKMBDHVN", "TGCAYRMKVHDBN"):
+    COMPLEMENT_BASES[ord(base)] = ord(complement)
+
+
+class PackedReference(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a packed reference file" % path)
+        headerStart = len(MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT)
+        headerLength = struct.unpack(HEADER_LENGTH_FORMAT, self._mmap[len(MAGIC):headerStart])[0]
+        header = json.loads(self._mmap[headerStart:headerStart + headerLength].decode("ascii"))
+        dataStart = headerStart + headerLength
+
+        # chromosome (e.g. '13') -> sorted list of (start, end, packed bases, runs of non ACGT bases)
+        self._regions = {}
+        for region in header["regions"]:
+            nBytes = -(-(region["end"] - region["start"]) // 4)
+            packed = np.frombuffer(self._mmap, dtype=np.uint8, count=nBytes, offset=dataStart + region["offset"])
+            self._regions.setdefault(str(region["chr"]), []).append(
+                (region["start"], region["end"], packed, region["runs"]))
+        for chromRegions in self._regions.values():
+            chromRegions.sort(key=lambda r: r[0])
+        self._regionStarts = dict((c, [r[0] for r in regions]) for c, regions in self._regions.items())
+
+    def _findRegion(self, chrom, regionStart, regionEnd):
+        chrom = str(chrom)
+        if chrom.startswith("chr"):
+            chrom = chrom[3:]
+        if chrom not in self._regions:
+            return None
+        i = bisect.bisect_right(self._regionStarts[chrom], regionStart) - 1
+        if i < 0 or regionEnd >= self._regions[chrom][i][1]:
+            return None
+        return self._regions[chrom][i]
+
+    def covers(self, chrom, regionStart, regionEnd):
+        """Returns True if the region from regionStart to regionEnd (inclusive) is contained in the file"""
+        return self._findRegion(chrom, regionStart, regionEnd) is not None
+
+    def getSeq(self, chrom, regionStart, regionEnd, plusStrandSeq=True):
+        """
+        Given chromosome (e.g. 'chr13'), region genomic start position, and region genomic end position:
+        Returns a string containing the sequence inclusive of regionStart and regionEnd
+        If plusStrandSeq=False, returns the reverse complement
+        """
+        region = self._findRegion(chrom, regionStart, regionEnd)
+        if region is None:
+            raise ValueError("%s:%s-%s is not covered by %s" % (chrom, regionStart, regionEnd, self.path))
+        start, _, packed, runs = region
+        first = regionStart - start
+        end = regionEnd - start + 1
+
+        firstByte = first // 4
+        packedBytes = packed[firstByte:(end - 1) // 4 + 1]
+        codes = np.stack([packedBytes >> 6, (packedBytes >> 4) & 3, (packedBytes >> 2) & 3, packedBytes & 3],
+                         axis=1).ravel()
+        bases = CODE_BASES[codes[first - firstByte * 4:end - firstByte * 4]]
+
+        # restore bases not being one of ACGT
+        for runStart, runLength, base in runs:
+            s, e = max(runStart, first), min(runStart + runLength, end)
+            if s < e:
+                bases[s - first:e - first] = ord(base)
+
+        if not plusStrandSeq:
+            bases = COMPLEMENT_BASES[bases][::-1]
+        return str(bases.tobytes().decode("ascii"))
@@ -0,0 +1,108 @@
+"""
+Persistent store of calculated priors, so that a run only calculates the variants which are new or changed.
+
+Results are keyed by a digest of the input fields read by calcVarPriors.getVarData. They are only valid for
+the version of the priors code, MaxEntScan models, zscore constants, protein prior reports and reference inputs
+(genome, transcripts and packed reference) which produced them (see priorsVersion), results of other versions
+are dropped when the store is opened.
+"""
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+
+from calc_priors.checkpoint import mergeSorted, variantSortKey
+from calc_priors.constants import BRCA_ZSCORES
+
+SPLICING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# fields of an input row read by calcVarPriors.getVarData
+INPUT_FIELDS = ["Chr", "Pos", "Ref", "Alt", "Gene_Symbol", "Reference_Sequence", "HGVS_cDNA", "pyhgvs_cDNA",
+                "Hg38_Start", "Hg38_End"]
+
+# files determining the calculated priors besides the input fields
+VERSIONED_FILES = ["calcVarPriors.py", "calcMaxEntScanMeanStd.py", "headers.tsv", "me2x5",
+                   "calc_priors/*.py", "splicemodels/me2x3acc*", "references/HCI_AllPriorsReport_*.txt"]
+
+
+def variantDigest(variant):
+    """Given an input row, returns a digest of the fields read by getVarData"""
+    return hashlib.md5(json.dumps([variant.get(field) for field in INPUT_FIELDS]).encode("utf-8")).hexdigest()
+
+
+def fileDigest(path, chunkSize=1024 * 1024):
+    """Returns the digest of the content of the file at path, read in chunks as the genome is large"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def priorsVersion(references=None):
+    """
+    Returns a digest of the priors code, MaxEntScan models, zscore constants and protein prior reports, and of the
+    reference inputs given as dict from input name (e.g. "genome") to digest of its content
+    """
+    version = hashlib.md5(json.dumps([BRCA_ZSCORES, references or {}], sort_keys=True).encode("utf-8"))
+    for pattern in VERSIONED_FILES:
+        for path in sorted(glob.glob(os.path.join(SPLICING_DIR, pattern))):
+            version.update(os.path.relpath(path, SPLICING_DIR).encode("utf-8"))
+            with open(path, "rb") as f:
+                version.update(f.read())
+    return version.hexdigest()
+
+
+class ResultStore(object):
+    def __init__(self, path, version=None):
+        """
+        Given path to the sqlite store (created if missing) and version of the results (default priorsVersion()),
+        opens the store, dropping the results of all other versions
+        """
+        self.path = path
+        self.version = version or priorsVersion()
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS priors "
+                         "(digest TEXT PRIMARY KEY, version TEXT NOT NULL, data TEXT NOT NULL)")
+        self._db.execute("DELETE FROM priors WHERE version != ?", (self.version,))
+        self._db.commit()
+
+    def get(self, variant):
+        """Given an input row, returns the dictionary of stored prior fields or None if there is none"""
+        row = self._db.execute("SELECT data FROM priors WHERE digest = ? AND version = ?",
+                               (variantDigest(variant), self.version)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, calculatedRow, fields):
+        """Given a calculated row (input fields plus prior fields), stores its values of fields"""
+        data = dict((field, calculatedRow[field]) for field in fields if field in calculatedRow)
+        self._db.execute("INSERT OR REPLACE INTO priors (digest, version, data) VALUES (?, ?, ?)",
+                         (variantDigest(calculatedRow), self.version, json.dumps(data, sort_keys=True)))
+
+    def storeAll(self, calculatedRows, fields):
+        """Stores the calculated rows while passing them on, committing once all of them are stored"""
+        for row in calculatedRows:
+            self.put(row, fields)
+            yield row
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class StoredResultsWriter(object):
+    """
+    Wraps a csv.DictWriter of the priors output: stores the calculated rows passed to writerows (sorted by
+    variantSortKey) and writes them merged with the rows reused from the store
+    """
+    def __init__(self, writer, store, reusedRows, fields):
+        self.writer = writer
+        self.store = store
+        self.reusedRows = reusedRows
+        self.fields = fields
+
+    def writerows(self, calculatedRows):
+        calculatedRows = self.store.storeAll(calculatedRows, self.fields)
+        self.writer.writerows(mergeSorted([sorted(self.reusedRows, key=variantSortKey), calculatedRows]))
@@ -3,7 +3,7 @@ import unittest
 
 from calcMaxEntScanMeanStd import runMaxEntScan
 from calcVarPriors import getVarData
-from calc_priors import extract, compute
+from calc_priors import extract, compute, maxentscan
 
 
 class test_calcMaxEndScanMeanStd(unittest.TestCase):
@@ -16,6 +16,17 @@ class test_calcMaxEndScanMeanStd(unittest.TestCase):
         self.assertEqual(non_perl, 10.86)
         self.assertEqual(perl, 10.86)
 
+    def test_MES_batch_vs_perl(self):
+        """
+        Compares the MES values of a batch scored with NumPy against the reference perl implementation
+        """
+        donors = ['cagGTAAGT', 'TCGGTAAGA', 'CTGCTGGCT', 'AAAATGCCT']
+        acceptors = ['TTTCTTTTCTTTTTTTTCAGGTG', 'ATTATTTTTCTATAATTTAGAAA', 'acagcatttctacagGATGGCCG']
+        self.assertEqual(maxentscan.scoreBatch(donors, donor=True),
+                         [runMaxEntScan(seq, donor=True, usePerl=True) for seq in donors])
+        self.assertEqual(maxentscan.scoreBatch(acceptors, donor=False),
+                         [runMaxEntScan(seq, donor=False, usePerl=True) for seq in acceptors])
+
     def compare_MSE(self, compare_type, long_test=False):
         """
         Uses the priors_short (or tests/priors_long) file to test runMaxEntScan's MES values against precomputed
@@ -1,10 +1,18 @@
+import json
+import os
+import struct
+import tempfile
 import unittest
 import mock
 import calcVarPriors
+import calc_priors.checkpoint
 import calc_priors.compute
 import calc_priors.dataproc
 import calc_priors.extract
+import calc_priors.maxentscan
+import calc_priors.packed_reference
 import calc_priors.priors
+import calc_priors.resultstore
 import calc_priors.verify
 from calc_priors.constants import STD_DONOR_INTRONIC_LENGTH, STD_DONOR_EXONIC_LENGTH, STD_ACC_INTRONIC_LENGTH, \
     STD_ACC_EXONIC_LENGTH, STD_EXONIC_PORTION, STD_DE_NOVO_LENGTH, STD_DE_NOVO_OFFSET, BRCA1_RefSeq, BRCA2_RefSeq
@@ -1494,6 +1502,56 @@ class test_calcVarPriors(unittest.TestCase):
         varLoc = calc_priors.compute.getVarLocation(self.variant, boundaries)
         self.assertEquals(varLoc, variantLocations["afterGreyZone"])
 
+    @mock.patch('calc_priors.extract.Fasta')
+    def test_getFastaSeqCache(self, Fasta):
+        '''
+        Tests that the fasta file is opened once per process and that sequence slices are cached
+        '''
+        calc_priors.extract.initSeqAccess("hg38.fa", cacheSize=2)
+        try:
+            calc_priors.extract.getFastaSeq("chr13", 32370936, 32370958)
+            # same region, given in reverse order
+            calc_priors.extract.getFastaSeq("chr13", 32370958, 32370936)
+            calc_priors.extract.getFastaSeq("chr13", 32370936, 32370958, plusStrandSeq=False)
+            # evicts the least recently used region
+            calc_priors.extract.getFastaSeq("chr17", 43051115, 43051137)
+            calc_priors.extract.getFastaSeq("chr13", 32370936, 32370958)
+
+            Fasta.assert_called_once_with("hg38.fa", sequence_always_upper=True)
+            self.assertEquals(calc_priors.extract.getSeqCacheStats(), {"hits": 1, "misses": 4, "size": 2})
+        finally:
+            calc_priors.extract.initSeqAccess()
+
+    def test_getFastaSeqPackedReference(self):
+        '''
+        Tests that sequences covered by a packed reference file are served from there, on both strands
+        '''
+        seq = "ACGTTGCANNACG"
+        regionStart = 32370930
+        packed = bytearray()
+        for i in range(0, len(seq), 4):
+            byte = 0
+            for j, base in enumerate(seq[i:i + 4].ljust(4, "A")):
+                byte |= "ACGT".find(base) % 4 << (6 - 2 * j)
+            packed.append(byte)
+        header = json.dumps({"regions": [{"chr": "13", "start": regionStart, "end": regionStart + len(seq),
+                                          "offset": 0, "runs": [[8, 2, "N"]]}]}).encode("ascii")
+        packedFile = tempfile.NamedTemporaryFile(suffix=".pack")
+        packedFile.write(calc_priors.packed_reference.MAGIC + struct.pack("<Q", len(header)) + header + bytes(packed))
+        packedFile.flush()
+
+        calc_priors.extract.setPackedReference(packedFile.name)
+        try:
+            self.assertEquals(calc_priors.extract.getFastaSeq("chr13", regionStart + 1, regionStart + 9), "CGTTGCANN")
+            self.assertEquals(calc_priors.extract.getFastaSeq("chr13", regionStart + 9, regionStart + 1,
+                                                              plusStrandSeq=False), "NNTGCAACG")
+            self.assertTrue(calc_priors.extract.packedReference.covers("chr13", regionStart, regionStart + 12))
+            self.assertFalse(calc_priors.extract.packedReference.covers("chr13", regionStart, regionStart + 13))
+            self.assertFalse(calc_priors.extract.packedReference.covers("chr17", regionStart, regionStart + 1))
+        finally:
+            calc_priors.extract.setPackedReference(None)
+            packedFile.close()
+
     @mock.patch('calc_priors.extract.getFastaSeq', return_value=brca1Seq)
     def test_getSeqLocDictBRCA1(self, getFastaSeq):
         '''
@@ -1638,6 +1696,73 @@ class test_calcVarPriors(unittest.TestCase):
         self.assertEquals(refAltSeqs["refSeq"], brca2RefSeq)
         self.assertEquals(refAltSeqs["altSeq"], brca2AltSeq)
 
+    @mock.patch('calc_priors.extract.getFastaSeq', return_value=brca1Seq)
+    def test_spliceAltSeqBRCA1(self, getFastaSeq):
+        '''Tests that alt sequence spliced for - strand gene (BRCA1) equals the one built from the sequence dictionary'''
+        strand = "-"
+        rangeStart = 43051137
+        rangeStop = 43051115
+        self.variant["Pos"] = "43051120"
+        self.variant["Ref"] = "G"
+        self.variant["Alt"] = "C"
+        altSeqDict = calc_priors.extract.getAltSeqDict(self.variant,
+                                                       calc_priors.extract.getSeqLocDict("chr17", strand, rangeStart, rangeStop))
+        altSeq = calc_priors.extract.spliceAltSeq(self.variant, brca1Seq, rangeStop, strand)
+        self.assertEquals(altSeq, calc_priors.extract.getAltSeq(altSeqDict, strand))
+        self.assertEquals(altSeq, "CTCTTCCTCTCTTCTTCGAGATC")
+        self.assertEquals(calc_priors.extract.spliceAltSeq(self.variant, bytearray(brca1Seq), rangeStop, strand),
+                          altSeq)
+
+    @mock.patch('calc_priors.extract.getFastaSeq', return_value=brca2Seq)
+    def test_spliceAltSeqBRCA2(self, getFastaSeq):
+        '''Tests that alt sequence spliced for + strand gene (BRCA2) equals the one built from the sequence dictionary'''
+        strand = "+"
+        rangeStart = 32370936
+        rangeStop = 32370958
+        self.variant["Alt"] = "C"
+        seqLocDict = calc_priors.extract.getSeqLocDict("chr13", strand, rangeStart, rangeStop)
+        for pos in [rangeStart, 32370944, rangeStop]:
+            self.variant["Pos"] = str(pos)
+            self.variant["Ref"] = seqLocDict[pos]
+            altSeqDict = calc_priors.extract.getAltSeqDict(self.variant, seqLocDict)
+            self.assertEquals(calc_priors.extract.spliceAltSeq(self.variant, brca2Seq, rangeStart, strand),
+                              calc_priors.extract.getAltSeq(altSeqDict, strand))
+
+    def test_spliceAltSeqRefMismatch(self):
+        '''Tests that reference allele not matching the sequence or variant outside of the sequence are rejected'''
+        self.variant["Pos"] = "32370944"
+        self.variant["Ref"] = "G"
+        self.variant["Alt"] = "C"
+        with self.assertRaises(ValueError):
+            calc_priors.extract.spliceAltSeq(self.variant, brca2Seq, 32370936, "+")
+        self.variant["Pos"] = "32370959"
+        with self.assertRaises(KeyError):
+            calc_priors.extract.spliceAltSeq(self.variant, brca2Seq, 32370936, "+")
+
+    @mock.patch('calcMaxEntScanMeanStd.runMaxEntScan', return_value=-20.0)
+    @mock.patch('calc_priors.maxentscan.scoreBatch', side_effect=lambda seqs, donor: [float(len(set(seq))) for seq in seqs])
+    def test_scoreManyCache(self, scoreBatch, runMaxEntScan):
+        '''
+        Tests that distinct sequences missing from the MaxEntScan score cache are scored once as a batch,
+        sequences that can't be batched are scored by runMaxEntScan and least recently used scores are evicted
+        '''
+        calc_priors.maxentscan.initMaxEntScanCache(cacheSize=3)
+        try:
+            scores = calc_priors.maxentscan.scoreMany(["CAGGTAAGT", "CAGGTAAGT", "AAAAAAAAA", "CAGGNAAGT"], donor=True)
+            self.assertEquals(scores, [4.0, 4.0, 1.0, -20.0])
+            scoreBatch.assert_called_once_with(["CAGGTAAGT", "AAAAAAAAA"], donor=True)
+            runMaxEntScan.assert_called_once_with("CAGGNAAGT", donor=True)
+
+            self.assertEquals(calc_priors.maxentscan.getMaxEntScanScore("CAGGTAAGT", donor=True), 4.0)
+            # scores are cached separately for donors and acceptors, evicts "AAAAAAAAA"
+            self.assertEquals(calc_priors.maxentscan.getMaxEntScanScore("CAGGTAAGT", donor=False), -20.0)
+            self.assertEquals(calc_priors.maxentscan.getMaxEntScanScore("AAAAAAAAA", donor=True), 1.0)
+
+            self.assertEquals(scoreBatch.call_count, 2)
+            self.assertEquals(calc_priors.maxentscan.getMaxEntScanCacheStats(), {"hits": 1, "misses": 5, "size": 3})
+        finally:
+            calc_priors.maxentscan.initMaxEntScanCache()
+
     def test_getVarSeqIndexSNSDiffLengths(self):
         '''Tests that function returns "N/A" for ref and alt seqs of different lengths'''
         refSeq = "ACTGTACTC"
@@ -8766,3 +8891,93 @@ class test_calcVarPriors(unittest.TestCase):
         self.assertEquals(varDict["varChrom"], self.variant["Chr"])
         self.assertEquals(varDict["varGene"], self.variant["Gene_Symbol"])
         self.assertEquals(varDict["varGenCoordinate"], self.variant["Pos"])
+
+    def test_calcCheckpointedResume(self):
+        '''
+        Tests that shards computed by a failed run are reused by the next run
+        and that the merged output is sorted like the output of the other modes
+        '''
+        fieldnames = ["Chr", "Pos", "Ref", "Alt", "applicablePrior"]
+        rows = [{"Chr": "13", "Pos": str(pos), "Ref": "A", "Alt": alt}
+                for pos, alt in [(32370944, "C"), (32316461, "G"), (32370944, "T"), (32326584, "T"), (32316461, "C")]]
+
+        def calcOne(row):
+            if row["Pos"] == "32326584":
+                raise ValueError("failed")
+            return dict(row, applicablePrior=0.02)
+
+        checkpointDir = tempfile.mkdtemp()
+        output = mock.MagicMock()
+        with mock.patch('calcVarPriors.calc_one', side_effect=calcOne) as calcOneMock:
+            with self.assertRaises(ValueError):
+                calcVarPriors.calc_checkpointed(iter(rows), output, fieldnames, GENOME, 1, None, checkpointDir, 2)
+            self.assertEquals(calcOneMock.call_count, 4)
+            output.writerows.assert_not_called()
+
+        with mock.patch('calcVarPriors.calc_one', side_effect=lambda row: dict(row, applicablePrior=0.5)) as calcOneMock:
+            calcVarPriors.calc_checkpointed(iter(rows), output, fieldnames, GENOME, 1, None, checkpointDir, 2)
+            # only the shard with the failed variant and the last shard are calculated again
+            self.assertEquals(calcOneMock.call_count, 3)
+
+        merged = list(output.writerows.call_args[0][0])
+        self.assertEquals([calc_priors.checkpoint.variantSortKey(row) for row in merged],
+                          sorted(calc_priors.checkpoint.variantSortKey(row) for row in rows))
+        self.assertEquals([row["applicablePrior"] for row in merged], ["0.5", "0.02", "0.5", "0.02", "0.5"])
+
+    def test_priorsVersionOfReferences(self):
+        '''Tests that the priors version depends on the content of the reference inputs'''
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, name) for name in ["a.fa", "b.fa", "c.fa"]]
+        for path, content in zip(paths, [">chr13\nACGT\n", ">chr13\nACGT\n", ">chr13\nACGA\n"]):
+            with open(path, "w") as f:
+                f.write(content)
+        digests = [calc_priors.resultstore.fileDigest(path, chunkSize=3) for path in paths]
+
+        self.assertEquals(digests[0], digests[1])
+        self.assertNotEquals(digests[0], digests[2])
+        self.assertEquals(calc_priors.resultstore.priorsVersion({"genome": digests[0]}),
+                          calc_priors.resultstore.priorsVersion({"genome": digests[1]}))
+        self.assertNotEquals(calc_priors.resultstore.priorsVersion({"genome": digests[0]}),
+                             calc_priors.resultstore.priorsVersion({"genome": digests[2]}))
+        self.assertNotEquals(calc_priors.resultstore.priorsVersion({"genome": digests[0]}),
+                             calc_priors.resultstore.priorsVersion())
+
+    def test_resultStoreReuse(self):
+        '''
+        Tests that stored results are reused for unchanged variants of the same priors version only
+        and that calculated rows are stored and written merged with the reused rows
+        '''
+        path = os.path.join(tempfile.mkdtemp(), "priors.sqlite")
+        fields = ["applicablePrior", "varLoc"]
+        rows = [{"Chr": "13", "Pos": str(pos), "Ref": "A", "Alt": "C", "Gene_Symbol": "BRCA2"}
+                for pos in [32370944, 32316461, 32326584]]
+
+        store = calc_priors.resultstore.ResultStore(path, version="1")
+        writer = mock.MagicMock()
+        reusedRows = []
+        pendingRows = list(calcVarPriors.reuse_stored_results(store, iter(rows), reusedRows))
+        self.assertEquals((len(pendingRows), reusedRows), (3, []))
+        calculatedRows = [dict(row, applicablePrior=0.02, varLoc="exon_variant") for row in pendingRows[:2]]
+        calc_priors.resultstore.StoredResultsWriter(writer, store, reusedRows, fields).writerows(
+            sorted(calculatedRows, key=calc_priors.checkpoint.variantSortKey))
+        self.assertEquals(len(list(writer.writerows.call_args[0][0])), 2)
+        store.close()
+
+        # a changed variant is calculated again
+        rows[0]["Alt"] = "G"
+        store = calc_priors.resultstore.ResultStore(path, version="1")
+        reusedRows = []
+        pendingRows = list(calcVarPriors.reuse_stored_results(store, iter(rows), reusedRows))
+        self.assertEquals([row["Pos"] for row in pendingRows], ["32370944", "32326584"])
+        self.assertEquals(reusedRows, [dict(rows[1], applicablePrior=0.02, varLoc="exon_variant")])
+        calculatedRows = [dict(row, applicablePrior=0.5, varLoc="intron_variant") for row in pendingRows]
+        calc_priors.resultstore.StoredResultsWriter(writer, store, reusedRows, fields).writerows(
+            sorted(calculatedRows, key=calc_priors.checkpoint.variantSortKey))
+        self.assertEquals([(row["Pos"], row["applicablePrior"]) for row in writer.writerows.call_args[0][0]],
+                          [("32316461", 0.02), ("32326584", 0.5), ("32370944", 0.5)])
+        store.close()
+
+        # results of other versions are dropped
+        store = calc_priors.resultstore.ResultStore(path, version="2")
+        self.assertEquals([store.get(row) for row in rows], [None, None, None])
+        store.close()
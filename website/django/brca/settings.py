@@ -85,6 +85,30 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'wsgi.application'
 
+# Responses of the release data views are cached in the 'responses' cache (see cache_per_release in
+# data/utilities.py). Each process has its own cache by default, site_settings.py can define CACHES with a
+# cache shared by all processes instead, e.g. django.core.cache.backends.filebased.FileBasedCache or a Redis cache.
+if 'CACHES' not in globals():
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'default',
+        },
+        'responses': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'responses',
+            # responses are invalidated by release, not by time
+            'TIMEOUT': None,
+            'OPTIONS': {'MAX_ENTRIES': 1000},
+        },
+    }
+
+# Listings of the current variants are served from a read-only snapshot of the latest release in this directory
+# if it is set (see data/snapshot.py). Snapshots are exported when releases are added or removed, or by the
+# export_snapshot command.
+if 'VARIANT_SNAPSHOT_ROOT' not in globals():
+    VARIANT_SNAPSHOT_ROOT = None
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -3,11 +3,11 @@ from django.db import connection, transaction
 from data.models import Variant, VariantDiff, Report, ReportDiff
 from argparse import FileType
 import json
+import re
 import psycopg2
 from tqdm import tqdm
 
 from django.db import connection
-from io import StringIO
 
 from data.utilities import Benchmark
 
@@ -29,19 +29,121 @@ class Command(BaseCommand):
         add_diffs(diff, release_id, reports_diff)
 
 
-def add_diffs(diff_fp, release_id, reports_diff_fp):
-    diff = json.load(diff_fp)
-    reports_diff = json.load(reports_diff_fp)
+# diff files are read in chunks of this many characters
+JSON_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+
+NUMBER_START = '-0123456789'
+# characters which can follow the part of a number decoded so far; '' (the end of the buffer) is in the string too
+NUMBER_CONTINUATION = '.eE+-'
+
+
+def iterate_json_object(fp, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Yields the (key, value) pairs of the JSON object in the file fp, reading it in chunks, so that only one
+    member of the object is decoded at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def next_char():
+        # skips whitespace, returns the next character or '' at the end of the file
+        nonlocal position
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or eof:
+                return buffer[position:position + 1]
+            read_more()
+
+    def decode():
+        # numbers could continue in the next chunk: they are complete if they are followed by a character which
+        # can't continue them, other values once they decode
+        nonlocal position
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                if eof or buffer[position] not in NUMBER_START or buffer[end:end + 1] not in NUMBER_CONTINUATION:
+                    position = end
+                    return value
+            except ValueError:
+                if eof:
+                    raise
+            read_more()
+
+    def expect(characters):
+        nonlocal position
+        char = next_char()
+        if not char or char not in characters:
+            raise ValueError("expected one of %r at %d in diff file, found %r" % (characters, position, char))
+        position += 1
+        return char
+
+    expect('{')
+    if next_char() == '}':
+        return
+    while True:
+        next_char()
+        key = decode()
+        expect(':')
+        next_char()
+        yield key, decode()
+        if expect(',}') == '}':
+            return
+
+
+class LinesFile(object):
+    """File-like object for cursor.copy_from reading the lines yielded by an iterator"""
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        buffered = len(self.buffer)
+        while size < 0 or buffered < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            buffered += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        line = self.buffer or next(self.lines, '')
+        end = line.find('\n') + 1 or len(line)
+        self.buffer = line[end:]
+        return line[:end]
+
+
+def copy_diffs(cursor, diff_fp, table):
+    """Creates the temporary table with the diffs in diff_fp by key, streaming them from the file"""
+    cursor.execute("""create temporary table %s (key text, diff json)""" % table)
+
+    with cursor.connection.cursor() as psycon:
+        # psycon = cursor.connection  # get the underlying psycopg2 handle so we can use copy_from()
+        lines = ("%s\t%s\n" % (k, json.dumps(diff).replace('\\', '\\\\')) for k, diff in iterate_json_object(diff_fp))
+        psycon.copy_from(file=LinesFile(lines), table=table)
+
 
+def add_diffs(diff_fp, release_id, reports_diff_fp):
     print("Creating variant diffs...")
     with Benchmark("variant diffs"):
         with connection.cursor() as cursor:
-            cursor.execute("""create temporary table _var_diffs (key text, diff json)""")
-
-            with cursor.connection.cursor() as psycon:
-                # psycon = cursor.connection  # get the underlying psycopg2 handle so we can use copy_from()
-                buf = StringIO("".join("%s\t%s\n" % (k, json.dumps(diff[k]).replace('\\', '\\\\')) for k in diff))
-                psycon.copy_from(file=buf, table="_var_diffs")
+            copy_diffs(cursor, diff_fp, "_var_diffs")
 
             cursor.execute("""
             insert into data_variantdiff (variant_id, diff)
@@ -54,20 +156,26 @@ def add_diffs(diff_fp, release_id, reports_diff_fp):
     print("Creating report diffs...")
     with Benchmark("creating report diffs"):
         with connection.cursor() as cursor:
-            cursor.execute("""create temporary table _report_diffs (key text, diff json)""")
+            copy_diffs(cursor, reports_diff_fp, "_report_diffs")
 
-            with cursor.connection.cursor() as psycon:
-                # psycon = cursor.connection  # get the underlying psycopg2 handle so we can use copy_from()
-                buf = StringIO("".join("%s\t%s\n" % (k, json.dumps(reports_diff[k]).replace('\\', '\\\\')) for k in reports_diff))
-                psycon.copy_from(buf, table="_report_diffs")
+            # ClinVar reports are keyed by SCV accession, LOVD reports by submission id. Each is matched by its
+            # own equi-join, so that the (Data_Release, SCV_ClinVar) and (Data_Release, Submission_ID_LOVD)
+            # indexes of report are used.
+            cursor.execute("""
+            insert into data_reportdiff (report_id, report_diff)
+            select report.id, _report_diffs.diff from _report_diffs
+            inner join report on _report_diffs.key = report."SCV_ClinVar"
+            and report."Data_Release_id"=%s
+            where _report_diffs.key like 'SCV%%'
+            -- on conflict DO NOTHING;
+            """, [release_id])
 
             cursor.execute("""
             insert into data_reportdiff (report_id, report_diff)
             select report.id, _report_diffs.diff from _report_diffs
-            inner join report on _report_diffs.key = (
-              case when _report_diffs.key like 'SCV%%' then report."SCV_ClinVar" else report."Submission_ID_LOVD" end
-            )
+            inner join report on _report_diffs.key = report."Submission_ID_LOVD"
             and report."Data_Release_id"=%s
+            where _report_diffs.key not like 'SCV%%'
             -- on conflict DO NOTHING;
             """, [release_id])
 
@@ -1,5 +1,3 @@
-from collections import defaultdict
-
 from django.core.management.base import BaseCommand, CommandError
 # from django.conf import settings
 from django.db import connection, transaction
@@ -7,30 +5,95 @@ from django.db import connection, transaction
 from brca.site_settings import DATABASES
 from data.models import Variant, DataRelease, ChangeType, Report, MupitStructure, InSilicoPriors
 from argparse import FileType
+import itertools
 import json
 import sys
 import csv
 import psycopg2
-from data.utilities import update_autocomplete_words
-from tqdm import tqdm
+from data.utilities import (
+    update_autocomplete_words, update_materialized_view, update_release_summary, clear_response_cache, Benchmark
+)
 from data.management.commands.add_diff_json import add_diffs
+from data.snapshot import refresh_snapshot
 
 csv.field_size_limit(sys.maxsize)
 
-def get_num_lines(file_path):
-    import mmap
-    fp = open(file_path, "r+")
-    buf = mmap.mmap(fp.fileno(), 0)
-    lines = 0
-    while buf.readline():
-        lines += 1
-    return lines
-
 
 OLD_MAF_ESP_FIELD_NAMES = ['Minor_allele_frequency_ESP', 'Minor_allele_frequency_ESP_percent']
 
 SKIP_VAR_INSERTION = True
 
+# temporary tables the release files are copied into, before inserting the rows with set-based joins
+STAGED_VARIANTS_TABLE = '_release_variants'
+STAGED_REPORTS_TABLE = '_release_reports'
+STAGED_REPORT_LINKS_TABLE = '_release_report_links'
+
+
+def staged_fields(model, exclude):
+    """Returns the concrete fields of model loaded from the release files, i.e. all but the primary key and exclude"""
+    return [field for field in model._meta.concrete_fields if not field.primary_key and field.name not in exclude]
+
+
+def column_definitions(fields):
+    return ',\n'.join('"%s" %s' % (field.column, field.db_type(connection)) for field in fields)
+
+
+def quoted_columns(fields, prefix=''):
+    return ', '.join('%s"%s"' % (prefix, field.column) for field in fields)
+
+
+def report_source_name(source):
+    """Given a source of the release notes, returns the source name used in report and BX_ID column names"""
+    if source == "Bic":
+        return "BIC"
+    elif source == "1000 Genomes":
+        return "1000_Genomes"
+    elif source == "ExUV":
+        return "exLOVD"
+    elif source == "Findlay BRCA1 Ring Function Scores":
+        return "Findlay_BRCA1_Ring_Function_Scores"
+    elif source == "ENIGMA BRCA12 Functional Assays":
+        return "ENIGMA_BRCA12_Functional_Assays"
+    return source
+
+
+def copy_value(value):
+    """Returns value in the text format of COPY"""
+    if value is None:
+        return '\\N'
+    elif value is True:
+        return 't'
+    elif value is False:
+        return 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyRowsFile(object):
+    """
+    Read-only file of the rows of an iterator in the text format of COPY, so rows are staged
+    without holding a whole release file in memory
+    """
+    def __init__(self, rows):
+        self.lines = ('\t'.join(copy_value(value) for value in row) + '\n' for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_rows(cursor, table, rows):
+    """COPY rows (lists of values in the order of the table's columns) into table"""
+    with cursor.connection.cursor() as psycon:
+        psycon.copy_expert("COPY %s FROM STDIN" % table, CopyRowsFile(rows))
+
 
 class Command(BaseCommand):
     help = 'Add a new variant release to the database'
@@ -72,24 +135,22 @@ class Command(BaseCommand):
 
         print(("Creating new release with ID %d and name %s in db %s" % (release_id, release_name, DATABASES['default']['NAME'])))
 
-        reports_dict = self.build_report_dictionary_by_source(reports_tsv, removed_reports_tsv)
-        change_types = {ct['name']: ct['id'] for ct in list(ChangeType.objects.values())}
-        mupit_structures = {ms['name']: ms['id'] for ms in list(MupitStructure.objects.values())}
-
-        # TODO: split variants_tsv ahead of time into separate variant and insilicopriors lists
-        # TODO: use django-postgres-copy to load these files, although we'll have to run update_variant_values_for_insertion on it beforehand
-
-        self.insert_variants(
-            variants_tsv, label="inserting variants", is_deletion=False, release_id=release_id,
-            change_types=change_types, mupit_structures=mupit_structures, reports_dict=reports_dict, sources=sources
-        )
-
-        # deleted variants
-        if deletions_tsv:
-            self.insert_variants(
-                deletions_tsv, label="applying deletions", is_deletion=True, release_id=release_id,
-                change_types=change_types, mupit_structures=mupit_structures, reports_dict=reports_dict, sources=sources
-            )
+        with connection.cursor() as cursor:
+            with Benchmark("staging variants"):
+                self.create_staging_tables(cursor)
+                self.stage_variants(cursor, variants_tsv, is_deletion=False)
+                # deleted variants
+                if deletions_tsv:
+                    self.stage_variants(cursor, deletions_tsv, is_deletion=True)
+                self.stage_reports(cursor, reports_tsv, removed=False)
+                self.stage_reports(cursor, removed_reports_tsv, removed=True)
+                self.check_change_types_and_mupit_structures(cursor)
+
+            with Benchmark("inserting variants"):
+                self.insert_variants(cursor, release_id)
+
+            with Benchmark("inserting reports"):
+                self.insert_reports(cursor, release_id, sources)
 
         # calls django/data/management/commands/add_diff_json to add diff to db
         # converted to a method call so that we don't launch a separate process that's not in the current transaction
@@ -98,77 +159,251 @@ class Command(BaseCommand):
 
         # raise Exception("terminating b/c i don't want to commit")
 
-        update_autocomplete_words()
+        # only the words and current versions of the variants of this release change
+        with Benchmark("updating autocomplete words and current variants"):
+            update_autocomplete_words(release_id)
+            update_materialized_view(release_id)
 
-        # update materialized view of current variants
-        with connection.cursor() as cursor:
-            cursor.execute("REFRESH MATERIALIZED VIEW currentvariant")
+        update_release_summary(release_id)
+
+        clear_response_cache()
+        refresh_snapshot()
 
         # raise Exception("terminating b/c i don't want to commit")
 
-    def insert_variants(self, tsv_fp, label, is_deletion, release_id, change_types, mupit_structures, reports_dict, sources):
+    def create_staging_tables(self, cursor):
         """
-        Given a file pointer to a TSV file containing variants, insert each variant + in-silico priors information
-        into the database. If is_deletion is true, mark the variants we're inserting as deletions instead of
+        Create temporary tables for the variants (including their in-silico priors) and reports of the release.
+        Besides the model columns, staged rows carry their position in the input files and the names of their
+        change type and mupit structure, which are resolved to ids when inserting.
+        """
+        self.variant_fields = staged_fields(Variant, exclude=['Data_Release', 'Change_Type', 'Mupit_Structure'])
+        self.insilicopriors_fields = staged_fields(InSilicoPriors, exclude=[])
+        self.report_fields = staged_fields(Report, exclude=['Variant', 'Data_Release', 'Change_Type'])
+        self.row_numbers = itertools.count()
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE {variants} (
+                _row integer PRIMARY KEY, _is_deletion boolean, _change_type text, _mupit_structure text, _variant_id integer,
+                {columns}
+            ) ON COMMIT DROP
+        """.format(variants=STAGED_VARIANTS_TABLE,
+                   columns=column_definitions(self.variant_fields + self.insilicopriors_fields)))
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE {reports} (
+                _row integer PRIMARY KEY, _removed boolean, _change_type text, _bx_id text,
+                {columns}
+            ) ON COMMIT DROP
+        """.format(reports=STAGED_REPORTS_TABLE, columns=column_definitions(self.report_fields)))
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE {links} (
+                variant_id integer, removed boolean, source text, bx_id text, source_order integer, bx_id_order bigint
+            ) ON COMMIT DROP
+        """.format(links=STAGED_REPORT_LINKS_TABLE))
+
+    def stage_variants(self, cursor, tsv_fp, is_deletion):
+        """
+        Given a file pointer to a TSV file containing variants, COPY each variant + in-silico priors information
+        into the variant staging table. If is_deletion is true, mark the variants we're staging as deletions instead of
         new or changed variant information.
-        :param tsv_fp: a handle to a tab-delimited file containing variant data
-        :param label: the message to display to the user in the progress bar
+        :param cursor: a cursor of the transaction loading the release
+        :param tsv_fp: a handle to a tab-delimited file containing variants
         :param is_deletion: whether these variants should be treated as new/changed variants, or deletions
-        :param release_id: the number of this release
-        :param change_types: a mapping from change_type strings (e.g., "added_information") to ChangeType model IDs
-        :param mupit_structures: a mapping from mupit strings (e.g., "4igk") to MupitStructure model IDs
-        :param reports_dict: an aggregation of reports, returned by build_report_dictionary_by_source()
-        :param sources: a list of sources included in this release, e.g. ["Bic", "ClinVar", "ESP", "ExAC"...]
-        :return:
         """
         reader = csv.reader(tsv_fp, dialect="excel-tab")
         header = next(reader)
+        variant_field_names = set(field.name for field in self.variant_fields)
+        variant_defaults = [(field.name, field.get_default()) for field in self.variant_fields]
+
+        def staged_rows():
+            for row in reader:
+                row_dict = dict(list(zip(header, row)))
+
+                # transfer insilico prior columns from row_dict to insilico_dict
+                insilico_dict = dict((field.name, row_dict.pop(field.name)) for field in self.insilicopriors_fields)
+
+                # basically, we process every variant if we're loading deletions,
+                # or if it's a non-deletion only variants that have a valid change type field
+                if not (is_deletion or ('change_type' in row_dict and row_dict['change_type'])):
+                    continue
+
+                if is_deletion:
+                    row_dict.pop('change_type', None)
+                    row_dict.pop('mupit_structure', None)
+                    change_type = 'deleted'
+                    mupit_structure = None
+                else:
+                    change_type = row_dict.pop('change_type')
+                    mupit_structure = row_dict.pop('mupit_structure')
+                    if self.is_empty(mupit_structure):
+                        mupit_structure = None
 
-        # collect list of insilico prior column names so we can split those into a separate table, insilicopriors
-        insilicopriors_cols = [x.name for x in InSilicoPriors._meta.get_fields() if x.name not in ['id', 'Variant']]
-
-        # tqdm() displays a progress bar as we read elements from the csvreader, making this all slightly more pleasant
-        for row in tqdm(reader, desc=label, total=get_num_lines(tsv_fp.name) - 1):
-            # split Source column into booleans
-            row_dict = dict(list(zip(header, row)))
-
-            # transfer insilico prior columns from row_dict to insilico_dict
-            insilico_dict = dict((col, row_dict.pop(col)) for col in insilicopriors_cols)
-
-            # basically, we process every variant if we're loading deletions,
-            # or if it's a non-deletion only variants that have a valid change type field
-            if is_deletion or ('change_type' in row_dict and row_dict['change_type']):
                 # remap certain variant columns to account for historical differences in the variant description
-                row_dict = self.update_variant_values_for_insertion(
-                    row_dict, release_id, change_types, mupit_structures,
-                    set_ct_and_ms_to_none=is_deletion
-                )
+                row_dict = self.update_variant_values_for_insertion(row_dict)
 
-                # create the actual variant
-                variant = Variant.objects.create_variant(row_dict)
+                unknown_columns = set(row_dict) - variant_field_names
+                if unknown_columns:
+                    raise CommandError("Unknown variant columns: %s" % ', '.join(sorted(unknown_columns)))
 
-                if not is_deletion:
-                    self.create_and_associate_reports_to_variant(variant, reports_dict, sources, release_id, change_types)
+                yield ([next(self.row_numbers), is_deletion, change_type, mupit_structure, None] +
+                       [row_dict.get(name, default) for name, default in variant_defaults] +
+                       [insilico_dict[field.name] for field in self.insilicopriors_fields])
 
-                # also create an instance in insilicopriors linked to this variant
-                InSilicoPriors.objects.create(Variant=variant, **insilico_dict)
+        copy_rows(cursor, STAGED_VARIANTS_TABLE, staged_rows())
 
-    def update_variant_values_for_insertion(self, row_dict, release_id, change_types, mupit_structures, set_ct_and_ms_to_none=False):
+    def stage_reports(self, cursor, tsv_fp, removed):
+        """
+        Given a file pointer to a TSV file containing reports (or removed reports, if removed is true),
+        COPY the reports into the report staging table.
+        """
+        reader = csv.reader(tsv_fp, dialect="excel-tab")
+        header = next(reader)
+        report_field_names = set(field.name for field in self.report_fields)
+        report_defaults = [(field.name, field.get_default()) for field in self.report_fields]
+
+        def staged_rows():
+            for row in reader:
+                report = dict(list(zip(header, row)))
+                if removed:
+                    report['change_type'] = 'deleted'
+                elif self.is_empty(report['change_type']):
+                    report['change_type'] = 'none'
+                change_type = report.pop('change_type')
+                bx_id = report['BX_ID_' + report['Source']]
+
+                report = self.update_report_values_for_insertion(report)
+
+                unknown_columns = set(report) - report_field_names
+                if unknown_columns:
+                    raise CommandError("Unknown report columns: %s" % ', '.join(sorted(unknown_columns)))
+
+                yield ([next(self.row_numbers), removed, change_type, bx_id] +
+                       [report.get(name, default) for name, default in report_defaults])
+
+        copy_rows(cursor, STAGED_REPORTS_TABLE, staged_rows())
+
+    def check_change_types_and_mupit_structures(self, cursor):
+        # temporary tables aren't analyzed automatically, without statistics the planner joins them row by row
+        cursor.execute("ANALYZE %s" % STAGED_VARIANTS_TABLE)
+        cursor.execute("ANALYZE %s" % STAGED_REPORTS_TABLE)
+
+        for table, column, model in [(STAGED_VARIANTS_TABLE, '_change_type', ChangeType),
+                                     (STAGED_VARIANTS_TABLE, '_mupit_structure', MupitStructure),
+                                     (STAGED_REPORTS_TABLE, '_change_type', ChangeType)]:
+            cursor.execute("""
+                SELECT DISTINCT s.{column} FROM {table} s
+                LEFT JOIN {model_table} m ON m.name = s.{column}
+                WHERE s.{column} IS NOT NULL AND m.id IS NULL
+            """.format(table=table, column=column, model_table=model._meta.db_table))
+            unknown = [row[0] for row in cursor.fetchall()]
+            if unknown:
+                raise CommandError("Unknown %s names: %s" % (model.__name__, ', '.join(sorted(unknown))))
+
+    def insert_variants(self, cursor, release_id):
+        """
+        Insert the staged variants and their in-silico priors in file order, resolving change types
+        and mupit structures by name.
+        """
+        # allocate the ids of the new variants up front, so the in-silico priors and reports can refer to them
+        cursor.execute("""
+            UPDATE {variants} s SET _variant_id = ids.id FROM (
+                SELECT _row, nextval(pg_get_serial_sequence(%s, 'id')) AS id
+                FROM (SELECT _row FROM {variants} ORDER BY _row) ordered_rows
+            ) ids
+            WHERE s._row = ids._row
+        """.format(variants=STAGED_VARIANTS_TABLE), [Variant._meta.db_table])
+
+        variant_columns = quoted_columns(self.variant_fields)
+        cursor.execute("""
+            INSERT INTO {variant} (id, "Data_Release_id", "Change_Type_id", "Mupit_Structure_id", {columns})
+            SELECT s._variant_id, %s, ct.id, ms.id, {staged_columns} FROM {variants} s
+            INNER JOIN {change_type} ct ON ct.name = s._change_type
+            LEFT JOIN {mupit_structure} ms ON ms.name = s._mupit_structure
+            ORDER BY s._row
+        """.format(variant=Variant._meta.db_table, variants=STAGED_VARIANTS_TABLE,
+                   change_type=ChangeType._meta.db_table, mupit_structure=MupitStructure._meta.db_table,
+                   columns=variant_columns, staged_columns=quoted_columns(self.variant_fields, prefix='s.')),
+            [release_id])
+
+        cursor.execute("""
+            INSERT INTO {insilicopriors} ("Variant_id", {columns})
+            SELECT s._variant_id, {staged_columns} FROM {variants} s
+            ORDER BY s._row
+        """.format(insilicopriors=InSilicoPriors._meta.db_table, variants=STAGED_VARIANTS_TABLE,
+                   columns=quoted_columns(self.insilicopriors_fields),
+                   staged_columns=quoted_columns(self.insilicopriors_fields, prefix='s.')))
+
+    def insert_reports(self, cursor, release_id, sources):
+        """
+        Associate the staged reports with the new variants listing their bx_ids and insert them.
+        Removed report bx_ids are from the previous release, so removed reports are associated with a variant
+        through the bx_ids of the previous version of the variant (if it exists).
+        """
+        variant_columns = set(field.column for field in self.variant_fields)
+
+        for source_order, source in enumerate(sources):
+            source = report_source_name(source)
+            bx_id_column = "BX_ID_" + source
+            if bx_id_column not in variant_columns:
+                raise CommandError("Unknown source %s, variants have no column %s" % (source, bx_id_column))
+
+            cursor.execute("""
+                INSERT INTO {links} (variant_id, removed, source, bx_id, source_order, bx_id_order)
+                SELECT s._variant_id, false, %s, bx.bx_id, %s, bx.bx_id_order FROM {variants} s,
+                unnest(string_to_array(s."{bx_id_column}", ',')) WITH ORDINALITY AS bx(bx_id, bx_id_order)
+                WHERE NOT s._is_deletion AND s."{bx_id_column}" NOT IN ('', '-')
+            """.format(links=STAGED_REPORT_LINKS_TABLE, variants=STAGED_VARIANTS_TABLE, bx_id_column=bx_id_column),
+                [source, source_order])
+
+            cursor.execute("""
+                INSERT INTO {links} (variant_id, removed, source, bx_id, source_order, bx_id_order)
+                SELECT s._variant_id, true, %s, bx.bx_id, %s, bx.bx_id_order FROM {variants} s
+                CROSS JOIN LATERAL (
+                    SELECT p."{bx_id_column}" FROM {variant} p
+                    WHERE p."Data_Release_id" = %s AND p."Genomic_Coordinate_hg38" = s."Genomic_Coordinate_hg38"
+                    ORDER BY p.id LIMIT 1
+                ) previous_version,
+                unnest(string_to_array(previous_version."{bx_id_column}", ',')) WITH ORDINALITY AS bx(bx_id, bx_id_order)
+                WHERE NOT s._is_deletion AND previous_version."{bx_id_column}" NOT IN ('', '-')
+            """.format(links=STAGED_REPORT_LINKS_TABLE, variants=STAGED_VARIANTS_TABLE, variant=Variant._meta.db_table,
+                       bx_id_column=bx_id_column),
+                [source, source_order, self.previous_release_id])
+
+        cursor.execute("ANALYZE %s" % STAGED_REPORT_LINKS_TABLE)
+
+        # every bx_id of a new variant has to refer to a report of this release
+        cursor.execute("""
+            SELECT l.source, l.bx_id FROM {links} l
+            WHERE NOT l.removed AND NOT EXISTS (
+                SELECT 1 FROM {reports} r WHERE NOT r._removed AND r."Source" = l.source AND r._bx_id = l.bx_id
+            )
+            ORDER BY l.source, l.bx_id LIMIT 10
+        """.format(links=STAGED_REPORT_LINKS_TABLE, reports=STAGED_REPORTS_TABLE))
+        missing = cursor.fetchall()
+        if missing:
+            raise CommandError("Variants refer to missing reports: %s" %
+                               ', '.join("%s %s" % (source, bx_id) for source, bx_id in missing))
+
+        # a later report with the same source and bx_id replaces an earlier one
+        cursor.execute("""
+            INSERT INTO {report} ("Variant_id", "Data_Release_id", "Change_Type_id", {columns})
+            SELECT l.variant_id, %s, ct.id, {staged_columns} FROM {links} l
+            INNER JOIN (
+                SELECT DISTINCT ON (_removed, "Source", _bx_id) * FROM {reports}
+                ORDER BY _removed, "Source", _bx_id, _row DESC
+            ) r ON r._removed = l.removed AND r."Source" = l.source AND r._bx_id = l.bx_id
+            INNER JOIN {change_type} ct ON ct.name = r._change_type
+            ORDER BY l.variant_id, l.source_order, l.removed, l.bx_id_order
+        """.format(report=Report._meta.db_table, links=STAGED_REPORT_LINKS_TABLE, reports=STAGED_REPORTS_TABLE,
+                   change_type=ChangeType._meta.db_table, columns=quoted_columns(self.report_fields),
+                   staged_columns=quoted_columns(self.report_fields, prefix='r.')),
+            [release_id])
+
+    def update_variant_values_for_insertion(self, row_dict):
         for source in row_dict['Source'].split(','):
             row_dict['Variant_in_' + source] = True
-        row_dict['Data_Release_id'] = release_id
-        if set_ct_and_ms_to_none is True:
-            row_dict.pop('change_type', None)
-            row_dict.pop('mupit_structure', None)
-            row_dict['Change_Type_id'] = change_types['deleted']
-            row_dict['Mupit_Structure_id'] = None
-        else:
-            row_dict['Change_Type_id'] = change_types[row_dict.pop('change_type')]
-            mupit_structure = row_dict.pop('mupit_structure')
-            if self.is_empty(mupit_structure):
-                row_dict['Mupit_Structure_id'] = None
-            else:
-                row_dict['Mupit_Structure_id'] = mupit_structures[mupit_structure]
 
         # use cleaned up genomic coordinates and other values
         row_dict['Genomic_Coordinate_hg38'] = row_dict.pop('pyhgvs_Genomic_Coordinate_38')
@@ -197,80 +432,7 @@ class Command(BaseCommand):
 
         return row_dict
 
-    def build_report_dictionary_by_source(self, reports_tsv, removed_reports_tsv):
-        reports_reader = csv.reader(reports_tsv, dialect="excel-tab")
-        reports_header = next(reports_reader)
-        removed_reports_reader = csv.reader(removed_reports_tsv, dialect="excel-tab")
-        removed_reports_header = next(removed_reports_reader)
-
-        reports_dict = {
-            'reports': defaultdict(dict), 'removed_reports': defaultdict(dict)
-        }
-
-        for row in reports_reader:
-            report = dict(list(zip(reports_header, row)))
-            if self.is_empty(report['change_type']):
-                report['change_type'] = 'none'
-            source = report['Source']
-            bx_id = report['BX_ID_' + source]
-            reports_dict['reports'][source][bx_id] = report
-
-        # add removed reports to dict
-        for row in removed_reports_reader:
-            report = dict(list(zip(removed_reports_header, row)))
-            report['change_type'] = 'deleted'
-            source = report['Source']
-            bx_id = report['BX_ID_' + source]
-            reports_dict['removed_reports'][source][bx_id] = report
-
-        return reports_dict
-
-    def create_and_associate_reports_to_variant(self, variant, reports_dict, sources, release_id, change_types):
-        # Used to associate removed reports with variants because removed report bx_ids refer
-        # to bx_ids from the previous release.\
-        previous_version_of_variant_query = Variant.objects.filter(
-            Data_Release_id=self.previous_release_id, Genomic_Coordinate_hg38=variant.Genomic_Coordinate_hg38
-        )
-        for source in sources:
-            if source == "Bic":
-                source = "BIC"
-            elif source == "1000 Genomes":
-                source = "1000_Genomes"
-            elif source == "ExUV":
-                source = "exLOVD"
-            elif source == "Findlay BRCA1 Ring Function Scores":
-                source = "Findlay_BRCA1_Ring_Function_Scores"
-            elif source == "ENIGMA BRCA12 Functional Assays":
-                source = "ENIGMA_BRCA12_Functional_Assays"
-            bx_id_field = "BX_ID_" + source
-
-            if not self.is_empty(getattr(variant, bx_id_field)):
-                bx_ids = getattr(variant, bx_id_field).split(',')
-                for bx_id in bx_ids:
-                    self.create_and_associate_report_to_variant(bx_id, source, reports_dict, variant, release_id, change_types, removed=False)
-
-            '''
-            Associate removed reports with variant -- note that bx_ids are release specific,
-            so we must check the previous version of a variant (if it exists) for its bx_ids and compare them
-            to the removed report bx_ids (removed report bx_ids are from the previous release).
-            '''
-            if len(previous_version_of_variant_query) > 0:
-                previous_version_of_variant = previous_version_of_variant_query[0]
-                if not self.is_empty(getattr(previous_version_of_variant, bx_id_field)):
-                    bx_ids = getattr(previous_version_of_variant, bx_id_field).split(',')
-                    for bx_id in bx_ids:
-                        if source in reports_dict['removed_reports'] and bx_id in reports_dict['removed_reports'][source]:
-                            self.create_and_associate_report_to_variant(bx_id, source, reports_dict, variant, release_id, change_types, removed=True)
-
-    def create_and_associate_report_to_variant(self, bx_id, source, reports_dict, variant, release_id, change_types, removed=False):
-        if removed:
-            report = reports_dict['removed_reports'][source][bx_id]
-        else:
-            report = reports_dict['reports'][source][bx_id]
-        report['Data_Release_id'] = release_id
-        report['Variant'] = variant
-        report['Change_Type_id'] = change_types[report.pop('change_type')]
-
+    def update_report_values_for_insertion(self, report):
         # satisfy postgres 63 char column name limit
         if 'Functional_Enrichment_Score_Findlay_ENIGMA_BRCA12_Functional_Assays' in report:
             report['Functional_Enrichment_Findlay_ENIGMA_BRCA12_Functional_Assays'] = report.pop('Functional_Enrichment_Score_Findlay_ENIGMA_BRCA12_Functional_Assays')
@@ -280,7 +442,7 @@ class Command(BaseCommand):
             if oldName in report:
                 report['Minor_allele_frequency_percent_ESP'] = report.pop(oldName)
 
-        Report.objects.create_report(report)
+        return report
 
     def is_empty(self, value):
         return value is None or value == '' or value == '-'
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand, CommandError
+from data.snapshot import export_snapshot, snapshot_root
+
+
+class Command(BaseCommand):
+    help = 'Exports the snapshot of the current variants served by the variants listing (see VARIANT_SNAPSHOT_ROOT)'
+
+    def handle(self, *args, **options):
+        if not snapshot_root():
+            raise CommandError('VARIANT_SNAPSHOT_ROOT is not set')
+        print("Exported %s" % export_snapshot())
@@ -1,32 +1,14 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
-from data.models import Variant, DataRelease, Report
+from data.models import Variant, DataRelease, DataReleaseSummary, Report
 from django.db import transaction
+from data.utilities import update_autocomplete_words, update_materialized_view, clear_response_cache
+from data.snapshot import refresh_snapshot, remove_snapshot, snapshot_root
 
 
 class Command(BaseCommand):
     help = 'Remove the most recent release from the database'
 
-    def update_autocomplete_words(self):
-        # Drop words table and recreate with latest data
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                DROP TABLE IF EXISTS words;
-                CREATE TABLE words AS SELECT DISTINCT left(word, 300) as word, release_id FROM (
-                SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg38"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg37"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Clinical_significance_ENIGMA"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Gene_Symbol"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Reference_Sequence"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("HGVS_cDNA"), '[\s|:''"]')  as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("BIC_Nomenclature"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("HGVS_Protein"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant
-                )
-                AS combined_words;
-
-                CREATE INDEX words_idx ON words(word text_pattern_ops);
-            """)
-
     def reset_sequence_ids(self):
         # NOTE: tried using sqlsequencereset to programatically generate these commands but cursor failed to execute them.
         # Ensure these are the correct commands before running this script!
@@ -52,14 +34,18 @@ class Command(BaseCommand):
 
         print("Deleted reports from most recent release.")
 
-        # Delete latest data_release and update materialized view of variants
+        # Update materialized view of variants, restoring the previous versions of the deleted variants
+        update_materialized_view(latest_release_id)
+
+        # Delete latest data_release
+        DataReleaseSummary.objects.filter(release_id=latest_release_id).delete()
         with connection.cursor() as cursor:
             cursor.execute("DELETE FROM data_release WHERE id = %s", [latest_release_id])
-            cursor.execute("REFRESH MATERIALIZED VIEW currentvariant")
 
         print("Deleted most recent data_release and updated materialized view.")
 
-        self.update_autocomplete_words()
+        # Words of the remaining releases are unchanged
+        update_autocomplete_words(latest_release_id)
 
         print("Updated autocomplete words.")
 
@@ -67,4 +53,14 @@ class Command(BaseCommand):
 
         print("Reset sequence ids in DB.")
 
+        clear_response_cache()
+
+        print("Cleared cached responses.")
+
+        if snapshot_root():
+            remove_snapshot(latest_release_id)
+            refresh_snapshot()
+
+            print("Removed the snapshot of the release, the previous release is exported once the removal is committed.")
+
         print("Done!")
@@ -3,7 +3,8 @@ from django.db import connection
 from data.models import Variant, Report, VariantDiff
 from django.db import transaction
 from math import floor, log10
-from data.utilities import update_materialized_view
+from data.utilities import update_materialized_view, clear_response_cache
+from data.snapshot import refresh_snapshot
 
 
 
@@ -48,5 +49,7 @@ class Command(BaseCommand):
                 obj.save()
 
         update_materialized_view()
+        clear_response_cache()
+        refresh_snapshot()
 
         print("Done!")
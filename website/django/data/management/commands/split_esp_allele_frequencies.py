@@ -2,7 +2,8 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
 from data.models import Variant, Report
 from django.db import transaction
-from data.utilities import update_materialized_view
+from data.utilities import update_materialized_view, clear_response_cache
+from data.snapshot import refresh_snapshot
 
 
 
@@ -37,5 +38,7 @@ class Command(BaseCommand):
                     obj.save()
 
         update_materialized_view()
+        clear_response_cache()
+        refresh_snapshot()
 
         print("Done!")
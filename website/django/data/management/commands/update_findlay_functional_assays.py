@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from data.utilities import update_findlay_functional_assays, update_materialized_view
+from data.utilities import update_findlay_functional_assays, update_materialized_view, clear_response_cache
+from data.snapshot import refresh_snapshot
 
 class Command(BaseCommand):
     help = 'Updates findlay functional assays retroactively'
@@ -9,4 +10,6 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         update_findlay_functional_assays()
         update_materialized_view()
+        clear_response_cache()
+        refresh_snapshot()
         print("Done!")
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+    Replaces the currentvariant materialized view by a table, so that adding a release only updates the
+    current versions of the variants of that release (see update_materialized_view in data/utilities.py)
+    instead of refreshing the whole view while holding a lock that blocks searches.
+    Migrations changing variant columns have to rebuild currentvariant, e.g. with update_materialized_view().
+    '''
+
+    dependencies = [
+        ('data', '0057_add_splice_ai_fields_and_update_empties'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            DROP MATERIALIZED VIEW IF EXISTS currentvariant;
+            CREATE TABLE currentvariant AS (
+                SELECT * FROM "variant" WHERE (
+                    "id" IN ( SELECT DISTINCT ON ("Genomic_Coordinate_hg38") "id" FROM "variant" ORDER BY "Genomic_Coordinate_hg38" ASC, "Data_Release_id" DESC )
+                )
+            );
+            ALTER TABLE currentvariant ADD CONSTRAINT currentvariant_pkey PRIMARY KEY (id);
+            CREATE UNIQUE INDEX currentvariant_hg38_idx ON currentvariant ("Genomic_Coordinate_hg38");
+            CREATE INDEX currentvariant_release_idx ON currentvariant ("Data_Release_id");
+
+            CREATE INDEX words_release_idx ON words(release_id);
+            """,
+            reverse_sql="""
+            DROP INDEX IF EXISTS words_release_idx;
+
+            DROP TABLE IF EXISTS currentvariant;
+            CREATE MATERIALIZED VIEW currentvariant AS (
+                SELECT * FROM "variant" WHERE (
+                    "id" IN ( SELECT DISTINCT ON ("Genomic_Coordinate_hg38") "id" FROM "variant" ORDER BY "Genomic_Coordinate_hg38" ASC, "Data_Release_id" DESC )
+                )
+            );
+            """
+        )
+    ]
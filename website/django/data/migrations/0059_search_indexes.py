@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+    Indexes the columns of currentvariant searched by apply_search in data/views.py with a pg_trgm trigram
+    index, so that icontains and istartswith searches (UPPER(column) LIKE UPPER(term)) don't scan the whole
+    table. The index is only created if the pg_trgm extension is available, it is recreated by
+    update_materialized_view() when rebuilding currentvariant (see SEARCH_COLUMNS in data/utilities.py).
+    Autocomplete suggestions are looked up by release and word prefix, hence words_release_idx covers both.
+    '''
+
+    dependencies = [
+        ('data', '0058_currentvariant_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    CREATE INDEX currentvariant_search_idx ON currentvariant USING gin (
+                        UPPER("Pathogenicity_expert") gin_trgm_ops,
+                        UPPER("Genomic_Coordinate_hg38") gin_trgm_ops,
+                        UPPER("Genomic_Coordinate_hg37") gin_trgm_ops,
+                        UPPER("Genomic_HGVS_38") gin_trgm_ops,
+                        UPPER("Genomic_HGVS_37") gin_trgm_ops,
+                        UPPER("Synonyms") gin_trgm_ops,
+                        UPPER("Gene_Symbol") gin_trgm_ops,
+                        UPPER("HGVS_cDNA") gin_trgm_ops,
+                        UPPER("BIC_Nomenclature") gin_trgm_ops,
+                        UPPER("HGVS_Protein") gin_trgm_ops,
+                        UPPER("Protein_Change") gin_trgm_ops,
+                        UPPER("SCV_ClinVar") gin_trgm_ops,
+                        UPPER("ClinVarAccession_ENIGMA") gin_trgm_ops,
+                        UPPER("CA_ID") gin_trgm_ops,
+                        UPPER("VR_ID") gin_trgm_ops
+                    );
+                END IF;
+            END
+            $$;
+
+            DROP INDEX IF EXISTS words_release_idx;
+            CREATE INDEX words_release_idx ON words(release_id, word text_pattern_ops);
+            """,
+            reverse_sql="""
+            DROP INDEX IF EXISTS words_release_idx;
+            CREATE INDEX words_release_idx ON words(release_id);
+
+            DROP INDEX IF EXISTS currentvariant_search_idx;
+            """
+        )
+    ]
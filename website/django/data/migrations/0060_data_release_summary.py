@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0059_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataReleaseSummary',
+            fields=[
+                ('release', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='data.DataRelease')),
+                ('variants_added', models.IntegerField()),
+                ('variants_classified', models.IntegerField()),
+                ('variants_modified', models.IntegerField()),
+                ('variants_deleted', models.IntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO data_datareleasesummary
+                (release_id, variants_added, variants_classified, variants_modified, variants_deleted)
+            SELECT r.id,
+                count(ct.id) FILTER (WHERE ct.name = 'new'),
+                count(ct.id) FILTER (WHERE ct.name IN ('changed_classification', 'added_classification')),
+                count(ct.id) FILTER (WHERE ct.name IN ('added_information', 'changed_information')),
+                count(ct.id) FILTER (WHERE ct.name = 'deleted')
+            FROM data_release r
+                LEFT JOIN variant v ON v."Data_Release_id" = r.id
+                LEFT JOIN data_changetype ct ON ct.id = v."Change_Type_id"
+            GROUP BY r.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 14:49
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0060_data_release_summary'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='variant',
+            index_together=set([('Data_Release', 'Genomic_Coordinate_hg38')]),
+        ),
+    ]
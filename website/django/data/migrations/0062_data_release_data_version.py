@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0061_variant_release_coordinate_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datarelease',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -13,6 +13,8 @@ class DataRelease(models.Model):
     md5sum = models.TextField()
     created = models.DateTimeField(auto_now_add=True, null=True)
     name = models.PositiveIntegerField()
+    # incremented by clear_response_cache when the data of the latest release is changed in place
+    data_version = models.PositiveIntegerField(default=0)
 
     class Meta:
         db_table = "data_release"
@@ -50,6 +52,15 @@ class ReportDiff(models.Model):
     report_diff = LegacyJSONField()
 
 
+class DataReleaseSummary(models.Model):
+    # counts of the variants of a release by kind of change, see update_release_summary in data/utilities.py
+    release = models.OneToOneField(DataRelease, primary_key=True)
+    variants_added = models.IntegerField()
+    variants_classified = models.IntegerField()
+    variants_modified = models.IntegerField()
+    variants_deleted = models.IntegerField()
+
+
 # ------------------------------------------------------------------------
 # --- variants
 # ------------------------------------------------------------------------
@@ -516,6 +527,10 @@ class Variant(models.Model):
     class Meta:
         db_table = 'variant'
 
+        index_together = [
+            ["Data_Release", "Genomic_Coordinate_hg38"]
+        ]
+
 
 class ReportManager(models.Manager):
     def create_report(self, row):
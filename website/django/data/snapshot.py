@@ -0,0 +1,283 @@
+"""
+Read-optimized snapshot of the current variants, which serves the variant listings of the index view without
+querying currentvariant.
+
+A snapshot is exported per release into VARIANT_SNAPSHOT_ROOT/<release id>-<timestamp>/ by export_snapshot, with the rows
+of currentvariant in id order and three files per column:
+- <column>.json: the JSON encodings of the values (as in the responses of index), concatenated
+- <column>.offsets: the offsets of the values in <column>.json, n + 1 unsigned 64 bit integers
+- <column>.ranks: the positions of the values in the Postgres sort order of the column, ties share a position
+and manifest.json with the number of rows, the columns and the release version the snapshot was exported for.
+VARIANT_SNAPSHOT_ROOT/CURRENT names the snapshot of the latest release.
+
+The files are memory-mapped and never written once exported, so all processes serving a snapshot share its
+pages. The files aren't compressed for that reason. A snapshot is never exported into an existing directory
+(e.g. when the current variants are updated in place), hence a process never maps files of different exports.
+"""
+import heapq
+import json
+import mmap
+import os
+import shutil
+from datetime import datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+from .models import ChangeType, CurrentVariant
+from .utilities import latest_release_version
+
+CURRENT_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+
+# columns are exported in batches of this many columns, one query each
+EXPORT_BATCH_SIZE = 50
+
+# internal types of the columns which filters compare with LIKE
+TEXT_TYPES = ('TextField', 'CharField')
+
+# opened snapshots by directory
+_snapshots = {}
+
+
+def snapshot_root():
+    return getattr(settings, 'VARIANT_SNAPSHOT_ROOT', None)
+
+
+def export_snapshot(root=None):
+    """
+    Exports the snapshot of the current variants of the latest release and makes it the current snapshot.
+    Listings are served by Postgres while exporting, as the previous snapshot may be stale.
+    """
+    root = root or snapshot_root()
+    if os.path.exists(os.path.join(root, CURRENT_FILE)):
+        os.remove(os.path.join(root, CURRENT_FILE))
+    version = latest_release_version()
+    release_id = version.split(':')[0]
+    name = '%s-%s' % (release_id, datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    directory = os.path.join(root, name)
+    exported = directory + '.tmp'
+    shutil.rmtree(exported, ignore_errors=True)
+    os.makedirs(exported)
+
+    fields = CurrentVariant._meta.concrete_fields
+    for start in range(0, len(fields), EXPORT_BATCH_SIZE):
+        batch = fields[start:start + EXPORT_BATCH_SIZE]
+        export_values(exported, batch)
+        export_ranks(exported, batch)
+
+    deleted = ChangeType.objects.filter(name='deleted').values_list('id', flat=True).first()
+    manifest = {
+        'version': version,
+        'rows': CurrentVariant.objects.count(),
+        'columns': [field.attname for field in fields],
+        'types': dict((field.attname, field.get_internal_type()) for field in fields),
+        'deleted_change_type': deleted,
+    }
+    with open(os.path.join(exported, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+    os.rename(exported, directory)
+    with open(os.path.join(root, CURRENT_FILE + '.tmp'), 'w') as f:
+        f.write(name)
+    os.replace(os.path.join(root, CURRENT_FILE + '.tmp'), os.path.join(root, CURRENT_FILE))
+
+    # earlier exports aren't current anymore, listings in progress on them fall back to Postgres
+    for other in os.listdir(root):
+        if other != name and other != CURRENT_FILE and os.path.isdir(os.path.join(root, other)):
+            shutil.rmtree(os.path.join(root, other), ignore_errors=True)
+    return directory
+
+
+def export_values(directory, fields):
+    columns = [field.attname for field in fields]
+    files = [(open(os.path.join(directory, column + '.json'), 'wb'), open(os.path.join(directory, column + '.offsets'), 'wb'))
+             for column in columns]
+    offsets = [0] * len(columns)
+    for data, offsets_file in files:
+        offsets_file.write((0).to_bytes(8, 'little'))
+    for row in CurrentVariant.objects.order_by('id').values_list(*columns).iterator():
+        for index, value in enumerate(row):
+            encoded = json.dumps(value, cls=DjangoJSONEncoder).encode('utf-8')
+            data, offsets_file = files[index]
+            data.write(encoded)
+            offsets[index] += len(encoded)
+            offsets_file.write(offsets[index].to_bytes(8, 'little'))
+    for data, offsets_file in files:
+        data.close()
+        offsets_file.close()
+
+
+def export_ranks(directory, fields):
+    # descending order is the reverse of ascending order, both in ranks and in Postgres (nulls first then)
+    ranks = ', '.join('dense_rank() OVER (ORDER BY "%s" ASC)' % field.column for field in fields)
+    files = [open(os.path.join(directory, field.attname + '.ranks'), 'wb') for field in fields]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s FROM currentvariant ORDER BY id' % ranks)
+        for row in cursor:
+            for rank, f in zip(row, files):
+                f.write(rank.to_bytes(8, 'little'))
+    for f in files:
+        f.close()
+
+
+def refresh_snapshot():
+    """Exports the snapshot of the latest release once the current transaction commits, if snapshots are enabled"""
+    if snapshot_root():
+        transaction.on_commit(export_snapshot)
+
+
+def remove_snapshot(release_id, root=None):
+    """Removes the snapshots of a release, the current snapshot is dropped if it is one of them"""
+    root = root or snapshot_root()
+    prefix = '%s-' % release_id
+    current = os.path.join(root, CURRENT_FILE)
+    if os.path.exists(current):
+        with open(current) as f:
+            if f.read().strip().startswith(prefix):
+                os.remove(current)
+    for name in os.listdir(root):
+        if name.startswith(prefix):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def map_file(path, format):
+    """Returns a memoryview of the file with the given struct format, mapped into memory"""
+    if os.path.getsize(path) == 0:
+        return memoryview(b'').cast(format)
+    with open(path, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(format)
+
+
+class Snapshot(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.version = manifest['version']
+        self.rows = manifest['rows']
+        self.columns = manifest['columns']
+        self.types = manifest['types']
+        self.deleted_change_type = manifest['deleted_change_type']
+        self._mapped = {}
+
+    def _map(self, column, kind, format):
+        key = (column, kind)
+        if key not in self._mapped:
+            self._mapped[key] = map_file(os.path.join(self.directory, '%s.%s' % (column, kind)), format)
+        return self._mapped[key]
+
+    def ranks(self, column):
+        return self._map(column, 'ranks', 'Q')
+
+    def value(self, column, row):
+        """Returns the JSON encoding of the value of column in row"""
+        offsets = self._map(column, 'offsets', 'Q')
+        return self._map(column, 'json', 'B')[offsets[row]:offsets[row + 1]].tobytes()
+
+    def values(self, column):
+        """
+        Returns the JSON encodings of the values of column in all rows, as views on the mapped file which compare
+        equal to bytes
+        """
+        offsets = self._map(column, 'offsets', 'Q')
+        data = self._map(column, 'json', 'B')
+        return [data[offsets[row]:offsets[row + 1]] for row in range(self.rows)]
+
+    def select(self, include, exclude, filters, show_deleted):
+        """
+        Returns the rows matching the listing filters of index and the number of matching deleted rows if they are
+        left out (see apply_sources and apply_filters in data/views.py), or None if the filters aren't supported
+        """
+        rows = range(self.rows)
+        if include:
+            included = [self.values(column) for column in include]
+            rows = [row for row in rows if any(values[row] == b'true' for values in included)]
+        for column in exclude:
+            values = self.values(column)
+            rows = [row for row in rows if values[row] == b'false']
+        for column, value in filters:
+            if column not in self.types:
+                return None
+            values = self.values(column)
+            if column == 'id':
+                if not value.isdigit():
+                    return None
+                encoded = json.dumps(int(value)).encode('utf-8')
+                rows = [row for row in rows if values[row] == encoded]
+            elif self.types[column] in TEXT_TYPES and not any(c in value for c in '%_\\'):
+                # LIKE 'value%': the JSON encoding of a string starting with value starts with that of value
+                prefix = json.dumps(value).encode('utf-8')[:-1]
+                rows = [row for row in rows if values[row][:len(prefix)] == prefix]
+            else:
+                return None
+        deleted_count = 0
+        if not show_deleted:
+            change_types = self.values('Change_Type_id')
+            deleted = json.dumps(self.deleted_change_type).encode('utf-8')
+            remaining = [row for row in rows if change_types[row] != deleted]
+            deleted_count = len(rows) - len(remaining)
+            rows = remaining
+        return list(rows), deleted_count
+
+    def order(self, rows, ordering, end=None):
+        """Returns the rows sorted by ordering (order_by arguments), only the first end rows if end is given"""
+        keys = []
+        for field in ordering:
+            ranks = self.ranks(field.lstrip('-'))
+            keys.append((ranks, field.startswith('-')))
+
+        def key(row):
+            return tuple(-ranks[row] if descending else ranks[row] for ranks, descending in keys) + (row,)
+
+        if end is not None:
+            return heapq.nsmallest(end, rows, key=key)
+        return sorted(rows, key=key)
+
+    def listing(self, include, exclude, filters, show_deleted, ordering, columns, page_size, page_num):
+        """
+        Returns the JSON of the index response of a listing of the current variants, or None if the listing
+        isn't supported
+        """
+        columns = columns or self.columns
+        if any(column not in self.types for column in columns + [field.lstrip('-') for field in ordering]):
+            return None
+        selected = self.select(include, exclude, filters, show_deleted)
+        if selected is None:
+            return None
+        rows, deleted_count = selected
+
+        start = page_size * page_num
+        end = start + page_size if page_size else None
+        if ordering:
+            rows = self.order(rows, ordering, end)
+        rows = rows[start:end]
+
+        encoded_columns = [json.dumps(column) for column in columns]
+        data = ', '.join(
+            '{%s}' % ', '.join('%s: %s' % (encoded_column, self.value(column, row).decode('utf-8'))
+                               for column, encoded_column in zip(columns, encoded_columns))
+            for row in rows)
+        return ('{"count": %d, "deletedCount": %d, "synonyms": 0, "releaseName": null, "nextCursor": null, "data": [%s]}'
+                % (len(selected[0]), deleted_count, data))
+
+
+def current_snapshot(version):
+    """
+    Returns the current snapshot if it was exported for the given release version, otherwise None. Snapshots are
+    opened once per process, by export directory.
+    """
+    root = snapshot_root()
+    if not root:
+        return None
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            directory = os.path.join(root, f.read().strip())
+        if directory not in _snapshots:
+            _snapshots.clear()
+            _snapshots[directory] = Snapshot(directory)
+    except (IOError, OSError, ValueError):
+        return None
+    snapshot = _snapshots[directory]
+    return snapshot if snapshot.version == version else None
@@ -0,0 +1,257 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, RequestFactory
+
+from data import test_data, views
+from data.management.commands.add_diff_json import iterate_json_object
+from data.models import (
+    Variant, CurrentVariant, DataRelease, DataReleaseSummary, Report, InSilicoPriors, VariantDiff, ReportDiff
+)
+from data.utilities import update_autocomplete_words, update_materialized_view, RESPONSE_CACHE
+
+'''
+Tests loading a release with the addrelease management command. The release files are written
+from the test data the same way the pipeline writes them: variants with pyhgvs columns, change type
+and mupit structure names, in-silico priors columns and reports referred to by bx_id.
+'''
+
+PYHGVS_COLUMNS = {
+    'Genomic_Coordinate_hg38': 'pyhgvs_Genomic_Coordinate_38',
+    'Genomic_Coordinate_hg37': 'pyhgvs_Genomic_Coordinate_37',
+    'Hg37_Start': 'pyhgvs_Hg37_Start',
+    'Hg37_End': 'pyhgvs_Hg37_End',
+    'HGVS_cDNA': 'pyhgvs_cDNA',
+    'HGVS_Protein': 'pyhgvs_Protein',
+}
+
+INSILICOPRIORS_COLUMNS = [field.name for field in InSilicoPriors._meta.get_fields() if field.name not in ['id', 'Variant']]
+
+
+def release_variant(coordinate, change_type, mupit_structure='-', **values):
+    """Returns a row of a release variants file, based on the existing test variant"""
+    variant = test_data.existing_variant()
+    for key in ['Change_Type_id', 'Data_Release_id'] + [key for key in variant if key.startswith('Variant_in_')]:
+        variant.pop(key)
+    variant['Genomic_Coordinate_hg38'] = coordinate
+    variant.update(values)
+    row = dict((PYHGVS_COLUMNS.get(key, key), value) for key, value in variant.items())
+    row.update((column, '-') for column in INSILICOPRIORS_COLUMNS)
+    row['applicablePrior'] = '0.02'
+    row['change_type'] = change_type
+    row['mupit_structure'] = mupit_structure
+    return row
+
+
+def release_report(source, bx_id, change_type='new'):
+    """Returns a row of a release reports file, based on the existing test reports"""
+    report = test_data.existing_clinvar_report() if source == 'ClinVar' else test_data.existing_lovd_report()
+    for key in ['Change_Type_id', 'Data_Release_id']:
+        report.pop(key)
+    report['BX_ID_' + source] = bx_id
+    report['change_type'] = change_type
+    return report
+
+
+class AddReleaseTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        previous_release = DataRelease.objects.create(name=1, date='2019-12-26')
+        previous = test_data.existing_variant()
+        previous['Data_Release_id'] = previous_release.id
+        previous['BX_ID_ClinVar'] = '38697'
+        previous['BX_ID_LOVD'] = '17567'
+        self.previous_variant = Variant.objects.create_variant(row=previous)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_tsv(self, name, rows):
+        path = os.path.join(self.directory, name)
+        fieldnames = sorted(set(key for row in rows for key in row))
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, dialect='excel-tab', restval='-')
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def write_json(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def write_text(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def add_release(self, variants, deletions, reports, removed_reports, diff={}, reports_diff={}):
+        notes = {'schema': '', 'archive': '', 'date': '2020-01-01', 'notes': '', 'md5sum': '',
+                 'sources': ['ClinVar', 'LOVD']}
+        call_command('addrelease',
+                     self.write_tsv('variants.tsv', variants),
+                     self.write_json('notes.json', notes),
+                     self.write_tsv('deletions.tsv', deletions),
+                     self.write_json('diff.json', diff),
+                     self.write_tsv('reports.tsv', reports),
+                     self.write_tsv('removed_reports.tsv', removed_reports),
+                     self.write_json('reports_diff.json', reports_diff))
+        return DataRelease.objects.order_by('-id')[0]
+
+    def test_add_release(self):
+        changed_coordinate = self.previous_variant.Genomic_Coordinate_hg38
+        caches[RESPONSE_CACHE].set('response:stale', 'stale')
+        release = self.add_release(
+            variants=[
+                release_variant(changed_coordinate, 'changed_information', Source='ClinVar',
+                                BX_ID_ClinVar='100', BX_ID_LOVD='-'),
+                release_variant('chr17:g.999999:A>G', 'new', mupit_structure='1t15', Source='LOVD',
+                                BX_ID_ClinVar='-', BX_ID_LOVD='200,201'),
+                release_variant('chr17:g.999998:A>G', '', Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-'),
+            ],
+            deletions=[
+                release_variant('chr17:g.999997:A>G', '', Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-'),
+            ],
+            reports=[
+                release_report('ClinVar', '100'),
+                release_report('LOVD', '200'),
+                release_report('LOVD', '201', change_type=''),
+                release_report('LOVD', '300'),
+            ],
+            removed_reports=[
+                release_report('ClinVar', '38697'),
+                release_report('LOVD', '999'),
+            ])
+
+        variants = Variant.objects.filter(Data_Release=release).order_by('id')
+        self.assertEqual([(v.Genomic_Coordinate_hg38, v.Change_Type.name) for v in variants],
+                         [(changed_coordinate, 'changed_information'),
+                          ('chr17:g.999999:A>G', 'new'),
+                          ('chr17:g.999997:A>G', 'deleted')])
+        changed, new, deleted = variants
+
+        self.assertTrue(changed.Variant_in_ClinVar)
+        self.assertFalse(changed.Variant_in_LOVD)
+        self.assertIsNone(changed.Mupit_Structure)
+        self.assertEqual(new.Mupit_Structure.name, '1t15')
+        self.assertIsNone(deleted.Mupit_Structure)
+        self.assertEqual(new.HGVS_cDNA, self.previous_variant.HGVS_cDNA)
+        self.assertEqual(new.Hg37_Start, self.previous_variant.Hg37_Start)
+
+        self.assertEqual([InSilicoPriors.objects.get(Variant=v).applicablePrior for v in variants],
+                         ['0.02', '0.02', '0.02'])
+
+        reports = Report.objects.filter(Data_Release=release).order_by('id')
+        self.assertEqual([(r.Variant_id, r.Source, r.Change_Type.name) for r in reports],
+                         [(changed.id, 'ClinVar', 'new'),
+                          (changed.id, 'ClinVar', 'deleted'),
+                          (new.id, 'LOVD', 'new'),
+                          (new.id, 'LOVD', 'none')])
+        self.assertEqual([r.BX_ID_ClinVar for r in reports[:2]], ['100', '38697'])
+        self.assertEqual([r.BX_ID_LOVD for r in reports[2:]], ['200', '201'])
+
+        self.assertEqual(CurrentVariant.objects.get(Genomic_Coordinate_hg38=changed_coordinate).id, changed.id)
+        self.assertIsNone(caches[RESPONSE_CACHE].get('response:stale'))
+
+    def current_variants_and_words(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT word, release_id FROM words ORDER BY word, release_id")
+            words = cursor.fetchall()
+        return sorted(CurrentVariant.objects.values_list('id', 'Genomic_Coordinate_hg38')), words
+
+    def test_incremental_updates_match_rebuild(self):
+        '''Tests that adding and removing a release updates currentvariant and words like rebuilding them'''
+        changed_coordinate = self.previous_variant.Genomic_Coordinate_hg38
+        Variant.objects.create_variant(row=dict(test_data.new_variant(), Data_Release_id=self.previous_variant.Data_Release_id))
+        update_materialized_view()
+        update_autocomplete_words()
+        before = self.current_variants_and_words()
+
+        release = self.add_release(
+            variants=[release_variant(changed_coordinate, 'changed_classification', Source='LOVD',
+                                      BIC_Nomenclature='5074T>CHANGED', BX_ID_ClinVar='-', BX_ID_LOVD='-'),
+                      release_variant('chr17:g.999996:A>G', 'new', Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-')],
+            deletions=[], reports=[], removed_reports=[])
+        added = self.current_variants_and_words()
+        self.assertIn(('5074t>changed', release.id), added[1])
+        self.assertEqual(CurrentVariant.objects.get(Genomic_Coordinate_hg38=changed_coordinate).Data_Release_id, release.id)
+
+        update_materialized_view()
+        update_autocomplete_words()
+        self.assertEqual(self.current_variants_and_words(), added)
+
+        call_command('remove_last_release')
+        self.assertEqual(self.current_variants_and_words(), before)
+
+    def test_release_summary(self):
+        '''Tests that the summary of a release is stored when adding it and used by the releases view'''
+        release = self.add_release(
+            variants=[release_variant(self.previous_variant.Genomic_Coordinate_hg38, 'changed_classification',
+                                      Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-'),
+                      release_variant('chr17:g.999996:A>G', 'new', Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-')],
+            deletions=[release_variant('chr17:g.999997:A>G', '', Source='LOVD', BX_ID_ClinVar='-', BX_ID_LOVD='-')],
+            reports=[], removed_reports=[])
+        summary = DataReleaseSummary.objects.get(release=release)
+        self.assertEqual((summary.variants_added, summary.variants_classified, summary.variants_modified, summary.variants_deleted),
+                         (1, 1, 0, 1))
+
+        # the previous release has no stored summary, its variants are counted in one query
+        with self.assertNumQueries(5):
+            response = views.releases(RequestFactory().get('/data/releases'))
+        response_data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([(r['id'], r['variants_added'], r['variants_classified'], r['variants_modified'], r['variants_deleted'])
+                          for r in response_data['releases']],
+                         [(self.previous_variant.Data_Release_id, 1, 0, 0, 0), (release.id, 1, 1, 0, 1)])
+
+        call_command('remove_last_release')
+        self.assertFalse(DataReleaseSummary.objects.filter(release_id=release.id).exists())
+
+    def test_add_diffs(self):
+        '''Tests that diffs are matched to the variants and reports of the release, reports by SCV or submission id'''
+        changed_coordinate = self.previous_variant.Genomic_Coordinate_hg38
+        variant_diff = [{'field': 'Source', 'added': ['ClinVar'], 'removed': ['LOVD'], 'field_type': 'list'}]
+        clinvar_diff = [{'field': 'Clinical_Significance_ClinVar', 'added': 'Benign', 'removed': 'Uncertain_significance\\'}]
+        lovd_diff = [{'field': 'Remarks_LOVD', 'added': 'tab\there', 'removed': '-'}]
+        scv = test_data.existing_clinvar_report()['SCV_ClinVar']
+        submission_id = test_data.existing_lovd_report()['Submission_ID_LOVD']
+        release = self.add_release(
+            variants=[release_variant(changed_coordinate, 'changed_information', Source='ClinVar',
+                                      BX_ID_ClinVar='100', BX_ID_LOVD='200')],
+            deletions=[],
+            reports=[release_report('ClinVar', '100', change_type='changed_information'),
+                     release_report('LOVD', '200', change_type='changed_information')],
+            removed_reports=[],
+            diff={changed_coordinate: variant_diff, 'chr17:g.999995:A>G': variant_diff},
+            reports_diff={scv: clinvar_diff, submission_id: lovd_diff, 'SCV999': clinvar_diff})
+
+        variant = Variant.objects.get(Data_Release=release)
+        self.assertEqual(VariantDiff.objects.get().variant_id, variant.id)
+        self.assertEqual(VariantDiff.objects.get().diff, variant_diff)
+        self.assertEqual(sorted((d.report.Source, d.report_diff) for d in ReportDiff.objects.all()),
+                         [('ClinVar', clinvar_diff), ('LOVD', lovd_diff)])
+
+    def test_iterate_json_object(self):
+        '''Tests that the members of a JSON object are decoded one at a time, across chunks of the file'''
+        data = {'chr17:g.1:A>G': [{'field': 'a', 'added': 1.5e10, 'removed': None}], 'b': 12345, 'c': 'x\\"}', 'd': {}}
+        for text in [json.dumps(data), json.dumps(data, indent=4), '{}', ' { } ']:
+            for chunk_size in [1, 2, 7, 1000]:
+                with open(self.write_text('diff.json', text)) as f:
+                    self.assertEqual(dict(iterate_json_object(f, chunk_size)), json.loads(text), (text, chunk_size))
+
+        # numbers split across chunks
+        for text in ['{"a": 0.25}', '{"a": -12.5e-3, "b": 1E+2}', '{"a": [1, 20, 300]}', '{"a": 10}']:
+            for chunk_size in [1, 2, 4, 8]:
+                with open(self.write_text('diff.json', text)) as f:
+                    self.assertEqual(dict(iterate_json_object(f, chunk_size)), json.loads(text), (text, chunk_size))
+
+        for text in ['', '[]', '{"a": 1', '{"a" 1}', '{"a": 1,}']:
+            with open(self.write_text('diff.json', text)) as f, self.assertRaises(ValueError):
+                list(iterate_json_object(f, 2))
@@ -3,19 +3,24 @@ import os
 import string
 import shutil
 import tempfile
+import threading
 from os import path
 from urllib.parse import quote
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from brca import settings
-from data.models import Variant, CurrentVariant, ChangeType, DataRelease, Report
-from django.test import TestCase, RequestFactory
+from data.models import Variant, CurrentVariant, ChangeType, DataRelease, Report, VariantDiff, ReportDiff, VariantRepresentation
+from django.test import TestCase, SimpleTestCase, RequestFactory
 import data.views as views
+from django.core.cache import cache, caches
 from django.db import connection
-from unittest import skip
+from django.test.utils import CaptureQueriesContext
+from unittest import skip, skipUnless
+from unittest.mock import patch
 from django.test.client import RequestFactory
 from data import test_data
-from data.views import index, autocomplete, variant_reports, remove_disallowed_chars
-from .utilities import update_autocomplete_words
+from data.views import index, autocomplete, variant_reports, remove_disallowed_chars, stream_copy, apply_search
+from .snapshot import export_snapshot
+from .utilities import update_autocomplete_words, update_materialized_view, clear_response_cache, RESPONSE_CACHE
 
 '''
 NOTE:
@@ -38,17 +43,14 @@ def create_variant_and_materialized_view(variant_data):
         data_release = DataRelease.objects.get(id=release_id)
     except DataRelease.DoesNotExist:
         data_release = DataRelease.objects.create(date='2019-12-26', id=release_id, name=1)
-    with connection.cursor() as cursor:
-        cursor.execute("REFRESH MATERIALIZED VIEW currentvariant")
+    update_materialized_view(release_id)
     materialized_view = CurrentVariant.objects.get(Genomic_Coordinate_hg38=variant.Genomic_Coordinate_hg38)
-    update_autocomplete_words()
+    update_autocomplete_words(release_id)
     return (variant, materialized_view)
 
 def create_report_and_associate_to_variant(report_data, variant):
     report_data['Variant'] = variant
     report = Report.objects.create_report(report_data)
-    with connection.cursor() as cursor:
-        cursor.execute("REFRESH MATERIALIZED VIEW currentvariant")
     return report
 
 
@@ -60,6 +62,8 @@ class VariantTestCase(TestCase):
         test_data.py file in this same directory.
         """
         self.factory = RequestFactory()
+        cache.clear()
+        caches[RESPONSE_CACHE].clear()
         (self.existing_variant, self.existing_variant_materialized_view) = create_variant_and_materialized_view(test_data.existing_variant())
         self.existing_clinvar_report = create_report_and_associate_to_variant(test_data.existing_clinvar_report(), self.existing_variant)
         self.existing_lovd_report = create_report_and_associate_to_variant(test_data.existing_lovd_report(), self.existing_variant)
@@ -94,6 +98,242 @@ class VariantTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.content.decode('utf-8'))['count'], 1)
 
+    def create_variants_to_page(self):
+        for position in range(5):
+            variant = test_data.existing_variant()
+            variant['Genomic_Coordinate_hg38'] = 'chr17:g.%d:A>G' % (43000000 + position)
+            variant['Genomic_HGVS_38'] = None if position % 2 else 'NC_000017.11:g.%dA>G' % (43000000 + position)
+            create_variant_and_materialized_view(variant)
+
+    def get_pages_by_cursor(self, listing):
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            response = index(self.factory.get('/data/?format=json&include=Variant_in_ENIGMA&page_size=2&%s&cursor=%s' % (listing, cursor)))
+            response_data = json.loads(response.content.decode('utf-8'))
+            pages.append(response_data['data'])
+            cursor = response_data['nextCursor']
+        return pages
+
+    def test_keyset_pagination(self):
+        """Tests that paging by cursor returns the same pages as paging by page number"""
+        self.create_variants_to_page()
+        for listing in ['order_by=Genomic_Coordinate_hg38&direction=descending',
+                        'order_by=Genomic_HGVS_38&direction=ascending',
+                        'order_by=Genomic_HGVS_38&direction=descending',
+                        'order_by=Genomic_Coordinate_hg38&column=Genomic_Coordinate_hg38&column=Protein_Change']:
+            pages = self.get_pages_by_cursor(listing)
+
+            expected_pages = []
+            for page_num in range(3):
+                response = index(self.factory.get('/data/?format=json&include=Variant_in_ENIGMA&page_size=2&page_num=%d&%s' % (page_num, listing)))
+                expected_pages.append(json.loads(response.content.decode('utf-8'))['data'])
+
+            self.assertEqual([len(page) for page in pages], [2, 2, 2], listing)
+            self.assertEqual(pages, expected_pages, listing)
+
+    def test_malformed_cursor(self):
+        """Tests that listings with a malformed cursor are bad requests"""
+        self.create_variants_to_page()
+        listing = '/data/?format=json&include=Variant_in_ENIGMA&page_size=2&order_by=Genomic_Coordinate_hg38&cursor=%s'
+        for cursor in ['x', '%C3%A4', views.encode_cursor(['chr17:g.43000001:A>G'])[:-2], views.encode_cursor({}),
+                       views.encode_cursor(['chr17:g.43000001:A>G', 1])]:
+            response = index(self.factory.get(listing % cursor))
+            self.assertEqual(response.status_code, 400, cursor)
+            # errors aren't tagged, nor answered as not modified
+            self.assertFalse(response.has_header('ETag'))
+            self.assertEqual(index(self.factory.get(listing % cursor, HTTP_IF_NONE_MATCH='*')).status_code, 400)
+
+    def test_counts_cached(self):
+        """Tests that counts of a listing are only counted again after a release is loaded"""
+        self.create_variants_to_page()
+        listing = '/data/?format=json&include=Variant_in_ENIGMA&page_size=2&order_by=Genomic_Coordinate_hg38&search_term=chr17&page_num=%d'
+
+        index(self.factory.get(listing % 0))
+        with CaptureQueriesContext(connection) as queries:
+            response = index(self.factory.get(listing % 1))
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['count'], 6)
+
+        create_variant_and_materialized_view(dict(test_data.new_variant(), Data_Release_id=DataRelease.objects.create(id=2, date='2020-01-01', name=2).id))
+        response = index(self.factory.get(listing % 1))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['count'], 7)
+
+    def test_data_changed_in_place(self):
+        """
+        Tests that ETags, cached responses and cached counts don't match anymore once data is changed without adding
+        a release, also if the caches of this process aren't cleared (the change is made by a management command)
+        """
+        self.create_variants_to_page()
+        listing = '/data/?format=json&include=Variant_in_ENIGMA&page_size=2&order_by=Genomic_Coordinate_hg38&page_num=1'
+        index(self.factory.get(listing))
+        etag = views.variant_counts(self.factory.get('/data/variant_counts'))['ETag']
+
+        CurrentVariant.objects.filter(Genomic_Coordinate_hg38='chr17:g.43000001:A>G').update(Variant_in_ENIGMA=False)
+        with patch('data.utilities.caches'):
+            clear_response_cache()
+
+        response = views.variant_counts(self.factory.get('/data/variant_counts', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = index(self.factory.get(listing))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['count'], 5)
+
+    def test_snapshot_listings(self):
+        """Tests that listings served from the snapshot of the latest release match those served by Postgres"""
+        self.create_variants_to_page()
+        create_variant_and_materialized_view(test_data.new_variant())
+        deleted_variant = dict(test_data.new_variant(), Change_Type_id=ChangeType.objects.get(name='deleted').id,
+                               Genomic_Coordinate_hg38='chr17:g.43000010:A>G', Gene_Symbol='BRCA2')
+        create_variant_and_materialized_view(deleted_variant)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        export_snapshot(root)
+
+        sources = '&include=Variant_in_ENIGMA&include=Variant_in_ClinVar&include=Variant_in_LOVD'
+        for listing in ['include=all&order_by=Genomic_Coordinate_hg38',
+                        'include=all&order_by=Genomic_HGVS_38&direction=descending&page_size=3&page_num=1',
+                        'include=all&order_by=Genomic_HGVS_38&direction=ascending&page_size=3&page_num=2',
+                        'include=all&order_by=HGVS_cDNA&direction=descending&show_deleted=true',
+                        'order_by=Gene_Symbol' + sources + '&exclude=Variant_in_BIC&column=id&column=Gene_Symbol',
+                        'order_by=Gene_Symbol' + sources + '&filter=Genomic_Coordinate_hg38&filterValue=chr17:g.4300000',
+                        'order_by=Gene_Symbol' + sources + '&filter=Gene_Symbol&filterValue=BRCA2&show_deleted=true',
+                        'include=all&filter=id&filterValue=%d&column=id' % self.existing_variant_materialized_view.id,
+                        'order_by=Gene_Symbol']:
+            request = '/data/?format=json&' + listing
+            caches[RESPONSE_CACHE].clear()
+            expected = index(self.factory.get(request))
+            caches[RESPONSE_CACHE].clear()
+            with self.settings(VARIANT_SNAPSHOT_ROOT=root), CaptureQueriesContext(connection) as queries:
+                response = index(self.factory.get(request))
+            self.assertNotIsInstance(response, JsonResponse, listing)
+            self.assertFalse([query for query in queries if 'currentvariant' in query['sql']], listing)
+            self.assertEqual(response.content, expected.content, listing)
+
+        # searches and listings of a release, or of a release the snapshot wasn't exported for, are served by Postgres
+        caches[RESPONSE_CACHE].clear()
+        with self.settings(VARIANT_SNAPSHOT_ROOT=root):
+            self.assertIsInstance(index(self.factory.get('/data/?format=json&include=all&search_term=BRCA2')), JsonResponse)
+            create_variant_and_materialized_view(dict(test_data.new_variant(), Genomic_Coordinate_hg38='chr17:g.43000011:A>G',
+                                                      Data_Release_id=DataRelease.objects.create(id=2, date='2020-01-01', name=2).id))
+            response = index(self.factory.get('/data/?format=json&include=all'))
+        self.assertIsInstance(response, JsonResponse)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['count'], 8)
+
+    def test_snapshot_reexport(self):
+        """Tests that listings are served from a new export once the current variants were updated in place"""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        request = '/data/?format=json&include=all&filter=Gene_Symbol&filterValue=BRCA&column=Gene_Symbol'
+        with self.settings(VARIANT_SNAPSHOT_ROOT=root):
+            first = export_snapshot(root)
+            response = index(self.factory.get(request))
+            self.assertEqual(json.loads(response.content.decode('utf-8'))['data'], [{'Gene_Symbol': 'BRCA1'}])
+
+            CurrentVariant.objects.update(Gene_Symbol='BRCA2')
+            second = export_snapshot(root)
+            self.assertNotEqual(first, second)
+            self.assertFalse(path.exists(first))
+            caches[RESPONSE_CACHE].clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = index(self.factory.get(request))
+            self.assertFalse([query for query in queries if 'currentvariant' in query['sql']])
+            self.assertEqual(json.loads(response.content.decode('utf-8'))['data'], [{'Gene_Symbol': 'BRCA2'}])
+
+    def test_response_cache(self):
+        """Tests that responses are cached and tagged until a release is added"""
+        request = self.factory.get('/data/variant_counts?x=1')
+        response = views.variant_counts(request)
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            cached_response = views.variant_counts(self.factory.get('/data/variant_counts?x=1'))
+        self.assertEqual(cached_response.content, response.content)
+        self.assertEqual(cached_response['ETag'], etag)
+
+        for if_none_match in [etag, etag.replace('"', ';gzip"') + ', "other"']:
+            not_modified = views.variant_counts(self.factory.get('/data/variant_counts?x=1', HTTP_IF_NONE_MATCH=if_none_match))
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, b'')
+
+        self.assertNotEqual(views.variant_counts(self.factory.get('/data/variant_counts?x=2'))['ETag'], etag)
+
+        DataRelease.objects.create(id=2, date='2020-01-01', name=2)
+        response = views.variant_counts(self.factory.get('/data/variant_counts?x=1', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_variant_counts(self):
+        """Tests that variants are counted by gene and ENIGMA classification in one query"""
+        for position, (gene, pathogenicity, enigma) in enumerate([('BRCA1', 'Pathogenic', True),
+                                                                  ('BRCA2', 'Likely benign', True),
+                                                                  ('BRCA2', 'Benign / Little Clinical Significance', True),
+                                                                  ('BRCA2', 'Pathogenic', False)]):
+            variant = test_data.existing_variant()
+            variant.update(Genomic_Coordinate_hg38='chr17:g.%d:A>G' % (43000000 + position), Gene_Symbol=gene,
+                           Pathogenicity_expert=pathogenicity, Variant_in_ENIGMA=enigma)
+            create_variant_and_materialized_view(variant)
+
+        # the latest release version (for the response cache) and the counts
+        with self.assertNumQueries(2):
+            response = views.variant_counts(self.factory.get('/data/variant_counts'))
+
+        response_data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(response_data['total'], 5)
+        # the existing variant is a benign BRCA1 variant
+        self.assertEqual(response_data['brca1'], {'total': 2, 'pathogenic': 1, 'benign': 1, 'likelyBenign': 0, 'likelyPathogenic': 0})
+        self.assertEqual(response_data['brca2'], {'total': 3, 'pathogenic': 0, 'benign': 1, 'likelyBenign': 1, 'likelyPathogenic': 0})
+        self.assertEqual(response_data['enigma'], self.existing_variant.Variant_in_ENIGMA + 3)
+
+    def test_variantreps_streamed(self):
+        """Tests that the representations of the current variants are streamed as one JSON document"""
+        self.create_variants_to_page()
+        for coordinate in ['chr17:g.43000001:A>G', 'chr17:g.43000003:A>G', 'chr17:g.43000004:A>G', 'chr17:g.1:A>G']:
+            VariantRepresentation.objects.create(Genomic_Coordinate_hg38=coordinate, Description={'coordinate': coordinate})
+        ids = dict(CurrentVariant.objects.values_list('Genomic_Coordinate_hg38', 'id'))
+
+        self.assertEqual(len(list(views.variantreps_rows(chunk_size=2))), 3)
+        response = views.variantreps(self.factory.get('/data/variantreps/'))
+        self.assertIsInstance(response, StreamingHttpResponse)
+        response_data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(response_data['count'], 3)
+        self.assertEqual(response_data['data'], [
+            {'id': ids[coordinate], 'Genomic_Coordinate_hg38': coordinate, 'vr_rep': {'coordinate': coordinate}}
+            for coordinate in ['chr17:g.43000001:A>G', 'chr17:g.43000003:A>G', 'chr17:g.43000004:A>G']])
+
+    def get_sitemap(self, query=''):
+        response = views.sitemap(self.factory.get('/data/sitemap.txt' + query))
+        self.assertIsInstance(response, StreamingHttpResponse)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_sitemap(self):
+        """Tests that the sitemap lists the root links and the current variants"""
+        self.create_variants_to_page()
+        ids = list(CurrentVariant.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(list(views.iterate_ids(CurrentVariant.objects.all(), start=1, chunk_size=2)), ids[1:])
+        self.assertEqual(self.get_sitemap().split('\n'),
+                         views.SITEMAP_ROOT_LINKS + ['https://brcaexchange.org/variant/%d' % id for id in ids])
+
+    @patch('data.views.SITEMAP_MAX_URLS', 5)
+    def test_sitemap_index(self):
+        """Tests that sitemaps of more than SITEMAP_MAX_URLS URLs are split into pages listed by a sitemap index"""
+        self.create_variants_to_page()
+        ids = list(CurrentVariant.objects.order_by('id').values_list('id', flat=True))
+
+        sitemap_index = self.get_sitemap()
+        self.assertIn('<sitemapindex', sitemap_index)
+        self.assertEqual(sitemap_index.count('<loc>'), 3)
+        self.assertIn('<loc>http://testserver/data/sitemap.txt?page=2</loc>', sitemap_index)
+
+        pages = [self.get_sitemap('?page=%d' % page).split('\n') for page in range(3)]
+        self.assertEqual([len(page) for page in pages], [5, 5, 3])
+        self.assertEqual(sum(pages, []), views.SITEMAP_ROOT_LINKS + ['https://brcaexchange.org/variant/%d' % id for id in ids])
+
+        for page, status_code in [('x', 400), ('-1', 400), ('1.5', 400), ('%C2%B3', 400), ('', 400), ('3', 404)]:
+            response = views.sitemap(self.factory.get('/data/sitemap.txt?page=' + page, HTTP_IF_NONE_MATCH='*'))
+            self.assertEqual(response.status_code, status_code, page)
+            self.assertFalse(response.has_header('ETag'))
+
     @skip("Not complete")
     def test_format_tsv(self):
         '''Tests format parameter with format tsv'''
@@ -139,6 +379,19 @@ class VariantTestCase(TestCase):
         self.assertEqual(response.content.decode('utf-8')['count'], 1)
         self.assertTrue(response.content.decode('utf-8')['data'][0]['Genomic_Coordinate_hg38'] != variant_2['Genomic_Coordinate_hg38'])
 
+    def test_format_tsv_streamed(self):
+        '''Tests that the tsv export is streamed and contains the header and the variant'''
+        request = self.factory.get(
+            '/data/?format=tsv&order_by=Gene_Symbol&direction=ascending&search_term=&include=Variant_in_ENIGMA&include=Variant_in_ClinVar&include=Variant_in_1000_Genomes&include=Variant_in_ExAC&include=Variant_in_LOVD&include=Variant_in_BIC&include=Variant_in_ESP&include=Variant_in_exLOVD')
+        response = index(request)
+
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Genomic_Coordinate_hg38', lines[0].split('\t'))
+        self.assertIn(self.existing_variant.Genomic_Coordinate_hg38, lines[1].split('\t'))
+
     def test_search_by_id(self):
         """Tests searching for a variant by id using a filter"""
         existing_current_variant_id = self.existing_variant_materialized_view.id
@@ -191,6 +444,16 @@ class VariantTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertJSONEqual(response.content.decode('utf-8'), {"suggestions": expected_autocomplete_results})
 
+    def test_autocomplete_limit(self):
+        """Only the first limit suggestions are returned"""
+        create_variant_and_materialized_view(test_data.new_variant())
+        existing_variant_nucleotide = self.existing_variant_materialized_view.HGVS_cDNA.split(':')[1].lower()
+
+        request = self.factory.get('/data/suggestions/?term=%s&limit=1' % quote('c.4955'))
+        response = autocomplete(request)
+
+        self.assertJSONEqual(response.content.decode('utf-8'), {"suggestions": [[existing_variant_nucleotide]]})
+
     def test_source_filters_all_off(self):
         """Tests all source filters on returns no variants"""
         request = self.factory.get(
@@ -683,6 +946,28 @@ class VariantTestCase(TestCase):
 
             self.assertEqual(response_data['count'], 1, message)
 
+    def test_search_synonyms_count(self):
+        """Tests that matches and the number of matches by synonyms only are counted in a single query"""
+        for search_term, count, synonyms in [('u14680.1', 1, 1), ('m1652t', 1, 0), ('brca1:c.4955', 1, 0),
+                                             ('brca1:nm_007294.2', 1, 1), ('np_009225.1:m1652t', 1, 0)]:
+            with self.assertNumQueries(1):
+                results, synonyms_count = apply_search(CurrentVariant.objects, search_term)
+            self.assertEqual((results.count(), synonyms_count), (count, synonyms), search_term)
+
+    @skipUnless(connection.vendor == 'postgresql', 'requires postgres')
+    def test_search_uses_trigram_index(self):
+        """Tests that searches are able to use the trigram index of currentvariant if pg_trgm is installed"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'currentvariant_search_idx'")
+            if not cursor.fetchone():
+                self.skipTest('pg_trgm is not installed')
+            results, _ = apply_search(CurrentVariant.objects, 'c.4955T>C')
+            sql, params = results.query.sql_with_params()
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN " + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('currentvariant_search_idx', plan)
+
     def test_genomic_coordinate_without_g(self):
         '''Tests that searching for a variant with a genomic_coordinate_hg38 search term is successful'''
         existing_genomic_coordinate = self.existing_variant_materialized_view.Genomic_Coordinate_hg38
@@ -1108,3 +1393,102 @@ class VariantTestCase(TestCase):
         self.assertEqual(len(response_data['data']), 4)
         self.assertEqual(len(clinvar_reports), 2)
         self.assertEqual(len(lovd_reports), 2)
+
+
+    def create_variant_versions_with_reports(self):
+        """
+        Creates two further versions of the existing variant with diffs, each with new versions of the existing
+        reports and another ClinVar and LOVD report. Returns the latest version of the variant.
+        """
+        change_types = {x['name']: x['id'] for x in ChangeType.objects.values()}
+        for release_id in [2, 3]:
+            DataRelease.objects.create(date='2020-01-0%d' % release_id, id=release_id, name=release_id)
+            variant_data = test_data.existing_variant()
+            variant_data['Data_Release_id'] = release_id
+            variant_data['Change_Type_id'] = change_types['changed_information']
+            variant = Variant.objects.create_variant(row=variant_data)
+            VariantDiff.objects.create(variant=variant, diff=[{'field': 'Allele_Frequency', 'release': release_id}])
+
+            for report_data in [test_data.existing_clinvar_report(), test_data.existing_lovd_report()]:
+                report_data['Data_Release_id'] = release_id
+                report = create_report_and_associate_to_variant(report_data, variant)
+                ReportDiff.objects.create(report=report, report_diff=[{'release': release_id}])
+            other_clinvar_report = test_data.existing_clinvar_report()
+            other_clinvar_report.update(Data_Release_id=release_id, SCV_ClinVar='SCV00000000%d' % release_id)
+            create_report_and_associate_to_variant(other_clinvar_report, variant)
+            other_lovd_report = test_data.existing_lovd_report()
+            other_lovd_report.update(Data_Release_id=release_id, Submission_ID_LOVD='submission %d' % release_id)
+            create_report_and_associate_to_variant(other_lovd_report, variant)
+        update_materialized_view(3)
+        return variant
+
+    def test_variant_query_count(self):
+        """Tests that all versions of a variant with their diffs are fetched with a constant number of queries"""
+        variant = self.create_variant_versions_with_reports()
+        request = self.factory.get('/data/variant/?variant_id=%d' % variant.id)
+        views.change_type_name(variant.Change_Type_id)
+
+        with self.assertNumQueries(2):
+            response = views.variant(request)
+
+        response_data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([version['Data_Release']['id'] for version in response_data['data']], [3, 2, 1])
+        self.assertEqual([version['Change_Type'] for version in response_data['data']],
+                         ['changed_information', 'changed_information', 'new'])
+        self.assertEqual([version['Diff'] for version in response_data['data']],
+                         [[{'field': 'Allele_Frequency', 'release': 3}], [{'field': 'Allele_Frequency', 'release': 2}], None])
+
+    def test_variant_reports_query_count(self):
+        """Tests that the reports of a variant and their histories are fetched with a constant number of queries"""
+        variant = self.create_variant_versions_with_reports()
+        request = self.factory.get('/data/variant/%s/reports' % variant.id)
+        views.change_type_name(variant.Change_Type_id)
+
+        with self.assertNumQueries(2):
+            response = variant_reports(request, variant.id)
+
+        response_data = json.loads(response.content.decode('utf-8'))
+        versions = [(report['Source'], report['Data_Release']['id'], report['Diff']) for report in response_data['data']]
+        self.assertEqual(sorted(versions, key=str), sorted([
+            ('ClinVar', 3, [{'release': 3}]), ('ClinVar', 2, [{'release': 2}]), ('ClinVar', 1, None),
+            ('LOVD', 3, [{'release': 3}]), ('LOVD', 2, [{'release': 2}]), ('LOVD', 1, None),
+            ('ClinVar', 3, None), ('LOVD', 3, None)
+        ], key=str))
+
+
+class FakeCopyCursor:
+    """Cursor writing rows to the copy_expert file until done or aborted"""
+    def __init__(self, num_rows):
+        self.num_rows = num_rows
+        self.rows_written = 0
+        self.closed = False
+
+    def copy_expert(self, query, f):
+        for i in range(self.num_rows):
+            f.write(b'%d\tvalue\n' % i)
+            self.rows_written += 1
+
+    def close(self):
+        self.closed = True
+
+
+class StreamCopyTestCase(SimpleTestCase):
+    def test_stream_copy_chunks(self):
+        cursor = FakeCopyCursor(10000)
+        chunks = list(stream_copy(cursor, 'COPY (SELECT 1) TO STDOUT', chunk_size=1000))
+
+        self.assertEqual(b''.join(chunks), b''.join(b'%d\tvalue\n' % i for i in range(10000)))
+        self.assertTrue(all(len(chunk) < 1100 for chunk in chunks))
+        self.assertTrue(cursor.closed)
+
+    @patch('data.views.connection')
+    def test_stream_copy_aborted(self, connection):
+        cursor = FakeCopyCursor(10 ** 9)
+        chunks = stream_copy(cursor, 'COPY (SELECT 1) TO STDOUT', chunk_size=1000)
+        next(chunks)
+        chunks.close()
+
+        # the copy stops once the queue of chunks is full and the connection is discarded
+        self.assertLess(cursor.rows_written, 10 ** 5)
+        self.assertEqual(threading.active_count(), 1)
+        connection.close.assert_called_once_with()
@@ -1,49 +1,232 @@
-from django.db import connection
-from .models import DataRelease, CurrentVariant, Variant, MupitStructure
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.http import HttpResponseNotModified
+from .models import DataRelease, DataReleaseSummary, CurrentVariant, Variant, MupitStructure
+from functools import wraps
+import hashlib
 import requests
 import json
 import sys
 import time
 
+# cache of the responses of views decorated with cache_per_release, see CACHES in brca/settings.py
+RESPONSE_CACHE = 'responses'
 
-def update_autocomplete_words():
-        # Drop words table and recreate with latest data
-        with connection.cursor() as cursor:
+
+AUTOCOMPLETE_WORDS_QUERY = """
+    SELECT DISTINCT left(word, 300) as word, release_id FROM (
+    SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg38"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg37"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("Clinical_significance_ENIGMA"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("Gene_Symbol"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("Reference_Sequence"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("HGVS_cDNA"), '[\s|:''"]')  as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("BIC_Nomenclature"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where} UNION
+    SELECT regexp_split_to_table(lower("HGVS_Protein"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant {where}
+    )
+    AS combined_words
+"""
+
+CURRENT_VARIANTS_QUERY = """
+    SELECT * FROM "variant" WHERE (
+        "id" IN ( SELECT DISTINCT ON ("Genomic_Coordinate_hg38") "id" FROM "variant" ORDER BY "Genomic_Coordinate_hg38" ASC, "Data_Release_id" DESC )
+    )
+"""
+
+# columns of currentvariant matched with icontains and istartswith by apply_search in data/views.py, Django
+# compares them as UPPER(column) LIKE UPPER(term), which the trigram index on UPPER(column) supports
+SEARCH_COLUMNS = [
+    "Pathogenicity_expert", "Genomic_Coordinate_hg38", "Genomic_Coordinate_hg37", "Genomic_HGVS_38",
+    "Genomic_HGVS_37", "Synonyms", "Gene_Symbol", "HGVS_cDNA", "BIC_Nomenclature", "HGVS_Protein",
+    "Protein_Change", "SCV_ClinVar", "ClinVarAccession_ENIGMA", "CA_ID", "VR_ID"
+]
+
+# creates the trigram index of the searched columns if the pg_trgm extension is installed (see migration 0059)
+SEARCH_INDEX_QUERY = """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX {name} ON {table} USING gin ({columns});
+        END IF;
+    END
+    $$;
+"""
+
+
+def search_index_query(name, table):
+    columns = ', '.join('UPPER("%s") gin_trgm_ops' % column for column in SEARCH_COLUMNS)
+    return SEARCH_INDEX_QUERY.format(name=name, table=table, columns=columns)
+
+
+def update_autocomplete_words(release_id=None):
+    """
+    Words of a release only depend on the variants of that release. Given a release id, replaces the words of
+    that release only, otherwise rebuilds the words table in the background and swaps it in.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        if release_id is not None:
+            cursor.execute("DELETE FROM words WHERE release_id = %s", [release_id])
+            cursor.execute("INSERT INTO words " + AUTOCOMPLETE_WORDS_QUERY.format(where='WHERE "Data_Release_id" = %(release_id)s'),
+                           {'release_id': release_id})
+        else:
             cursor.execute("""
+                DROP TABLE IF EXISTS words_new;
+                CREATE TABLE words_new AS {words};
+                CREATE INDEX words_new_idx ON words_new(word text_pattern_ops);
+                CREATE INDEX words_new_release_idx ON words_new(release_id, word text_pattern_ops);
+
                 DROP TABLE IF EXISTS words;
-                CREATE TABLE words AS SELECT DISTINCT left(word, 300) as word, release_id FROM (
-                SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg38"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Genomic_Coordinate_hg37"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Clinical_significance_ENIGMA"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Gene_Symbol"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("Reference_Sequence"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("HGVS_cDNA"), '[\s|:''"]')  as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("BIC_Nomenclature"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant UNION
-                SELECT regexp_split_to_table(lower("HGVS_Protein"), '[\s|''"]') as word, "Data_Release_id" as release_id from variant
-                )
-                AS combined_words;
-
-                CREATE INDEX words_idx ON words(word text_pattern_ops);
-            """)
-
-
-def update_materialized_view():
-    with connection.cursor() as cursor:
-        cursor.execute(
-            """
-            DROP MATERIALIZED VIEW IF EXISTS currentvariant;
-                CREATE MATERIALIZED VIEW currentvariant AS (
-                    SELECT * FROM "variant" WHERE (
-                        "id" IN ( SELECT DISTINCT ON ("Genomic_Coordinate_hg38") "id" FROM "variant" ORDER BY "Genomic_Coordinate_hg38" ASC, "Data_Release_id" DESC )
+                ALTER TABLE words_new RENAME TO words;
+                ALTER INDEX words_new_idx RENAME TO words_idx;
+                ALTER INDEX words_new_release_idx RENAME TO words_release_idx;
+            """.format(words=AUTOCOMPLETE_WORDS_QUERY.format(where='')))
+
+
+def update_materialized_view(release_id=None):
+    """
+    Updates currentvariant, the latest version of every variant. currentvariant is a table maintained like a
+    materialized view of CURRENT_VARIANTS_QUERY, so adding or removing a release only touches its variants:
+    given a release id, replaces the current versions of the variants of that release (after its variants
+    were added or deleted). Otherwise, rebuilds the table in the background and swaps it in, which is needed
+    after variants were updated in place or variant columns changed.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        if release_id is not None:
+            cursor.execute(
+                """
+                CREATE TEMPORARY TABLE _changed_coordinates AS
+                    SELECT "Genomic_Coordinate_hg38" FROM currentvariant WHERE "Data_Release_id" = %(release_id)s UNION
+                    SELECT "Genomic_Coordinate_hg38" FROM variant WHERE "Data_Release_id" = %(release_id)s;
+
+                DELETE FROM currentvariant
+                WHERE "Genomic_Coordinate_hg38" IN (SELECT "Genomic_Coordinate_hg38" FROM _changed_coordinates);
+
+                INSERT INTO currentvariant
+                    SELECT * FROM "variant" WHERE "id" IN (
+                        SELECT DISTINCT ON ("Genomic_Coordinate_hg38") "id" FROM "variant"
+                        WHERE "Genomic_Coordinate_hg38" IN (SELECT "Genomic_Coordinate_hg38" FROM _changed_coordinates)
+                        ORDER BY "Genomic_Coordinate_hg38" ASC, "Data_Release_id" DESC
                     )
-                );
-            """
-        )
+                    ORDER BY "id";
+
+                DROP TABLE _changed_coordinates;
+                """,
+                {'release_id': release_id}
+            )
+        else:
+            cursor.execute(
+                """
+                DROP TABLE IF EXISTS currentvariant_new;
+                CREATE TABLE currentvariant_new AS ({current_variants});
+                ALTER TABLE currentvariant_new ADD CONSTRAINT currentvariant_new_pkey PRIMARY KEY (id);
+                CREATE UNIQUE INDEX currentvariant_new_hg38_idx ON currentvariant_new ("Genomic_Coordinate_hg38");
+                CREATE INDEX currentvariant_new_release_idx ON currentvariant_new ("Data_Release_id");
+                {search_index}
+
+                DROP TABLE IF EXISTS currentvariant;
+                ALTER TABLE currentvariant_new RENAME TO currentvariant;
+                ALTER INDEX currentvariant_new_pkey RENAME TO currentvariant_pkey;
+                ALTER INDEX currentvariant_new_hg38_idx RENAME TO currentvariant_hg38_idx;
+                ALTER INDEX currentvariant_new_release_idx RENAME TO currentvariant_release_idx;
+                ALTER INDEX IF EXISTS currentvariant_new_search_idx RENAME TO currentvariant_search_idx;
+                """.format(current_variants=CURRENT_VARIANTS_QUERY,
+                           search_index=search_index_query('currentvariant_new_search_idx', 'currentvariant_new'))
+            )
+
+
+# change types of the variants counted by each field of DataReleaseSummary
+RELEASE_SUMMARY_CHANGE_TYPES = {
+    'variants_added': ['new'],
+    'variants_classified': ['changed_classification', 'added_classification'],
+    'variants_modified': ['added_information', 'changed_information'],
+    'variants_deleted': ['deleted'],
+}
+
+
+def summarize_releases(release_ids):
+    """Given release ids, returns their (unsaved) summaries, counting their variants by change type in one query"""
+    summaries = dict((release_id, DataReleaseSummary(release_id=release_id, **dict.fromkeys(RELEASE_SUMMARY_CHANGE_TYPES, 0)))
+                     for release_id in release_ids)
+    counts = Variant.objects.filter(Data_Release_id__in=release_ids)\
+        .values('Data_Release_id', 'Change_Type__name').annotate(count=Count('id')).order_by()
+    for row in counts:
+        for field, change_types in RELEASE_SUMMARY_CHANGE_TYPES.items():
+            if row['Change_Type__name'] in change_types:
+                summary = summaries[row['Data_Release_id']]
+                setattr(summary, field, getattr(summary, field) + row['count'])
+    return [summaries[release_id] for release_id in release_ids]
+
+
+def update_release_summary(release_id):
+    """Stores the summary of a release, after its variants were added"""
+    DataReleaseSummary.objects.filter(release_id=release_id).delete()
+    DataReleaseSummary.objects.bulk_create(summarize_releases([release_id]))
+
+
+def latest_release_version():
+    """
+    Returns a string identifying the latest release as loaded. Besides the id it contains the time the release
+    was loaded, as remove_last_release resets the ids, so the id of a removed release is given to the next one,
+    and the data version of the release, which changes when its data is changed in place.
+    """
+    latest = DataRelease.objects.order_by('-id').values_list('id', 'created', 'data_version').first()
+    return '%s:%s:%s' % latest if latest else 'none'
+
+
+def clear_response_cache():
+    """
+    Drops the cached responses, which are stale once a release is added or removed or the data is changed. The
+    data version of the latest release is incremented, so that the ETags and the cached responses and counts of
+    the other processes (e.g. web workers when called by a management command) don't match anymore either.
+    """
+    latest = DataRelease.objects.order_by('-id').values_list('id', flat=True).first()
+    DataRelease.objects.filter(id=latest).update(data_version=F('data_version') + 1)
+    caches[RESPONSE_CACHE].clear()
+
+
+def cache_per_release(view):
+    """
+    Caches the responses of a view of release data by the latest release version and the query parameters, and
+    tags them with an ETag, so that requests with a matching If-None-Match get an empty 304 Not Modified response.
+    Streamed responses are tagged but not cached, error responses are neither.
+    """
+    @wraps(view)
+    def cached_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        params = sorted((key, request.GET.getlist(key)) for key in request.GET)
+        digest = hashlib.md5(json.dumps([latest_release_version(), view.__name__, request.path, args, kwargs, params],
+                                        sort_keys=True).encode('utf-8')).hexdigest()
+        etag = '"%s"' % digest
+
+        cache = caches[RESPONSE_CACHE]
+        key = 'response:' + digest
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                # errors aren't tagged, so that revalidating them doesn't give 304 Not Modified
+                return response
+            if not response.streaming:
+                cache.set(key, response)
+
+        # gzip_page appends ;gzip to the ETags of compressed responses
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip().replace(';gzip', '') for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            response = HttpResponseNotModified()
+            response['Access-Control-Allow-Origin'] = '*'
+        response['ETag'] = etag
+        return response
+
+    return cached_view
 
 
 def set_release_name_defaults(apps, schema_editor):
+    # the historical model, as fields added later don't exist yet when the migration runs
+    releases = apps.get_model('data', 'DataRelease').objects.all().order_by('date')
     count = 1
-    releases = DataRelease.objects.all().order_by('date')
     for release in releases:
         release.name = count
         release.save()
@@ -2,18 +2,27 @@ import os
 import re
 import tempfile
 import json
-import io
+import queue
+import base64
+import binascii
+import hashlib
+import itertools
+import threading
 from operator import __or__
 from django.core import serializers
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
 from django.db.models import Q
-from django.db.models import Value
+from django.db.models import Value, Case, When, BooleanField, Count, IntegerField
 from django.db.models.functions import Concat
 from django.forms.models import model_to_dict
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, StreamingHttpResponse
 from django.views.decorators.gzip import gzip_page
+from .utilities import cache_per_release, latest_release_version, summarize_releases, RELEASE_SUMMARY_CHANGE_TYPES
+from .snapshot import current_snapshot, snapshot_root
 from .models import (
-    Variant, VariantDiff, CurrentVariant, DataRelease, ChangeType, Report, ReportDiff,
+    Variant, VariantDiff, CurrentVariant, DataRelease, DataReleaseSummary, ChangeType, Report, ReportDiff,
     InSilicoPriors, VariantPaper, Paper, VariantRepresentation
 )
 from django.views.decorators.http import require_http_methods
@@ -23,10 +32,50 @@ from datetime import datetime
 from operator import itemgetter
 import logging
 from functools import reduce
+from collections import defaultdict
 
 DISALLOWED_SEARCH_CHARS = ['\x00']
 
+# csv/tsv exports are streamed in chunks of about this many bytes, at most EXPORT_QUEUE_CHUNKS of them are buffered
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_QUEUE_CHUNKS = 16
 
+# LOVD submission ids were redefined in the release of 12/2/2019, earlier LOVD reports aren't versions of later ones
+LOVD_SUBMISSION_CUTOFF_DATE = '2019-12-02'
+
+# names of change types by id, filled in by change_type_name
+CHANGE_TYPE_NAMES = {}
+
+# ENIGMA classifications counted by variant_counts, matching Pathogenicity_expert like the filters
+# Pathogenicity_expert='Pathogenic' and Pathogenicity_expert__contains='Benign' etc.
+ENIGMA_CLASSIFICATIONS = {
+    'pathogenic': lambda pathogenicity: pathogenicity == 'Pathogenic',
+    'benign': lambda pathogenicity: 'Benign' in pathogenicity,
+    'likelyBenign': lambda pathogenicity: 'Likely benign' in pathogenicity,
+    'likelyPathogenic': lambda pathogenicity: 'Likely pathogenic' in pathogenicity,
+}
+
+# sitemap and variantreps rows are fetched in chunks of this many rows
+STREAM_CHUNK_SIZE = 2000
+
+# sitemaps may contain at most 50000 URLs, see https://www.sitemaps.org/protocol.html
+SITEMAP_MAX_URLS = 50000
+
+SITEMAP_ROOT_LINKS = [
+    'https://brcaexchange.org/',
+    'https://brcaexchange.org/factsheet',
+    'https://brcaexchange.org/help',
+    'https://brcaexchange.org/community',
+    'https://brcaexchange.org/variants',
+    'https://brcaexchange.org/about/thisSite',
+    'https://brcaexchange.org/releases',
+]
+
+# counts of the variants listing are cached by latest release, so they are recomputed once a release is added or removed
+VARIANT_COUNTS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+@cache_per_release
 def releases(request):
     release_id = request.GET.get('release_id')
     if release_id:
@@ -34,59 +83,54 @@ def releases(request):
     else:
         releases = list(DataRelease.objects.values())
     latest = DataRelease.objects.order_by('-id')[0].id
-    change_types = {x['name']: x['id'] for x in list(ChangeType.objects.values())}
+    release_ids = [release['id'] for release in releases]
+    summaries = dict((summary.release_id, summary) for summary in DataReleaseSummary.objects.filter(release_id__in=release_ids))
+    # releases which weren't added by addrelease have no stored summary
+    missing = [release_id for release_id in release_ids if release_id not in summaries]
+    if missing:
+        summaries.update((summary.release_id, summary) for summary in summarize_releases(missing))
     for release in releases:
-        variants = Variant.objects.filter(Data_Release_id=release['id'])
-        release['variants_added'] = variants.filter(Change_Type_id=change_types['new']).count()
-        release['variants_classified'] = variants.filter(
-            Q(Change_Type_id=change_types['changed_classification']) | Q(Change_Type_id=change_types['added_classification'])).count()
-        release['variants_modified'] = variants.filter(
-            Q(Change_Type_id=change_types['added_information']) | Q(Change_Type_id=change_types['changed_information'])).count()
-        release['variants_deleted'] = variants.filter(Change_Type_id=change_types['deleted']).count()
+        for field in RELEASE_SUMMARY_CHANGE_TYPES:
+            release[field] = getattr(summaries[release['id']], field)
     response = JsonResponse({"releases": list(releases), "latest": latest})
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
+@cache_per_release
 def variant_counts(request):
-    query = CurrentVariant.objects.all().exclude(Change_Type__name='deleted')
-    total_count = query.count()
-    brca1_count = query.filter(Gene_Symbol='BRCA1').count()
-    brca2_count = query.filter(Gene_Symbol='BRCA2').count()
-    query = query.filter(Variant_in_ENIGMA=True)
-    enigma_count = query.count()
-    enigma_pathogenic_count = query.filter(Pathogenicity_expert='Pathogenic').count()
-    enigma_benign_count = query.filter(Pathogenicity_expert__contains='Benign').count()
-    enigma_likely_benign_count = query.filter(Pathogenicity_expert__contains='Likely benign').count()
-    enigma_likely_pathogenic_count = query.filter(Pathogenicity_expert__contains='Likely pathogenic').count()
-    query_brca1 = query.filter(Gene_Symbol='BRCA1')
-    brca1_enigma_pathogenic_count = query_brca1.filter(Pathogenicity_expert='Pathogenic').count()
-    brca1_enigma_benign_count = query_brca1.filter(Pathogenicity_expert__contains='Benign').count()
-    brca1_enigma_likely_benign_count = query_brca1.filter(Pathogenicity_expert__contains='Likely benign').count()
-    brca1_enigma_likely_pathogenic_count = query_brca1.filter(Pathogenicity_expert__contains='Likely pathogenic').count()
-    query_brca2 = query.filter(Gene_Symbol='BRCA2')
-    brca2_enigma_pathogenic_count = query_brca2.filter(Pathogenicity_expert='Pathogenic').count()
-    brca2_enigma_benign_count = query_brca2.filter(Pathogenicity_expert__contains='Benign').count()
-    brca2_enigma_likely_benign_count = query_brca2.filter(Pathogenicity_expert__contains='Likely benign').count()
-    brca2_enigma_likely_pathogenic_count = query_brca2.filter(Pathogenicity_expert__contains='Likely pathogenic').count()
+    # number of current variants by gene, classification and whether they are in ENIGMA, counted in one query
+    groups = CurrentVariant.objects.exclude(Change_Type__name='deleted')\
+        .values('Gene_Symbol', 'Pathogenicity_expert', 'Variant_in_ENIGMA').annotate(count=Count('id')).order_by()
+    counts = defaultdict(int)
+    for group in groups:
+        # None stands for all genes
+        for gene in (None, group['Gene_Symbol']):
+            counts[gene, 'total'] += group['count']
+            if group['Variant_in_ENIGMA']:
+                counts[gene, 'enigma'] += group['count']
+                for classification, matches in ENIGMA_CLASSIFICATIONS.items():
+                    if matches(group['Pathogenicity_expert']):
+                        counts[gene, classification] += group['count']
+
     response = JsonResponse({
-        "total": total_count,
+        "total": counts[None, 'total'],
         "brca1": {
-            "total": brca1_count,
-            "pathogenic": brca1_enigma_pathogenic_count,
-            "benign": brca1_enigma_benign_count,
-            "likelyBenign": brca1_enigma_likely_benign_count,
-            "likelyPathogenic": brca1_enigma_likely_pathogenic_count },
+            "total": counts['BRCA1', 'total'],
+            "pathogenic": counts['BRCA1', 'pathogenic'],
+            "benign": counts['BRCA1', 'benign'],
+            "likelyBenign": counts['BRCA1', 'likelyBenign'],
+            "likelyPathogenic": counts['BRCA1', 'likelyPathogenic'] },
         "brca2": {
-            "total": brca2_count,
-            "pathogenic": brca2_enigma_pathogenic_count,
-            "benign": brca2_enigma_benign_count,
-            "likelyBenign": brca2_enigma_likely_benign_count,
-            "likelyPathogenic": brca2_enigma_likely_pathogenic_count },
-        "enigma": enigma_count,
-        "enigmaPathogenic": enigma_pathogenic_count,
-        "enigmaLikelyPathogenic": enigma_likely_pathogenic_count,
-        "enigmaBenign": enigma_benign_count,
-        "enigmaLikelyBenign": enigma_likely_benign_count })
+            "total": counts['BRCA2', 'total'],
+            "pathogenic": counts['BRCA2', 'pathogenic'],
+            "benign": counts['BRCA2', 'benign'],
+            "likelyBenign": counts['BRCA2', 'likelyBenign'],
+            "likelyPathogenic": counts['BRCA2', 'likelyPathogenic'] },
+        "enigma": counts[None, 'enigma'],
+        "enigmaPathogenic": counts[None, 'pathogenic'],
+        "enigmaLikelyPathogenic": counts[None, 'likelyPathogenic'],
+        "enigmaBenign": counts[None, 'benign'],
+        "enigmaLikelyBenign": counts[None, 'likelyBenign'] })
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
@@ -120,7 +164,8 @@ def variant(request):
         .order_by('-Data_Release_id')\
         .select_related('Data_Release')\
         .select_related('Mupit_Structure')\
-        .select_related('insilicopriors')
+        .select_related('insilicopriors')\
+        .select_related('variantdiff')
 
     variant_versions = list(map(variant_to_dict, query))
     response = JsonResponse({"data": variant_versions})
@@ -167,46 +212,105 @@ def vrid(request):
     return response
 
 
+@cache_per_release
 def variantreps(request):
-    vr_reps = list(
-        VariantRepresentation.objects.raw("""
-        select VR.id, VR."Genomic_Coordinate_hg38", CV.id as Variant_id, VR."Description" from data_variantrepresentation VR
-        inner join currentvariant CV on CV."Genomic_Coordinate_hg38" = VR."Genomic_Coordinate_hg38"
-        """)
-    )
-
-    response = JsonResponse({
-        "count": len(vr_reps),
-        "data": list(
-            {'id': x.variant_id, 'Genomic_Coordinate_hg38': x.Genomic_Coordinate_hg38, 'vr_rep': x.Description}
-            for x in vr_reps
-        )
-    })
+    # the count is known once all representations are written, JSON doesn't require it to come first
+    response = StreamingHttpResponse(stream_json_object('data', variantreps_rows(), 'count'), content_type='application/json')
     response['Access-Control-Allow-Origin'] = '*'
 
     return response
 
 
+@cache_per_release
 def sitemap(request):
-    variants = CurrentVariant.objects.values_list('id')
-    root_links = [
-        'https://brcaexchange.org/',
-        'https://brcaexchange.org/factsheet',
-        'https://brcaexchange.org/help',
-        'https://brcaexchange.org/community',
-        'https://brcaexchange.org/variants',
-        'https://brcaexchange.org/about/thisSite',
-        'https://brcaexchange.org/releases',
-    ]
-    response = HttpResponse(
-        ("\n".join(root_links) + "\n") +
-        "\n".join("https://brcaexchange.org/variant/%s" % x[0] for x in variants)
-    )
+    """
+    Text sitemap of the site, at most SITEMAP_MAX_URLS URLs. Larger sitemaps are split into pages (?page=n), in which
+    case the sitemap itself is a sitemap index of the pages.
+    """
+    num_urls = len(SITEMAP_ROOT_LINKS) + CurrentVariant.objects.count()
+    num_pages = (num_urls + SITEMAP_MAX_URLS - 1) // SITEMAP_MAX_URLS
+    page = request.GET.get('page')
+    if page is not None:
+        try:
+            page = int(page)
+        except ValueError:
+            page = -1
+        if page < 0:
+            return HttpResponseBadRequest("page has to be a non-negative number")
+        if page >= max(num_pages, 1):
+            return HttpResponseNotFound("sitemap has %d pages" % num_pages)
+
+    if page is None and num_pages > 1:
+        sitemap_url = request.build_absolute_uri(request.path)
+        response = StreamingHttpResponse(
+            itertools.chain(
+                ['<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'],
+                ('<sitemap><loc>%s?page=%d</loc></sitemap>\n' % (sitemap_url, page_num) for page_num in range(num_pages)),
+                ['</sitemapindex>\n']),
+            content_type='application/xml')
+    else:
+        # the URLs are the root links followed by the variants, the page lists SITEMAP_MAX_URLS of them from start on
+        start = (page or 0) * SITEMAP_MAX_URLS
+        variant_ids = iterate_ids(CurrentVariant.objects.all(), start=max(start - len(SITEMAP_ROOT_LINKS), 0))
+        variant_urls = ("https://brcaexchange.org/variant/%s" % variant_id for variant_id in variant_ids)
+        urls = itertools.islice(itertools.chain(SITEMAP_ROOT_LINKS[start:], variant_urls), SITEMAP_MAX_URLS)
+        response = StreamingHttpResponse(join_lines(urls), content_type='text/plain')
     response['Access-Control-Allow-Origin'] = '*'
-    response['Content-Type'] = 'text/plain'
     return response
 
 
+def iterate_ids(query, start=0, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the ids of the rows of query in id order from the start-th on, fetching chunk_size ids per query
+    (by id rather than by offset, so that every chunk costs the same)
+    """
+    ids = query.order_by('id').values_list('id', flat=True)
+    chunk = list(ids[start:start + chunk_size])
+    while chunk:
+        for id in chunk:
+            yield id
+        if len(chunk) < chunk_size:
+            return
+        chunk = list(ids.filter(id__gt=chunk[-1])[:chunk_size])
+
+
+def join_lines(lines):
+    """Yields the newline separated lines (without a trailing newline)"""
+    for index, line in enumerate(lines):
+        yield ('\n' if index else '') + line
+
+
+def variantreps_rows(chunk_size=STREAM_CHUNK_SIZE):
+    """Yields the representations of the current variants, fetching chunk_size representations per query"""
+    last_id = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                select VR.id, CV.id, VR."Genomic_Coordinate_hg38", VR."Description" from data_variantrepresentation VR
+                inner join currentvariant CV on CV."Genomic_Coordinate_hg38" = VR."Genomic_Coordinate_hg38"
+                where VR.id > %s
+                order by VR.id
+                limit %s
+                """, [last_id, chunk_size])
+            rows = cursor.fetchall()
+        for _, variant_id, coordinate, description in rows:
+            yield {'id': variant_id, 'Genomic_Coordinate_hg38': coordinate, 'vr_rep': description}
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+def stream_json_object(items_key, items, count_key):
+    """Yields the JSON encoding of {items_key: [items], count_key: number of items} an item at a time"""
+    yield '{"%s": [' % items_key
+    count = 0
+    for item in items:
+        yield (', ' if count else '') + json.dumps(item, cls=DjangoJSONEncoder)
+        count += 1
+    yield '], "%s": %d}' % (count_key, count)
+
+
 def variant_reports(request, variant_id):
     variant_id = str(variant_id).lower().strip()
     variant_id = remove_disallowed_chars(variant_id)
@@ -222,42 +326,77 @@ def variant_reports(request, variant_id):
     else:
         variant_id = int(variant_id)
 
-    change_types_map = {x['name']:x['id'] for x in list(ChangeType.objects.values())}
-    query = Report.objects.filter(Variant_id=variant_id).exclude(Change_Type_id=change_types_map['deleted'])
+    query = Report.objects.filter(Variant_id=variant_id).exclude(Change_Type__name='deleted')\
+        .select_related('Data_Release').select_related('reportdiff')
+    reports = list(query)
+    versions_by_key = get_report_versions_by_key(reports)
+
     report_versions = []
-    for report in query:
-        key = None
-        if report.Source == "ClinVar":
-            key = report.SCV_ClinVar
-            if not key or key == '-':
-                # if no key is available, skip report history
-                report_query = [report]
-            else:
-                # extend the selection w/reports that have matching keys,
-                # but only up until the requested variants' release
-                report_query = Report.objects\
-                    .filter(Data_Release_id__lte=report.Data_Release.id, SCV_ClinVar=key)\
-                    .order_by('-Data_Release_id').select_related('Data_Release')
-            report_versions.extend(list(map(report_to_dict, report_query)))
-        elif report.Source == "LOVD":
-            # only return submissions on or after 12/2/2019 since we redefined submission ids in this release
-            cutoff_date = '2019-12-02'
-            key = report.Submission_ID_LOVD
-            if not key or key == '-':
-                # if no key is available, skip report history
-                report_query = [report]
-            else:
-                # extend the selection w/reports that have matching keys,
-                # but only up until the requested variants' release (i.e., same as for ClinVar)
-                report_query = Report.objects\
-                    .filter(Data_Release_id__lte=report.Data_Release.id, Submission_ID_LOVD=key, Data_Release__date__gte=cutoff_date)\
-                    .order_by('-Data_Release_id').select_related('Data_Release')
-            report_versions.extend(list(map(report_to_dict, report_query)))
+    for report in reports:
+        key = report_history_key(report)
+        if report.Source not in ("ClinVar", "LOVD"):
+            continue
+        elif key is None:
+            # if no key is available, skip report history
+            report_query = [report]
+        else:
+            # extend the selection w/reports that have matching keys,
+            # but only up until the requested variants' release
+            report_query = [version for version in versions_by_key[key]
+                            if version.Data_Release_id <= report.Data_Release_id]
+        report_versions.extend(list(map(report_to_dict, report_query)))
 
     response = JsonResponse({"data": report_versions})
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
+
+def report_history_key(report):
+    """Returns the (Source, identifier) key shared by the versions of a ClinVar or LOVD report, None if it has none"""
+    if report.Source == "ClinVar":
+        key = report.SCV_ClinVar
+    elif report.Source == "LOVD":
+        key = report.Submission_ID_LOVD
+    else:
+        return None
+    if not key or key == '-':
+        return None
+    return (report.Source, key)
+
+
+def get_report_versions_by_key(reports):
+    """
+    Given reports, fetches the versions of all of them with a single query.
+    Returns a dictionary of lists of versions (latest release first) by report_history_key,
+    up until the latest release of the given reports.
+    """
+    versions_by_key = defaultdict(list)
+    keys = set(report_history_key(report) for report in reports) - {None}
+    clinvar_keys = set(key for source, key in keys if source == "ClinVar")
+    lovd_keys = set(key for source, key in keys if source == "LOVD")
+
+    conditions = []
+    if clinvar_keys:
+        conditions.append(Q(SCV_ClinVar__in=clinvar_keys))
+    if lovd_keys:
+        conditions.append(Q(Submission_ID_LOVD__in=lovd_keys, Data_Release__date__gte=LOVD_SUBMISSION_CUTOFF_DATE))
+    if not conditions:
+        return versions_by_key
+
+    versions = Report.objects\
+        .filter(reduce(__or__, conditions), Data_Release_id__lte=max(report.Data_Release_id for report in reports))\
+        .annotate(after_lovd_cutoff=Case(When(Data_Release__date__gte=LOVD_SUBMISSION_CUTOFF_DATE, then=Value(True)),
+                                         default=Value(False), output_field=BooleanField()))\
+        .order_by('-Data_Release_id', 'id').select_related('Data_Release').select_related('reportdiff')
+    for version in versions:
+        if version.SCV_ClinVar in clinvar_keys:
+            versions_by_key[("ClinVar", version.SCV_ClinVar)].append(version)
+        # only return submissions on or after 12/2/2019 since we redefined submission ids in this release
+        if version.Submission_ID_LOVD in lovd_keys and version.after_lovd_cutoff:
+            versions_by_key[("LOVD", version.Submission_ID_LOVD)].append(version)
+    return versions_by_key
+
+
 def variant_papers(request):
     variant_id = int(request.GET.get('variant_id'))
     variant = Variant.objects.get(id=variant_id)
@@ -272,14 +411,20 @@ def variant_papers(request):
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
+def change_type_name(change_type_id):
+    """Returns the name of a change type, the names are only queried once per process (and for new change types)"""
+    if change_type_id not in CHANGE_TYPE_NAMES:
+        CHANGE_TYPE_NAMES.update(ChangeType.objects.values_list('id', 'name'))
+    return CHANGE_TYPE_NAMES[change_type_id]
+
+
 def variant_to_dict(variant_object):
-    change_types_map = {x['name']:x['id'] for x in list(ChangeType.objects.values())}
     variant_dict = model_to_dict(variant_object)
     variant_dict["Data_Release"] = model_to_dict(variant_object.Data_Release)
     if variant_object.Mupit_Structure is not None:
         variant_dict["Mupit_Structure"] = model_to_dict(variant_object.Mupit_Structure)
     variant_dict["Data_Release"]["date"] = variant_object.Data_Release.date
-    variant_dict["Change_Type"] = ChangeType.objects.get(id=variant_dict["Change_Type"]).name
+    variant_dict["Change_Type"] = change_type_name(variant_dict["Change_Type"])
 
     try:
         variant_dict["priors"] = model_to_dict(variant_object.insilicopriors)
@@ -287,19 +432,17 @@ def variant_to_dict(variant_object):
         variant_dict["priors"] = None
 
     try:
-        variant_diff = VariantDiff.objects.get(variant_id=variant_object.id)
-        variant_dict["Diff"] = variant_diff.diff
+        variant_dict["Diff"] = variant_object.variantdiff.diff
     except VariantDiff.DoesNotExist:
         variant_dict["Diff"] = None
     return variant_dict
 
 
 def report_to_dict(report_object):
-    change_types_map = {x['name']:x['id'] for x in list(ChangeType.objects.values())}
     report_dict = model_to_dict(report_object)
     report_dict["Data_Release"] = model_to_dict(report_object.Data_Release)
     report_dict["Data_Release"]["date"] = report_object.Data_Release.date
-    report_dict["Change_Type"] = ChangeType.objects.get(id=report_dict["Change_Type"]).name
+    report_dict["Change_Type"] = change_type_name(report_dict["Change_Type"])
 
     if report_object.Source == "ClinVar":
         # don't display ClinVar report diffs prior to April 2018
@@ -317,8 +460,7 @@ def report_to_dict(report_object):
         logging.error(repr(e))
 
     try:
-        report_diff = ReportDiff.objects.get(report_id=report_object.id)
-        report_dict["Diff"] = report_diff.report_diff
+        report_dict["Diff"] = report_object.reportdiff.report_diff
     except ReportDiff.DoesNotExist:
         report_dict["Diff"] = None
 
@@ -327,6 +469,7 @@ def report_to_dict(report_object):
 
 
 @gzip_page
+@cache_per_release
 def index(request):
     order_by = request.GET.get('order_by')
     direction = request.GET.get('direction')
@@ -343,9 +486,23 @@ def index(request):
     change_types = request.GET.getlist('change_types')
     change_types_map = {x['name']:x['id'] for x in list(ChangeType.objects.values())}
     show_deleted = (request.GET.get('show_deleted', False) != False)
+    page_cursor = request.GET.get('cursor')
     deleted_count = 0
     synonyms_count = 0
     release_name = None
+    counts = None
+
+    if format == 'json' and not release and not search_term and page_cursor is None and snapshot_root():
+        # listings of the current variants are served from the snapshot of the latest release if there is one
+        response = snapshot_listing(include, exclude, filters, filter_values, show_deleted, order_by, direction,
+                                    column, page_size, page_num)
+        if response is not None:
+            return response
+
+    if format == 'json':
+        counts_key = variant_counts_cache_key(release, change_types, include, exclude, filters, filter_values,
+                                              search_term, show_deleted)
+        counts = cache.get(counts_key)
 
     if release:
         query = Variant.objects.filter(Data_Release_id=int(release))
@@ -367,51 +524,173 @@ def index(request):
         query = apply_filters(query, filter_values, filters, quotes=quotes)
 
     if search_term:
-        query, synonyms_count = apply_search(query, search_term, quotes=quotes, release=release)
+        query, synonyms_count = apply_search(query, search_term, quotes=quotes, release=release,
+                                             count_synonyms=(format == 'json' and counts is None))
 
     if not show_deleted and not release:
-        deleted_count = query.filter(Change_Type_id=change_types_map['deleted']).count()
+        if format == 'json' and counts is None:
+            deleted_count = query.filter(Change_Type_id=change_types_map['deleted']).count()
         query = query.exclude(Change_Type_id=change_types_map['deleted'])
 
     if order_by:
         query = apply_order(query, order_by, direction)
 
     if format == 'csv' or format == 'tsv':
-        cursor = connection.cursor()
-
-        # create an in-memory StringIO object that we can use to buffer the results from the server
-        # (it'll get released when it goes out of scope, so unlike a real file we don't need to close it)
-        f = io.StringIO()
         query = "COPY ({}) TO STDOUT WITH DELIMITER '{}' CSV HEADER".format(query.query, '\t' if format == 'tsv' else ',')
         # HACK to add quotes around search terms
         query = re.sub(r'LIKE UPPER\((.+?)\)', r"LIKE UPPER('\1')", query)
-        cursor.copy_expert(query, f)
-        f.seek(0)
 
-        response = HttpResponse(f.read(), content_type='text/csv')
+        # the export is streamed while the query runs, gzip_page compresses it on the fly if the client accepts gzip
+        response = StreamingHttpResponse(stream_copy(connection.cursor(), query), content_type='text/csv')
         response['Content-Disposition'] = 'attachment;filename="variants.%s"' % format
         return response
 
     elif format == 'json':
-        count = query.count()
-        query = select_page(query, page_size, page_num)
-        # call list() now to evaluate the query
-        response = JsonResponse({'count': count, 'deletedCount': deleted_count, 'synonyms': synonyms_count, 'releaseName': release_name, 'data': list(query.values(*column))})
+        if counts is None:
+            counts = {'count': query.count(), 'deletedCount': deleted_count, 'synonyms': synonyms_count}
+            cache.set(counts_key, counts, VARIANT_COUNTS_CACHE_TIMEOUT)
+
+        next_cursor = None
+        if page_cursor is not None and page_size:
+            # keyset pagination: the page starts after the last row of the previous page
+            ordering = get_ordering(order_by, direction)
+            query = query.order_by(*ordering)
+            if page_cursor:
+                try:
+                    query = query.filter(keyset_filter(ordering, decode_cursor(page_cursor, len(ordering))))
+                except (binascii.Error, ValueError):
+                    return HttpResponseBadRequest("malformed cursor")
+            key_fields = [field.lstrip('-') for field in ordering]
+            # one more row than the page tells whether there is a next page
+            rows = list(query.values(*(column + [field for field in key_fields if column and field not in column]))[:page_size + 1])
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_cursor = encode_cursor([rows[-1][field] for field in key_fields])
+            if column:
+                rows = [dict((field, row[field]) for field in column) for row in rows]
+        else:
+            # call list() now to evaluate the query
+            rows = list(select_page(query, page_size, page_num).values(*column))
+
+        response = JsonResponse({'count': counts['count'], 'deletedCount': counts['deletedCount'], 'synonyms': counts['synonyms'],
+                                 'releaseName': release_name, 'nextCursor': next_cursor, 'data': rows})
         response['Access-Control-Allow-Origin'] = '*'
         return response
 
 
-def apply_sources(query, include, exclude):
-    # if there are multiple sources given then OR them:
-    # the row must match in at least one column
+def snapshot_listing(include, exclude, filters, filter_values, show_deleted, order_by, direction, column,
+                     page_size, page_num):
+    """Returns the index response of a listing of the current variants served from the snapshot, or None"""
+    snapshot = current_snapshot(latest_release_version())
+    if snapshot is None:
+        return None
+    include, exclude = source_columns(include, exclude)
+    try:
+        content = snapshot.listing(include, exclude, list(zip(filters, normalize_filter_values(filter_values))),
+                                   show_deleted, get_ordering(order_by, direction) if order_by else [], column,
+                                   page_size, page_num)
+    except (IOError, OSError):
+        # the snapshot was replaced by a newer export while serving the listing
+        return None
+    if content is None:
+        return None
+    response = HttpResponse(content, content_type='application/json')
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+class CopyChunkWriter:
+    """
+    File-like object for cursor.copy_expert which collects the COPY output into chunks of about chunk_size bytes
+    and puts them into a bounded queue, blocking while the queue is full
+    """
+    def __init__(self, chunks, chunk_size):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        if self.cancelled.is_set():
+            # aborts the COPY
+            raise IOError("export cancelled")
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.chunks.put(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+
+def stream_copy(cursor, query, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Runs a COPY ... TO STDOUT query in a background thread and yields its output in chunks of about chunk_size bytes
+    as they arrive, so that memory use doesn't depend on the size of the export. If the consumer stops early
+    (e.g. the client disconnected), the COPY is aborted.
+    """
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    writer = CopyChunkWriter(chunks, chunk_size)
+    done = object()
+
+    def copy():
+        try:
+            cursor.copy_expert(query, writer)
+            writer.flush()
+            chunks.put(done)
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    finished = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                finished = True
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        writer.cancelled.set()
+        # unblock the copy thread if it waits for space in the queue
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+        if finished:
+            cursor.close()
+        else:
+            # an aborted COPY leaves the connection in an undefined state, a new one is opened by the next request
+            connection.close()
+
+
+def source_columns(include, exclude):
+    """Returns the source columns of which a listing's rows must match at least one, and those they must not match"""
     if len(include) > 0:
         if include == ['all']:
             include = [f.name for f in Variant._meta.get_fields() if (f.name.startswith("Variant_in_") and f.name != "Variant_in_Findlay_BRCA1_Ring_Function_Scores")]
-        include_list = (Q(**{column: True}) for column in include)
-        query = query.filter(reduce(__or__, include_list))
     else:
         # exclude all sources if none are included
         exclude = [f.name for f in Variant._meta.get_fields() if "Variant_in" in f.name]
+    return include, exclude
+
+
+def apply_sources(query, include, exclude):
+    include, exclude = source_columns(include, exclude)
+    # if there are multiple sources given then OR them:
+    # the row must match in at least one column
+    if include:
+        include_list = (Q(**{column: True}) for column in include)
+        query = query.filter(reduce(__or__, include_list))
     if exclude:
         exclude_dict = {exclusion: False for exclusion in exclude}
         query = query.filter(**exclude_dict)
@@ -449,7 +728,19 @@ def remove_disallowed_chars(search_term):
     return search_term
 
 
-def apply_search(query, search_term, quotes='', release=None):
+def variant_counts_cache_key(release, change_types, include, exclude, filters, filter_values, search_term, show_deleted):
+    """
+    Returns the cache key of the counts of a variants listing: the listing parameters normalized the way
+    they are applied, and the latest release version, so that adding or removing a release or changing its data in
+    place invalidates the counts
+    """
+    listing = [release, sorted(change_types), sorted(include), sorted(exclude), sorted(zip(filters, filter_values)),
+               remove_disallowed_chars((search_term or '').lower().strip()), show_deleted]
+    digest = hashlib.md5(json.dumps([latest_release_version(), listing]).encode('utf-8')).hexdigest()
+    return 'variant_counts:' + digest
+
+
+def apply_search(query, search_term, quotes='', release=None, count_synonyms=True):
     '''
     NOTE: there is some additional handling of search terms on the front-end in
     website/js/hgvs.js. hgvs.js methods are called before sending the query to the
@@ -536,13 +827,17 @@ def apply_search(query, search_term, quotes='', release=None):
 
         # values in synonyms column are separated by commas
         comma_prefixed_suffix = ',' + suffix
-        results = query.filter(HGVS_Protein__istartswith=prefix).filter(
-            Q(Protein_Change__istartswith=suffix) |
-            Q(HGVS_Protein__icontains=suffix) |
-            Q(Synonyms__icontains=comma_prefixed_suffix) |
-            Q(Synonyms__istartswith=suffix)
-        ) | query.filter(Q(HGVS_Protein__icontains=search_term) | Q(Synonyms__icontains=search_term))
-        non_synonyms = results.filter(Protein_Change__istartswith=suffix) | query.filter(HGVS_Protein__icontains=search_term)
+        results = query.filter(
+            Q(HGVS_Protein__istartswith=prefix) & (
+                Q(Protein_Change__istartswith=suffix) |
+                Q(HGVS_Protein__icontains=suffix) |
+                Q(Synonyms__icontains=comma_prefixed_suffix) |
+                Q(Synonyms__istartswith=suffix)
+            ) |
+            Q(HGVS_Protein__icontains=search_term) |
+            Q(Synonyms__icontains=search_term)
+        )
+        non_synonyms = Q(Protein_Change__istartswith=suffix) | Q(HGVS_Protein__icontains=search_term)
 
     # Handle gene symbol prefixed searches
     elif has_gene_symbol_prefix:
@@ -554,20 +849,23 @@ def apply_search(query, search_term, quotes='', release=None):
         comma_prefixed_suffix = ',' + suffix
         # need to check synonym column for colon prefixes in the case of HGVS_cDNA and HGVS_Protein fields
         colon_prefixed_suffix = ':' + suffix
-        results = query.filter(Gene_Symbol__iexact=prefix).filter(
-            Q(HGVS_cDNA__icontains=suffix) |
-            Q(HGVS_Protein__icontains=suffix) |
-            Q(Genomic_Coordinate_hg38__istartswith=suffix) |
-            Q(Genomic_Coordinate_hg37__istartswith=suffix) |
-            Q(Genomic_HGVS_38__istartswith=suffix) |
-            Q(Genomic_HGVS_37__istartswith=suffix) |
-            Q(BIC_Nomenclature__istartswith=suffix) |
-            Q(Protein_Change__istartswith=suffix) |
-            Q(Synonyms__icontains=comma_prefixed_suffix) |
-            Q(Synonyms__icontains=colon_prefixed_suffix) |
-            Q(Synonyms__istartswith=suffix)
-        ) | query.filter(Synonyms__icontains=search_term)
-        non_synonyms = results.filter(
+        results = query.filter(
+            Q(Gene_Symbol__iexact=prefix) & (
+                Q(HGVS_cDNA__icontains=suffix) |
+                Q(HGVS_Protein__icontains=suffix) |
+                Q(Genomic_Coordinate_hg38__istartswith=suffix) |
+                Q(Genomic_Coordinate_hg37__istartswith=suffix) |
+                Q(Genomic_HGVS_38__istartswith=suffix) |
+                Q(Genomic_HGVS_37__istartswith=suffix) |
+                Q(BIC_Nomenclature__istartswith=suffix) |
+                Q(Protein_Change__istartswith=suffix) |
+                Q(Synonyms__icontains=comma_prefixed_suffix) |
+                Q(Synonyms__icontains=colon_prefixed_suffix) |
+                Q(Synonyms__istartswith=suffix)
+            ) |
+            Q(Synonyms__icontains=search_term)
+        )
+        non_synonyms = (
             Q(HGVS_cDNA__icontains=suffix) |
             Q(HGVS_Protein__icontains=suffix) |
             Q(Genomic_Coordinate_hg38__istartswith=suffix) |
@@ -581,17 +879,20 @@ def apply_search(query, search_term, quotes='', release=None):
         prefix = search_term[:11]
         suffix = search_term[12:]
         comma_prefixed_suffix = ',' + suffix
-        results = query.filter(Reference_Sequence__iexact=prefix).filter(
-            Q(HGVS_cDNA__icontains=suffix) |
-            Q(Genomic_Coordinate_hg38__istartswith=suffix) |
-            Q(Genomic_Coordinate_hg37__istartswith=suffix) |
-            Q(Genomic_HGVS_38__istartswith=suffix) |
-            Q(Genomic_HGVS_37__istartswith=suffix) |
-            Q(BIC_Nomenclature__istartswith=suffix) |
-            Q(Synonyms__icontains=comma_prefixed_suffix) |
-            Q(Synonyms__istartswith=suffix)
-        ) | query.filter(Synonyms__icontains=search_term)
-        non_synonyms = results.filter(
+        results = query.filter(
+            Q(Reference_Sequence__iexact=prefix) & (
+                Q(HGVS_cDNA__icontains=suffix) |
+                Q(Genomic_Coordinate_hg38__istartswith=suffix) |
+                Q(Genomic_Coordinate_hg37__istartswith=suffix) |
+                Q(Genomic_HGVS_38__istartswith=suffix) |
+                Q(Genomic_HGVS_37__istartswith=suffix) |
+                Q(BIC_Nomenclature__istartswith=suffix) |
+                Q(Synonyms__icontains=comma_prefixed_suffix) |
+                Q(Synonyms__istartswith=suffix)
+            ) |
+            Q(Synonyms__icontains=search_term)
+        )
+        non_synonyms = (
             Q(HGVS_cDNA__icontains=suffix) |
             Q(Genomic_Coordinate_hg38__istartswith=suffix) |
             Q(Genomic_HGVS_38__istartswith=suffix) |
@@ -599,16 +900,11 @@ def apply_search(query, search_term, quotes='', release=None):
         )
     # Handle clinvar accession numbers
     elif clinvar_accession is True:
-        results = query.filter(
+        # accessions aren't searched in the synonyms, so none of the matches are synonyms
+        return query.filter(
             Q(SCV_ClinVar__icontains=search_term) |
             Q(ClinVarAccession_ENIGMA__icontains=search_term)
-        )
-
-        # filter against synonym fields
-        non_synonyms = query.filter(
-            Q(SCV_ClinVar__icontains=search_term) |
-            Q(ClinVarAccession_ENIGMA__icontains=search_term)
-        )
+        ), 0
 
         # Generic searches (no prefixes)
     else:
@@ -628,7 +924,7 @@ def apply_search(query, search_term, quotes='', release=None):
         )
 
         # filter against synonym fields
-        non_synonyms = query.filter(
+        non_synonyms = (
             Q(Pathogenicity_expert__icontains=search_term) |
             Q(Genomic_Coordinate_hg38__icontains=search_term) |
             Q(Genomic_HGVS_38__istartswith=search_term) |
@@ -639,18 +935,33 @@ def apply_search(query, search_term, quotes='', release=None):
             Q(Protein_Change__icontains=search_term)
         )
 
-    synonyms_count = results.count() - non_synonyms.count()
+    if not count_synonyms:
+        return results, 0
+
+    # count the matches and the matches of non-synonym fields in a single pass over the results
+    counts = results.aggregate(
+        matches=Count('id'),
+        non_synonyms=Count(Case(When(non_synonyms, then=Value(1)), output_field=IntegerField()))
+    )
+    synonyms_count = counts['matches'] - counts['non_synonyms']
 
     return results, synonyms_count
 
 
-def apply_order(query, order_by, direction):
+def get_ordering(order_by, direction):
+    """Returns the order_by arguments of a listing sorted by order_by, ending with id so that the order is total"""
+    if not order_by:
+        return ['id']
     # special case for HGVS columns
     if order_by in ('HGVS_cDNA', 'HGVS_Protein'):
         order_by = 'Genomic_Coordinate_hg38'
     if direction == 'descending':
         order_by = '-' + order_by
-    return query.order_by(order_by, 'Pathogenicity_expert')
+    return [order_by, 'Pathogenicity_expert', 'id']
+
+
+def apply_order(query, order_by, direction):
+    return query.order_by(*get_ordering(order_by, direction))
 
 
 def select_page(query, page_size, page_num):
@@ -661,6 +972,42 @@ def select_page(query, page_size, page_num):
     return query
 
 
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """Returns the values of a cursor of an ordering by length fields, raises ValueError if it is malformed"""
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("cursor doesn't hold %d values" % length)
+    return values
+
+
+def keyset_filter(ordering, values):
+    """
+    Given the order_by arguments of a listing and the values of its fields in a row, returns the filter
+    selecting the rows after that row. Postgres sorts nulls after all values in ascending order.
+    """
+    conditions = []
+    equal = Q()
+    for field, value in zip(ordering, values):
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        if value is None:
+            # only the non-null values follow a null, and only in descending order
+            if descending:
+                conditions.append(equal & Q(**{field + '__isnull': False}))
+            equal &= Q(**{field + '__isnull': True})
+        else:
+            if descending:
+                conditions.append(equal & Q(**{field + '__lt': value}))
+            else:
+                conditions.append(equal & (Q(**{field + '__gt': value}) | Q(**{field + '__isnull': True})))
+            equal &= Q(**{field: value})
+    return reduce(__or__, conditions)
+
+
 def autocomplete(request):
     cursor = connection.cursor()
     term = request.GET.get('term')
@@ -681,12 +1028,13 @@ def autocomplete(request):
         WHERE word LIKE %s
         AND char_length(word) >= 3
         AND release_id = %s
-        ORDER BY word""",
-        ["%s%%" % term, release])
+        ORDER BY word
+        LIMIT %s""",
+        ["%s%%" % term, release, limit])
 
     rows = cursor.fetchall()
 
-    response = JsonResponse({'suggestions': rows[:limit]})
+    response = JsonResponse({'suggestions': rows})
     response['Access-Control-Allow-Origin'] = '*'
     return response
 